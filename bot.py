@@ -5,10 +5,12 @@ from discord.ext import commands
 from discord.utils import *
 
 import os
+import sys
 from dotenv import load_dotenv
 
 from lib.Logger import *
 from lib.Rooms import Rooms
+from lib.Provisioning import setup
 
 intents = discord.Intents.default()
 intents.members = True
@@ -17,17 +19,48 @@ intents.reactions = True
 try:
     load_dotenv()
     TOKEN = str(os.getenv("TOKEN"))
+    SHARD_COUNT = os.getenv("SHARD_COUNT")
+    SHARD_IDS = os.getenv("SHARD_IDS")
+    FAKE_GATEWAY = os.getenv("FAKE_GATEWAY")
+    LEAN_MODE = os.getenv("LEAN_MODE", "").lower() in ("1", "true", "yes")
     logger.info("SUCCESS: Environment settings loaded")
 except:
     logger.error("FAILED: Couldn't load environment settings")
     exit()
 
+# Local stand-in for Discord, see launcher.py --fake-gateway
+if FAKE_GATEWAY:
+    discord.http.Route.BASE = f"{FAKE_GATEWAY}/api/v7"
+
 class Bot():
 
     def __init__(self):
 
-        self.bot = commands.Bot(command_prefix="!", intents=intents, help_command=None,  case_insensitive=True)
+        options = dict(command_prefix="!", intents=intents, help_command=None, case_insensitive=True)
+
+        # Skip member chunking and keep only members sitting in voice, the rest is fetched when a command needs it
+        if LEAN_MODE:
+            options["chunk_guilds_at_startup"] = False
+            options["member_cache_flags"] = discord.MemberCacheFlags(online=False, voice=True, joined=False)
+
+        # Each worker process runs only its own shards, "auto" lets Discord pick the count
+        if SHARD_COUNT:
+            if SHARD_COUNT != "auto":
+                options["shard_count"] = int(SHARD_COUNT)
+            if SHARD_IDS:
+                options["shard_ids"] = [int(shard_id) for shard_id in SHARD_IDS.split(",")]
+            self.bot = commands.AutoShardedBot(**options)
+        else:
+            self.bot = commands.Bot(**options)
         self.bot.add_cog(Rooms(self.bot))
 
         self.bot.run(TOKEN)
-Bot()
\ No newline at end of file
+
+        # Unloading cogs flushes pending database writes
+        self.bot.remove_cog("Rooms")
+
+# `python bot.py setup <guild id>` creates the channels, saves them into settings and exits
+if len(sys.argv) > 1 and sys.argv[1] == "setup":
+    setup(sys.argv[2:], TOKEN)
+else:
+    Bot()
\ No newline at end of file
@@ -0,0 +1,77 @@
+# launcher.py
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+from lib.Logger import *
+
+# Runs the bot as several worker processes, each owning a contiguous range of shards.
+# Workers share the SQLite database (WAL) and never touch guilds of another worker's shards.
+
+def split_shards(shard_count, workers):
+    per_worker, extra = divmod(shard_count, workers)
+    start = 0
+    for worker in range(workers):
+        size = per_worker + (1 if worker < extra else 0)
+        yield list(range(start, start + size))
+        start += size
+
+async def run_workers(args, env):
+    processes = []
+    for shard_ids in split_shards(args.shards, args.workers):
+        if not shard_ids:
+            continue
+        worker_env = dict(env, SHARD_COUNT=str(args.shards), SHARD_IDS=",".join(map(str, shard_ids)))
+        process = await asyncio.create_subprocess_exec(sys.executable, "bot.py", env=worker_env)
+        logger.info("SUCCESS: Started worker %s for shards %s", process.pid, shard_ids)
+        processes.append(process)
+
+    try:
+        if args.duration:
+            await asyncio.sleep(args.duration)
+        else:
+            await asyncio.gather(*(process.wait() for process in processes))
+    finally:
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+        await asyncio.gather(*(process.wait() for process in processes))
+
+async def main(args):
+    env = dict(os.environ)
+    gateway = None
+
+    if args.fake_gateway:
+        from lib.FakeGateway import FakeGateway
+
+        gateway = FakeGateway(guild_count=args.guilds, member_count=args.members)
+        await gateway.start()
+
+        settings_path = os.path.join(tempfile.mkdtemp(), "settings.json")
+        gateway.write_settings(settings_path)
+        env.update(TOKEN="fake", FAKE_GATEWAY=gateway.url, SETTINGS_PATH=settings_path)
+
+    try:
+        await run_workers(args, env)
+    finally:
+        if gateway is not None:
+            for shard_id, shard_count, guild_ids in sorted(gateway.identified):
+                logger.info("Shard %s/%s identified with %s guilds", shard_id, shard_count, len(guild_ids))
+            await gateway.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bot as several sharded worker processes")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes")
+    parser.add_argument("--shards", type=int, default=2, help="total number of shards")
+    parser.add_argument("--fake-gateway", action="store_true", help="run against a local fake Discord instead of the real one")
+    parser.add_argument("--guilds", type=int, default=8, help="number of guilds served by the fake gateway")
+    parser.add_argument("--members", type=int, default=0, help="number of members in every fake guild")
+    parser.add_argument("--duration", type=float, default=0, help="stop workers after this many seconds")
+    args = parser.parse_args()
+
+    if args.workers > args.shards:
+        parser.error("--workers can't be larger than --shards")
+
+    asyncio.run(main(args))
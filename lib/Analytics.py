@@ -0,0 +1,151 @@
+import time
+
+HOUR = 3600
+DAY = 86400
+
+PERIODS = (("hour", HOUR), ("day", DAY))
+
+class Rollup:
+
+    # Changes to one period's counters since the last flush
+
+    __slots__ = ("created", "deleted", "timed", "lifetime", "joined", "invitations", "peak")
+
+    def __init__(self):
+        self.created = 0
+        self.deleted = 0
+        self.timed = 0
+        self.lifetime = 0.0
+        self.joined = 0
+        self.invitations = 0
+        self.peak = 0
+
+class Analytics:
+
+    # Room lifecycle and membership events. Every event is one row appended through the database journal,
+    # hourly and daily rollups are summed up in memory and added to the stored ones with each flush,
+    # so recording costs a list append and stats never scan the events.
+
+    def __init__(self, db, enabled=True):
+        self.db = db
+        self.enabled = enabled
+
+        # (guild_id, period, period_start) -> Rollup
+        self.rollups = {}
+        # Rooms currently open per guild, for peak concurrency
+        self.active = {}
+        # Room id -> time it was handed out
+        self.opened = {}
+        # (guild_id, period) -> (period_start, peak) last written, so a steady count isn't written again
+        self.peaks = {}
+
+        db.flush_hooks.append(self.stage)
+
+    async def start(self, rooms):
+        # rooms maps guild id -> ids of rooms already open
+        self.active = {guild_id: len(room_ids) for guild_id, room_ids in rooms.items()}
+        if self.enabled:
+            self.opened.update(await self.db.get_room_created_times())
+
+    def rollups_at(self, guild_id, at):
+        for period, length in PERIODS:
+            key = (guild_id, period, int(at // length * length))
+            rollup = self.rollups.get(key)
+            if rollup is None:
+                rollup = self.rollups[key] = Rollup()
+            yield rollup
+
+    def record(self, event, guild_id, room_id, member_id=0, value=0):
+        at = time.time()
+        self.db.add_room_event(at, guild_id, room_id, member_id, event, value)
+        return at
+
+# EVENTS
+
+    def room_created(self, guild_id, room_id, member_id):
+        if not self.enabled:
+            return
+        at = self.record("created", guild_id, room_id, member_id)
+        self.opened[room_id] = at
+
+        active = self.active[guild_id] = self.active.get(guild_id, 0) + 1
+        for rollup in self.rollups_at(guild_id, at):
+            rollup.created += 1
+            rollup.peak = max(rollup.peak, active)
+
+    def room_deleted(self, guild_id, room_id):
+        if not self.enabled:
+            return
+        # Rooms opened before analytics existed have no known lifetime
+        opened = self.opened.pop(room_id, None)
+        lifetime = time.time() - opened if opened else 0
+        at = self.record("deleted", guild_id, room_id, value=lifetime)
+
+        self.active[guild_id] = max(0, self.active.get(guild_id, 0) - 1)
+        for rollup in self.rollups_at(guild_id, at):
+            rollup.deleted += 1
+            if opened:
+                rollup.timed += 1
+                rollup.lifetime += lifetime
+
+    def member_joined(self, guild_id, room_id, member_id):
+        if not self.enabled:
+            return
+        at = self.record("joined", guild_id, room_id, member_id)
+        for rollup in self.rollups_at(guild_id, at):
+            rollup.joined += 1
+
+    def members_invited(self, guild_id, room_id, member_ids):
+        if not self.enabled or not member_ids:
+            return
+        for member_id in member_ids:
+            at = self.record("invited", guild_id, room_id, member_id)
+        for rollup in self.rollups_at(guild_id, at):
+            rollup.invitations += len(member_ids)
+
+    def ownership_transferred(self, guild_id, room_id, member_id):
+        if self.enabled:
+            self.record("transferred", guild_id, room_id, member_id)
+
+    def stage(self):
+        # Runs right before the database flushes, puts the gathered counters into the same transaction
+        if not self.enabled:
+            return
+
+        # Rooms staying open through a quiet hour still count towards its peak
+        now = time.time()
+        for guild_id, active in self.active.items():
+            for period, length in PERIODS:
+                period_start = int(now // length * length)
+                if active and self.peaks.get((guild_id, period), (0, 0)) < (period_start, active):
+                    rollup = self.rollups.setdefault((guild_id, period, period_start), Rollup())
+                    rollup.peak = max(rollup.peak, active)
+
+        rollups, self.rollups = self.rollups, {}
+        for (guild_id, period, period_start), rollup in rollups.items():
+            if self.peaks.get((guild_id, period), (0, 0)) < (period_start, rollup.peak):
+                self.peaks[(guild_id, period)] = (period_start, rollup.peak)
+            self.db.add_rollup(guild_id, period, period_start, rollup.created, rollup.deleted, rollup.timed,
+                rollup.lifetime, rollup.joined, rollup.invitations, rollup.peak)
+
+# QUERIES
+
+    async def summary(self, guild_id, days):
+        # Totals over the last days, including today
+        since = int(time.time() // DAY * DAY) - (days - 1) * DAY
+        await self.db.flush()
+
+        totals = await self.db.get_rollup_totals(guild_id, since)
+        created, deleted, timed, lifetime, joined, invitations, peak = (value or 0 for value in totals or (None,) * 7)
+        hours = await self.db.get_busiest_hours(guild_id, since)
+
+        return {
+            "created": created,
+            "deleted": deleted,
+            "active": self.active.get(guild_id, 0),
+            "peak": peak,
+            "lifetime": lifetime / timed if timed else 0,
+            "invitations": invitations / created if created else 0,
+            "joined": joined,
+            "hours": [hour for hour, _ in hours],
+        }
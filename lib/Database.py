@@ -1,63 +1,227 @@
 import sqlite3
 from sqlite3 import Error
 
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from lib.Logger import *
+from lib.Metrics import metrics
+
+# Schema versions, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = [
+    (
+        "CREATE TABLE IF NOT EXISTS active_rooms \
+            (id INTEGER PRIMARY KEY AUTOINCREMENT, \
+            room_id INTEGER NOT NULL, \
+            member_id INTEGER NOT NULL, \
+            is_open INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS active_invitations \
+            (id INTEGER PRIMARY KEY AUTOINCREMENT, \
+            room_id INTEGER NOT NULL, \
+            member_id INTEGER NOT NULL)",
+    ),
+    (
+        "DELETE FROM active_rooms WHERE id NOT IN (SELECT MAX(id) FROM active_rooms GROUP BY room_id)",
+        "DELETE FROM active_invitations WHERE id NOT IN (SELECT MIN(id) FROM active_invitations GROUP BY room_id, member_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_active_rooms_room ON active_rooms (room_id)",
+        "CREATE INDEX IF NOT EXISTS idx_active_rooms_member ON active_rooms (member_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_active_invitations_room_member ON active_invitations (room_id, member_id)",
+        "CREATE INDEX IF NOT EXISTS idx_active_invitations_member ON active_invitations (member_id)",
+    ),
+    (
+        "ALTER TABLE active_rooms ADD COLUMN guild_id INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE active_invitations ADD COLUMN guild_id INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_active_rooms_guild_member ON active_rooms (guild_id, member_id)",
+        "CREATE INDEX IF NOT EXISTS idx_active_invitations_guild ON active_invitations (guild_id)",
+    ),
+    (
+        "CREATE TABLE IF NOT EXISTS join_requests \
+            (message_id INTEGER PRIMARY KEY, \
+            channel_id INTEGER NOT NULL, \
+            guild_id INTEGER NOT NULL, \
+            requester_id INTEGER NOT NULL, \
+            owner_id INTEGER NOT NULL, \
+            expires_at REAL NOT NULL)",
+    ),
+    (
+        "CREATE TABLE IF NOT EXISTS info_messages \
+            (guild_id INTEGER PRIMARY KEY, \
+            channel_id INTEGER NOT NULL, \
+            message_id INTEGER NOT NULL)",
+    ),
+    (
+        "CREATE TABLE IF NOT EXISTS room_events \
+            (id INTEGER PRIMARY KEY AUTOINCREMENT, \
+            at REAL NOT NULL, \
+            guild_id INTEGER NOT NULL, \
+            room_id INTEGER NOT NULL, \
+            member_id INTEGER NOT NULL, \
+            event TEXT NOT NULL, \
+            value REAL NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS idx_room_events_room ON room_events (room_id)",
+        "CREATE TABLE IF NOT EXISTS room_rollups \
+            (guild_id INTEGER NOT NULL, \
+            period TEXT NOT NULL, \
+            period_start INTEGER NOT NULL, \
+            rooms_created INTEGER NOT NULL DEFAULT 0, \
+            rooms_deleted INTEGER NOT NULL DEFAULT 0, \
+            timed_rooms INTEGER NOT NULL DEFAULT 0, \
+            lifetime_seconds REAL NOT NULL DEFAULT 0, \
+            members_joined INTEGER NOT NULL DEFAULT 0, \
+            invitations INTEGER NOT NULL DEFAULT 0, \
+            peak_rooms INTEGER NOT NULL DEFAULT 0, \
+            PRIMARY KEY (guild_id, period, period_start))",
+    ),
+]
+
+query_latency = metrics.histogram("db_query_seconds", "Duration of database calls by method, including time queued for the database thread", ("method",))
+
+def timed(function):
+    histogram = query_latency.labels(function.__name__)
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    return wrapper
+
+DATABASE_PATH = os.getenv("DATABASE_PATH", "bot.db")
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA busy_timeout = 5000",
+)
 
 class Database:
 
-    def __init__(self, db_name="bot.db"):
+    def __init__(self, db_name=DATABASE_PATH):
         self.name = db_name
+
+        # Writes are queued here and committed in batches by flush()
+        self.journal = []
+        # Called right before every flush, to queue writes that are gathered in memory
+        self.flush_hooks = []
+
+        # Every query runs on this single thread, so the event loop never waits on disk I/O
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        self.executor.submit(self.setup, db_name).result()
+
+    def setup(self, db_name):
         self.conn = self.connect(db_name)
         self.cursor = self.conn.cursor()
-        self.create_tables()
+        self.migrate()
 
     def connect(self, db_name):
         try:
-            return sqlite3.connect(db_name, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            conn = sqlite3.connect(db_name, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, cached_statements=128)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            return conn
         except Error as e:
             logger.error(e)
             pass
 
-    def create_tables(self):
+    def migrate(self):
 
-        try:
-            self.cursor.execute("CREATE TABLE IF NOT EXISTS active_rooms \
-                (id INTEGER PRIMARY KEY AUTOINCREMENT, \
-                room_id INTEGER NOT NULL, \
-                member_id INTEGER NOT NULL, \
-                is_open INTEGER NOT NULL DEFAULT 0)")
-            self.cursor.execute("CREATE TABLE IF NOT EXISTS active_invitations \
-                (id INTEGER PRIMARY KEY AUTOINCREMENT, \
-                room_id INTEGER NOT NULL, \
-                member_id INTEGER NOT NULL)")
+        # Several worker processes can share the database, the write lock makes only one of them migrate
+        number = None
+        while True:
+            try:
+                self.cursor.execute("BEGIN IMMEDIATE")
+                number = self.cursor.execute("PRAGMA user_version").fetchone()[0] + 1
+                if number > len(MIGRATIONS):
+                    self.conn.rollback()
+                    return True
+                for statement in MIGRATIONS[number - 1]:
+                    self.cursor.execute(statement)
+                self.cursor.execute(f"PRAGMA user_version = {number}")
+                self.conn.commit()
 
-        except Error as e:
-            logger.error(e)
-            return False
+            except Error as e:
+                self.conn.rollback()
+                logger.error("FAILED: Couldn't migrate database to version %s - %s", number, e)
+                return False
+
+            logger.info("SUCCESS: Database migrated to version %s", number)
 
-        self.conn.commit()
-        return True
+    def close(self):
+        for hook in self.flush_hooks:
+            hook()
+        if self.journal:
+            statements, self.journal = self.journal, []
+            self.executor.submit(self._execute_batch, statements).result()
+        self.executor.submit(self.conn.close).result()
+        self.executor.shutdown()
 
 # GENERIC FUNCTIONS
 
-    def execute_statement(self, statement):
+    async def run(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    def _execute(self, statements, commit):
 
+        # Runs on database thread, statements are applied as one transaction
         try:
-            self.cursor.execute(statement)
+            for statement, params in statements:
+                self.cursor.execute(statement, params)
+            result = self.cursor.fetchall()
         except Error as e:
             logger.error(e)
-            return False
-        return True
+            self.conn.rollback()
+            return None
+
+        if commit:
+            self.conn.commit()
+        return result
+
+    async def execute_statement(self, statement, params=(), commit=False):
+        return await self.run(self._execute, ((statement, params),), commit)
+
+    def _execute_batch(self, statements):
+
+        if self._execute(statements, True) is not None:
+            return True
+
+        # One bad statement shouldn't drop the whole batch
+        for statement in statements:
+            self._execute((statement,), True)
+        return False
+
+    def queue(self, statement, params=()):
+        self.journal.append((statement, params))
+
+    @timed
+    async def flush(self):
+
+        for hook in self.flush_hooks:
+            hook()
 
-    def get_value(self, member_id, table, attribute):
+        if not self.journal:
+            return True
+
+        statements, self.journal = self.journal, []
+        return await self.run(self._execute_batch, statements)
 
-        if self.member_exists(member_id):
+    @timed
+    async def get_value(self, member_id, table, attribute):
 
-            statement = f"SELECT {attribute} FROM {table} WHERE member_id = {int(member_id)}"
+        if await self.member_exists(member_id):
 
-            if self.execute_statement(statement):
+            statement = f"SELECT {attribute} FROM {table} WHERE member_id = ?"
+            result = await self.execute_statement(statement, (int(member_id),))
 
-                result = self.cursor.fetchall()
+            if result is not None:
                 return result[0][0]
             
             return 0
@@ -66,110 +230,213 @@ class Database:
 
 # PRIVATE ROOMS
 
-    def invite_member(self, room_id, member_id):
+    @timed
+    async def get_all_rooms(self):
+        result = await self.execute_statement("SELECT guild_id, room_id, member_id, is_open FROM active_rooms")
+        return result or []
 
-        statement = f"INSERT INTO active_invitations (room_id, member_id) VALUES ({int(room_id)}, {int(member_id)})"
-        if self.execute_statement(statement):
-            self.conn.commit()
-            return True
-        return False
+    @timed
+    async def get_all_invitations(self):
+        result = await self.execute_statement("SELECT room_id, member_id FROM active_invitations")
+        return result or []
+
+    def invite_member(self, room_id, member_id, guild_id=0):
+        statement = "INSERT OR IGNORE INTO active_invitations (guild_id, room_id, member_id) VALUES (?, ?, ?)"
+        params = (int(guild_id), int(room_id), int(member_id))
+        self.queue(statement, params)
 
     def uninvite_member(self, room_id, member_id):
-        statement = f"DELETE FROM active_invitations WHERE member_id = {int(member_id)} AND room_id = {int(room_id)}"
-        if self.execute_statement(statement):
-            self.conn.commit()
-            return True
-        return False
+        statement = "DELETE FROM active_invitations WHERE member_id = ? AND room_id = ?"
+        params = (int(member_id), int(room_id))
+        self.queue(statement, params)
 
-    def get_all_invited_members(self, room_id):
-        statement = f"SELECT * FROM active_invitations WHERE room_id = {int(room_id)}"
-        if self.execute_statement(statement):
-            result = self.cursor.fetchall()
-            if result:
-                return result
-        return False
+    def invite_members(self, room_id, member_ids, guild_id=0):
+        # Whole batch goes in as one multi-row insert
+        member_ids = [int(member_id) for member_id in member_ids]
+        for start in range(0, len(member_ids), 300):
+            chunk = member_ids[start:start + 300]
+            values = ", ".join("(?, ?, ?)" for _ in chunk)
+            params = [value for member_id in chunk for value in (int(guild_id), int(room_id), member_id)]
+            self.queue(f"INSERT OR IGNORE INTO active_invitations (guild_id, room_id, member_id) VALUES {values}", params)
 
-    def is_member_invited(self, room_id, member_id):
-        statement = f"SELECT EXISTS (SELECT 1 FROM active_invitations WHERE member_id = {int(member_id)} AND room_id = {int(room_id)} LIMIT 1)"
-        if self.execute_statement(statement):
-            result = self.cursor.fetchall()
-            if result[0][0]:
-                return True
+    def uninvite_members(self, room_id, member_ids):
+        member_ids = [int(member_id) for member_id in member_ids]
+        for start in range(0, len(member_ids), 500):
+            chunk = member_ids[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            self.queue(f"DELETE FROM active_invitations WHERE room_id = ? AND member_id IN ({placeholders})", [int(room_id)] + chunk)
+
+    @timed
+    async def get_all_invited_members(self, room_id):
+        statement = "SELECT * FROM active_invitations WHERE room_id = ?"
+        params = (int(room_id),)
+        result = await self.execute_statement(statement, params)
+        if result:
+            return result
         return False
 
-    def add_private_room(self, room_id, member_id):
-        statement = f"INSERT INTO active_rooms (room_id, member_id) VALUES ({int(room_id)}, {int(member_id)})"
-        if self.execute_statement(statement):
-            self.conn.commit()
+    @timed
+    async def is_member_invited(self, room_id, member_id):
+        statement = "SELECT EXISTS (SELECT 1 FROM active_invitations WHERE member_id = ? AND room_id = ? LIMIT 1)"
+        params = (int(member_id), int(room_id))
+        result = await self.execute_statement(statement, params)
+        if result and result[0][0]:
             return True
         return False
 
-    def is_room_private(self, room_id):
-        statement = f"SELECT EXISTS (SELECT 1 FROM active_rooms WHERE room_id = {int(room_id)} LIMIT 1)"
-        if self.execute_statement(statement):
-            result = self.cursor.fetchall()
-            if result[0][0]:
-                return True
+    def add_private_room(self, room_id, member_id, guild_id=0):
+        statement = "INSERT INTO active_rooms (guild_id, room_id, member_id) VALUES (?, ?, ?)"
+        params = (int(guild_id), int(room_id), int(member_id))
+        self.queue(statement, params)
+
+    @timed
+    async def is_room_private(self, room_id):
+        statement = "SELECT EXISTS (SELECT 1 FROM active_rooms WHERE room_id = ? LIMIT 1)"
+        params = (int(room_id),)
+        result = await self.execute_statement(statement, params)
+        if result and result[0][0]:
+            return True
         return False
     
-    def is_owner(self, room_id, member_id):
-        statement = f"SELECT EXISTS (SELECT 1 FROM active_rooms WHERE room_id = {int(room_id)} AND member_id = {int(member_id)} LIMIT 1)"
-        if self.execute_statement(statement):
-            result = self.cursor.fetchall()
-            if result[0][0]:
-                return True
+    @timed
+    async def is_owner(self, room_id, member_id):
+        statement = "SELECT EXISTS (SELECT 1 FROM active_rooms WHERE room_id = ? AND member_id = ? LIMIT 1)"
+        params = (int(room_id), int(member_id))
+        result = await self.execute_statement(statement, params)
+        if result and result[0][0]:
+            return True
         return False
 
-    def is_already_owner(self, member_id):
-        statement = f"SELECT EXISTS (SELECT 1 FROM active_rooms WHERE member_id = {int(member_id)} LIMIT 1)"
-        if self.execute_statement(statement):
-            result = self.cursor.fetchall()
-            if result[0][0]:
-                return True
+    @timed
+    async def is_already_owner(self, member_id, guild_id=None):
+        if guild_id is None:
+            statement = "SELECT EXISTS (SELECT 1 FROM active_rooms WHERE member_id = ? LIMIT 1)"
+            params = (int(member_id),)
+        else:
+            statement = "SELECT EXISTS (SELECT 1 FROM active_rooms WHERE guild_id = ? AND member_id = ? LIMIT 1)"
+            params = (int(guild_id), int(member_id))
+        result = await self.execute_statement(statement, params)
+        if result and result[0][0]:
+            return True
         return False
 
-    def get_owner_room(self, member_id):
-        statement = f"SELECT room_id FROM active_rooms WHERE member_id = {int(member_id)}"
-        if self.execute_statement(statement):
-            result = self.cursor.fetchall()
-            if result:
-                return result[0][0]
+    @timed
+    async def get_owner_room(self, member_id, guild_id=None):
+        if guild_id is None:
+            statement = "SELECT room_id FROM active_rooms WHERE member_id = ?"
+            params = (int(member_id),)
+        else:
+            statement = "SELECT room_id FROM active_rooms WHERE guild_id = ? AND member_id = ?"
+            params = (int(guild_id), int(member_id))
+        result = await self.execute_statement(statement, params)
+        if result:
+            return result[0][0]
         return False
 
-    def is_open(self, room_id):
-        statement = f"SELECT is_open FROM active_rooms WHERE room_id = {int(room_id)}"
-        if self.execute_statement(statement):
-            result = self.cursor.fetchall()
-            if result and result[0][0]:
-                return True
+    @timed
+    async def is_open(self, room_id):
+        statement = "SELECT is_open FROM active_rooms WHERE room_id = ?"
+        params = (int(room_id),)
+        result = await self.execute_statement(statement, params)
+        if result and result[0][0]:
+            return True
         return False
 
     def open_room(self, room_id):
-        statement = f"UPDATE active_rooms SET is_open = 1 WHERE room_id = {int(room_id)}"
-        if self.execute_statement(statement):
-            self.conn.commit()
-            return True
-        return False
+        statement = "UPDATE active_rooms SET is_open = 1 WHERE room_id = ?"
+        params = (int(room_id),)
+        self.queue(statement, params)
     
     def close_room(self, room_id):
-        statement = f"UPDATE active_rooms SET is_open = 0 WHERE room_id = {int(room_id)}"
-        if self.execute_statement(statement):
-            self.conn.commit()
-            return True
-        return False
+        statement = "UPDATE active_rooms SET is_open = 0 WHERE room_id = ?"
+        params = (int(room_id),)
+        self.queue(statement, params)
         
     def delete_private_room(self, room_id):
-        statement = f"DELETE FROM active_rooms WHERE room_id = {int(room_id)}"
-        if self.execute_statement(statement):
-            statement = f"DELETE FROM active_invitations WHERE room_id = {int(room_id)}"
-            if self.execute_statement(statement):
-                self.conn.commit()
-                return True
-        return False
+        self.queue("DELETE FROM active_rooms WHERE room_id = ?", (int(room_id),))
+        self.queue("DELETE FROM active_invitations WHERE room_id = ?", (int(room_id),))
 
-    def transfer_ownership(self, from_id, to_id):
-        statement = f"UPDATE active_rooms SET member_id = {int(to_id)} WHERE member_id = {int(from_id)}"
-        if self.execute_statement(statement):
-            self.conn.commit()
-            return True
-        return False
\ No newline at end of file
+    def delete_private_rooms(self, room_ids):
+        # SQLite limits bound parameters per statement, larger sets are split
+        room_ids = [int(room_id) for room_id in room_ids]
+        for start in range(0, len(room_ids), 500):
+            chunk = room_ids[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            self.queue(f"DELETE FROM active_rooms WHERE room_id IN ({placeholders})", chunk)
+            self.queue(f"DELETE FROM active_invitations WHERE room_id IN ({placeholders})", chunk)
+
+    def transfer_ownership(self, room_id, to_id):
+        statement = "UPDATE active_rooms SET member_id = ? WHERE room_id = ?"
+        params = (int(to_id), int(room_id))
+        self.queue(statement, params)
+
+    def set_room_guild(self, room_id, guild_id):
+        self.queue("UPDATE active_rooms SET guild_id = ? WHERE room_id = ?", (int(guild_id), int(room_id)))
+        self.queue("UPDATE active_invitations SET guild_id = ? WHERE room_id = ?", (int(guild_id), int(room_id)))
+
+# JOIN REQUESTS
+
+    @timed
+    async def get_all_join_requests(self):
+        result = await self.execute_statement("SELECT message_id, channel_id, guild_id, requester_id, owner_id, expires_at FROM join_requests")
+        return result or []
+
+    def add_join_request(self, message_id, channel_id, guild_id, requester_id, owner_id, expires_at):
+        statement = "INSERT OR REPLACE INTO join_requests (message_id, channel_id, guild_id, requester_id, owner_id, expires_at) VALUES (?, ?, ?, ?, ?, ?)"
+        params = (int(message_id), int(channel_id), int(guild_id), int(requester_id), int(owner_id), float(expires_at))
+        self.queue(statement, params)
+
+    def delete_join_request(self, message_id):
+        self.queue("DELETE FROM join_requests WHERE message_id = ?", (int(message_id),))
+
+# INFO MESSAGES
+
+    @timed
+    async def get_info_messages(self):
+        result = await self.execute_statement("SELECT guild_id, channel_id, message_id FROM info_messages")
+        return result or []
+
+    def set_info_message(self, guild_id, channel_id, message_id):
+        statement = "INSERT OR REPLACE INTO info_messages (guild_id, channel_id, message_id) VALUES (?, ?, ?)"
+        self.queue(statement, (int(guild_id), int(channel_id), int(message_id)))
+
+# ANALYTICS
+
+    def add_room_event(self, at, guild_id, room_id, member_id, event, value=0):
+        statement = "INSERT INTO room_events (at, guild_id, room_id, member_id, event, value) VALUES (?, ?, ?, ?, ?, ?)"
+        self.queue(statement, (float(at), int(guild_id), int(room_id), int(member_id), event, float(value)))
+
+    def add_rollup(self, guild_id, period, period_start, created, deleted, timed, lifetime, joined, invitations, peak):
+        # Adds to the stored counters, peak keeps the highest value seen
+        statement = "INSERT INTO room_rollups (guild_id, period, period_start, rooms_created, rooms_deleted, timed_rooms, lifetime_seconds, members_joined, invitations, peak_rooms) \
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) \
+            ON CONFLICT (guild_id, period, period_start) DO UPDATE SET \
+            rooms_created = rooms_created + excluded.rooms_created, \
+            rooms_deleted = rooms_deleted + excluded.rooms_deleted, \
+            timed_rooms = timed_rooms + excluded.timed_rooms, \
+            lifetime_seconds = lifetime_seconds + excluded.lifetime_seconds, \
+            members_joined = members_joined + excluded.members_joined, \
+            invitations = invitations + excluded.invitations, \
+            peak_rooms = MAX(peak_rooms, excluded.peak_rooms)"
+        self.queue(statement, (int(guild_id), period, int(period_start), created, deleted, timed, lifetime, joined, invitations, peak))
+
+    @timed
+    async def get_room_created_times(self):
+        # Creation time of rooms still active, lifetimes survive restarts
+        result = await self.execute_statement("SELECT room_id, MAX(at) FROM room_events WHERE event = 'created' AND room_id IN (SELECT room_id FROM active_rooms) GROUP BY room_id")
+        return result or []
+
+    @timed
+    async def get_rollup_totals(self, guild_id, since):
+        statement = "SELECT SUM(rooms_created), SUM(rooms_deleted), SUM(timed_rooms), SUM(lifetime_seconds), SUM(members_joined), SUM(invitations), MAX(peak_rooms) \
+            FROM room_rollups WHERE guild_id = ? AND period = 'day' AND period_start >= ?"
+        result = await self.execute_statement(statement, (int(guild_id), int(since)))
+        return result[0] if result else None
+
+    @timed
+    async def get_busiest_hours(self, guild_id, since, limit=3):
+        # Hours of the day (UTC) with most rooms created
+        statement = "SELECT period_start % 86400 / 3600 AS hour, SUM(rooms_created) AS created FROM room_rollups \
+            WHERE guild_id = ? AND period = 'hour' AND period_start >= ? GROUP BY hour HAVING created > 0 ORDER BY created DESC LIMIT ?"
+        result = await self.execute_statement(statement, (int(guild_id), int(since), limit))
+        return result or []
@@ -0,0 +1,524 @@
+import asyncio
+import itertools
+import json
+import re
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web, WSMsgType
+
+from lib.Logger import *
+
+# Minimal local stand-in for Discord's gateway and REST API, good enough for discord.py to log in,
+# identify shards, receive a set of guilds and run the bot's REST calls against them.
+# Used by launcher.py to test worker processes offline and by loadtest.py to benchmark the cog.
+
+BOT_USER = {"id": "1000", "username": "Private rooms", "discriminator": "0000", "avatar": None, "bot": True}
+
+OP_DISPATCH = 0
+OP_HEARTBEAT = 1
+OP_IDENTIFY = 2
+OP_REQUEST_MEMBERS = 8
+OP_HELLO = 10
+OP_HEARTBEAT_ACK = 11
+
+INTERACTION_COMMAND = 2
+INTERACTION_COMPONENT = 3
+
+# Discord sends at most this many members per GUILD_MEMBERS_CHUNK
+CHUNK_SIZE = 1000
+
+CHANNEL_TEXT = 0
+CHANNEL_DM = 1
+CHANNEL_VOICE = 2
+CHANNEL_CATEGORY = 4
+
+TIMESTAMP = "2021-01-01T00:00:00+00:00"
+
+def json_response(data, status=200, headers=None):
+    # discord.py only decodes bodies whose content type is exactly application/json, without charset
+    return web.Response(body=json.dumps(data).encode(), status=status, headers=headers, content_type="application/json")
+
+def shard_for(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+def overwrite_payload(target_id, target_type, allow, deny):
+    # Gateway v6/v7 carry 64-bit permissions as strings in the *_new fields
+    return {"id": str(target_id), "type": target_type, "allow": int(allow) & 0xFFFFFFFF, "deny": int(deny) & 0xFFFFFFFF, "allow_new": str(allow), "deny_new": str(deny)}
+
+def route_template(path):
+    # Ids and interaction tokens are replaced so calls can be grouped the way Discord buckets them
+    path = re.sub(r"^(interactions/\d+|webhooks/\d+)/[^/]+", r"\1/{token}", path)
+    return re.sub(r"\d{5,}", "{id}", path)
+
+def major_parameter(path):
+    # Discord splits a route's bucket by channel, guild or webhook, never by the ids after it
+    match = re.match(r"^(?:channels|guilds|webhooks)/(\d+)", path)
+    return match.group(1) if match else None
+
+class FakeGuild:
+
+    def __init__(self, guild_id, channel_ids, member_count=0, room_ids=()):
+        self.id = guild_id
+        self.category_id, self.entry_room_id, self.commands_room_id, self.afk_room_id = channel_ids
+        self.member_count = member_count
+        self.room_ids = list(room_ids)
+
+        self.channels = {}
+        self.add_channel(self.category_id, CHANNEL_CATEGORY, "Private rooms", None)
+        self.add_channel(self.entry_room_id, CHANNEL_VOICE, "Create room", self.category_id)
+        self.add_channel(self.commands_room_id, CHANNEL_TEXT, "🔐info", self.category_id)
+        self.add_channel(self.afk_room_id, CHANNEL_VOICE, "AFK", None)
+        for room_id in self.room_ids:
+            self.add_channel(room_id, CHANNEL_VOICE, f"[🔐] Room {room_id}", self.category_id)
+
+        self.voice_states = {}
+
+    def add_channel(self, channel_id, channel_type, name, parent_id, overwrites=(), bitrate=64000):
+        channel = {
+            "id": str(channel_id),
+            "guild_id": str(self.id),
+            "type": channel_type,
+            "name": name,
+            "position": len(self.channels),
+            "permission_overwrites": [overwrite_payload(overwrite["id"], overwrite["type"], overwrite["allow"], overwrite["deny"]) for overwrite in overwrites],
+        }
+        if parent_id:
+            channel["parent_id"] = str(parent_id)
+        if channel_type == CHANNEL_VOICE:
+            channel.update(bitrate=bitrate, user_limit=0)
+        self.channels[channel_id] = channel
+        return channel
+
+    def member_ids(self):
+        return range(self.id + 1, self.id + 1 + self.member_count)
+
+    def has_member(self, member_id):
+        return 0 < member_id - self.id <= self.member_count
+
+    def member_payload(self, member_id):
+        return {
+            "user": {"id": str(member_id), "username": f"Member {member_id}", "discriminator": "0001", "avatar": None},
+            "roles": [],
+            "joined_at": TIMESTAMP,
+            "deaf": False,
+            "mute": False,
+        }
+
+    def member_payloads(self, start, stop):
+        for member_id in range(self.id + 1 + start, self.id + 1 + stop):
+            yield self.member_payload(member_id)
+
+    def voice_state_payload(self, member_id, channel_id, **flags):
+        payload = {
+            "guild_id": str(self.id),
+            "channel_id": str(channel_id) if channel_id else None,
+            "user_id": str(member_id),
+            "session_id": f"session-{member_id}",
+            "deaf": False,
+            "mute": False,
+            "self_deaf": False,
+            "self_mute": False,
+            "self_video": False,
+            "suppress": False,
+            "member": self.member_payload(member_id),
+        }
+        payload.update(flags)
+        return payload
+
+    def to_payload(self):
+        bot_member = {"user": BOT_USER, "roles": [], "joined_at": TIMESTAMP, "deaf": False, "mute": False}
+        return {
+            "id": str(self.id),
+            "name": f"Fake guild {self.id}",
+            "owner_id": BOT_USER["id"],
+            "unavailable": False,
+            "member_count": self.member_count + 1,
+            "large": self.member_count > 250,
+            "premium_tier": 0,
+            "roles": [{"id": str(self.id), "name": "@everyone", "permissions": "0", "position": 0}],
+            "channels": [dict(channel) for channel in self.channels.values()],
+            "members": [bot_member],
+            "voice_states": [self.voice_state_payload(member_id, channel_id) for member_id, channel_id in self.voice_states.items()],
+        }
+
+    def to_settings(self):
+        return {
+            "GUILD_ID": self.id,
+            "CATEGORY_ID": self.category_id,
+            "ENTRY_ROOM_IDS": [self.entry_room_id],
+            "COMMANDS_ROOM_ID": self.commands_room_id,
+            "AFK_ROOM_ID": self.afk_room_id,
+        }
+
+class FakeGateway:
+
+    def __init__(self, guild_count=8, member_count=0, room_count=0, latency=0, rate_limits=None, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+        # Seconds every REST call takes, roughly what a real round trip to Discord costs
+        self.latency = latency
+
+        # {(method, route template): (requests, seconds)}, going over answers with 429 like Discord does
+        self.rate_limits = rate_limits or {}
+        self.buckets = defaultdict(deque)
+
+        # Guild snowflakes step by one shard so guilds are spread over all shards
+        guild_ids = itertools.count((1 << 22) * 1000, 1 << 22)
+        self.snowflakes = itertools.count((1 << 22) * 100000, 1 << 22)
+        self.guilds = [FakeGuild(next(guild_ids), (next(self.snowflakes), next(self.snowflakes), next(self.snowflakes), next(self.snowflakes)), member_count, [next(self.snowflakes) for _ in range(room_count)]) for _ in range(guild_count)]
+
+        self.sockets = []
+        self.channel_guilds = {channel_id: guild for guild in self.guilds for channel_id in guild.channels}
+        self.dm_channels = {}
+
+        self.identified = []
+
+        # (monotonic time, method, route template, status, json body) of every REST call
+        self.requests = []
+
+        # (monotonic time, guild id, member id, channel id) of every voice state change
+        self.voice_log = []
+
+        # Interaction id -> monotonic time of its first answer (callback), deferred or not
+        self.interaction_answers = {}
+
+        # Channel id -> monotonic time it was deleted
+        self.deleted_channels = {}
+        self.registered_commands = {}
+
+        # Discord allows 50 requests per second per bot across all routes
+        self.global_limit = (50, 1)
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/gateway", self.handle_socket)
+        app.router.add_route("*", "/api/v7/{path:.*}", self.handle_rest)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+        self.port = site._server.sockets[0].getsockname()[1]
+        logger.info("Fake gateway listening on %s with %s guilds", self.url, len(self.guilds))
+
+    async def stop(self):
+        for ws, _, _ in list(self.sockets):
+            await ws.close()
+        if self.runner:
+            await self.runner.cleanup()
+
+    def get_guild(self, guild_id):
+        for guild in self.guilds:
+            if guild.id == guild_id:
+                return guild
+
+# GATEWAY
+
+    async def handle_socket(self, request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+
+        sequence = itertools.count(1)
+        session = [ws, sequence, None]
+
+        async def dispatch(event, data):
+            await ws.send_str(json.dumps({"op": OP_DISPATCH, "t": event, "s": next(sequence), "d": data}))
+
+        await ws.send_str(json.dumps({"op": OP_HELLO, "d": {"heartbeat_interval": 41250}}))
+
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                payload = json.loads(message.data)
+
+                if payload["op"] == OP_HEARTBEAT:
+                    await ws.send_str(json.dumps({"op": OP_HEARTBEAT_ACK}))
+
+                elif payload["op"] == OP_IDENTIFY:
+                    shard_id, shard_count = payload["d"].get("shard", [0, 1])
+                    guilds = [guild for guild in self.guilds if shard_for(guild.id, shard_count) == shard_id]
+                    self.identified.append((shard_id, shard_count, [guild.id for guild in guilds]))
+                    session[2] = (shard_id, shard_count)
+                    self.sockets.append(session)
+
+                    await dispatch("READY", {
+                        "v": 6,
+                        "user": BOT_USER,
+                        "guilds": [{"id": str(guild.id), "unavailable": True} for guild in guilds],
+                        "session_id": f"fake-{shard_id}",
+                        "application": {"id": BOT_USER["id"], "flags": 0},
+                        "shard": [shard_id, shard_count],
+                    })
+                    for guild in guilds:
+                        await dispatch("GUILD_CREATE", guild.to_payload())
+
+                elif payload["op"] == OP_REQUEST_MEMBERS:
+                    await self.send_members(dispatch, payload["d"])
+        finally:
+            if session in self.sockets:
+                self.sockets.remove(session)
+
+        return ws
+
+    async def send_members(self, dispatch, data):
+        guild = self.get_guild(int(data["guild_id"]))
+        user_ids = data.get("user_ids")
+
+        # Requests for specific users get just those, an empty query means the whole member list
+        if user_ids:
+            members = [guild.member_payload(int(user_id)) for user_id in user_ids if guild.has_member(int(user_id))]
+        else:
+            members = list(guild.member_payloads(0, guild.member_count))
+
+        chunk_count = max(1, -(-len(members) // CHUNK_SIZE))
+        for index in range(chunk_count):
+            await dispatch("GUILD_MEMBERS_CHUNK", {
+                "guild_id": data["guild_id"],
+                "members": members[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE],
+                "chunk_index": index,
+                "chunk_count": chunk_count,
+                "nonce": data.get("nonce"),
+            })
+
+    async def dispatch(self, guild, event, data):
+        # Events go to whichever connected shard serves the guild
+        for ws, sequence, shard in list(self.sockets):
+            if shard is not None and shard_for(guild.id, shard[1]) == shard[0] and not ws.closed:
+                await ws.send_str(json.dumps({"op": OP_DISPATCH, "t": event, "s": next(sequence), "d": data}))
+
+# SIMULATED USERS
+
+    async def join_voice(self, guild, member_id, channel_id, **flags):
+        # flags such as self_mute=True change the state without moving
+        self.voice_log.append((time.monotonic(), guild.id, member_id, channel_id))
+        if channel_id:
+            guild.voice_states[member_id] = channel_id
+        else:
+            guild.voice_states.pop(member_id, None)
+        await self.dispatch(guild, "VOICE_STATE_UPDATE", guild.voice_state_payload(member_id, channel_id, **flags))
+
+    async def send_message(self, guild, member_id, channel_id, content, mentions=()):
+        member = guild.member_payload(member_id)
+        message = self.message_payload(channel_id, content, member.pop("user"), guild)
+        message["member"] = member
+        message["mentions"] = [dict(guild.member_payload(mention)["user"], member=guild.member_payload(mention)) for mention in mentions]
+        await self.dispatch(guild, "MESSAGE_CREATE", message)
+        return message
+
+    async def interact(self, guild, member_id, name=None, options=(), custom_id=None, resolved=None):
+        # Slash command /room <name> with {option: value}, or a button press when custom_id is given
+        interaction_id = next(self.snowflakes)
+        if custom_id is not None:
+            interaction_type, data = INTERACTION_COMPONENT, {"custom_id": custom_id, "component_type": 2}
+        else:
+            options = [{"name": key, "value": str(value)} for key, value in dict(options).items()]
+            interaction_type, data = INTERACTION_COMMAND, {"name": "room", "options": [{"name": name, "type": 1, "options": options}], "resolved": resolved or {}}
+        payload = {
+            "id": str(interaction_id),
+            "application_id": BOT_USER["id"],
+            "type": interaction_type,
+            "token": f"token{interaction_id}",
+            "guild_id": str(guild.id),
+            "channel_id": str(guild.commands_room_id),
+            "member": guild.member_payload(member_id),
+            "data": data,
+            "version": 1,
+        }
+        await self.dispatch(guild, "INTERACTION_CREATE", payload)
+        return payload
+
+    def message_payload(self, channel_id, content, author, guild=None, embeds=()):
+        payload = {
+            "id": str(next(self.snowflakes)),
+            "channel_id": str(channel_id),
+            "author": author,
+            "content": content,
+            "timestamp": TIMESTAMP,
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": list(embeds),
+            "pinned": False,
+            "type": 0,
+        }
+        if guild is not None:
+            payload["guild_id"] = str(guild.id)
+        return payload
+
+# REST
+
+    def rate_limited(self, key, limit):
+        if limit is None:
+            return 0
+
+        requests, period = limit
+        history = self.buckets[key]
+        now = time.monotonic()
+        while history and now - history[0] >= period:
+            history.popleft()
+        if len(history) >= requests:
+            return period - (now - history[0])
+        history.append(now)
+        return 0
+
+    async def handle_rest(self, request):
+        path = request.match_info["path"]
+        template = route_template(path)
+        body = await request.json() if request.can_read_body and request.content_type == "application/json" else None
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        # Route buckets are per template and major parameter like Discord's, so moving
+        # different members of one guild shares a bucket. Interaction responses don't
+        # count against the global limit.
+        global_limit = None if template.startswith(("interactions/", "webhooks/")) else self.global_limit
+        route_key = (request.method, template, major_parameter(path))
+        for key, limit, is_global in (("global", global_limit, True), (route_key, self.rate_limits.get((request.method, template)), False)):
+            retry_after = self.rate_limited(key, limit)
+            if retry_after:
+                self.requests.append((time.monotonic(), request.method, template, 429, body))
+                # discord.py only trusts a 429 that came through Discord's proxy
+                return json_response({"message": "You are being rate limited.", "retry_after": retry_after * 1000, "global": is_global}, 429, {"Via": "1.1 google"})
+
+        response = await self.route(request.method, path.split("/"), body)
+        self.requests.append((time.monotonic(), request.method, template, response.status, body))
+        return response
+
+    async def route(self, method, parts, body):
+        if parts == ["users", "@me"]:
+            return json_response(BOT_USER)
+        if parts[0] == "gateway":
+            return json_response({"url": f"ws://{self.host}:{self.port}/gateway", "shards": 1, "session_start_limit": {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 1}})
+        if parts == ["users", "@me", "channels"] and method == "POST":
+            return self.create_dm(int(body["recipient_id"]))
+
+        if parts[0] == "applications" and method == "PUT" and parts[-1] == "commands":
+            self.registered_commands[int(parts[3])] = body
+            return json_response([dict(command, id=str(next(self.snowflakes)), application_id=parts[1]) for command in body])
+        if parts[0] == "interactions" and parts[-1] == "callback":
+            self.interaction_answers.setdefault(int(parts[1]), time.monotonic())
+            return web.Response(status=204)
+        if parts[0] == "webhooks" and method in ("POST", "PATCH"):
+            return json_response(self.message_payload(0, body.get("content"), BOT_USER, None, body.get("embeds", ())))
+
+        if parts[0] == "guilds" and len(parts) >= 3:
+            guild = self.get_guild(int(parts[1]))
+            if guild is None:
+                return self.not_found("Unknown Guild", 10004)
+            if parts[2] == "channels" and method == "POST":
+                return await self.create_channel(guild, body)
+            if parts[2] == "members" and len(parts) == 4:
+                member_id = int(parts[3])
+                if not guild.has_member(member_id):
+                    return self.not_found("Unknown Member", 10007)
+                if method == "PATCH":
+                    return await self.edit_member(guild, member_id, body)
+                return json_response(guild.member_payload(member_id))
+
+        if parts[0] == "channels" and len(parts) >= 2:
+            channel_id = int(parts[1])
+            if channel_id in self.dm_channels:
+                return self.dm_channel_route(method, parts, body)
+
+            guild = self.channel_guilds.get(channel_id)
+            if guild is None or channel_id not in guild.channels:
+                return self.not_found("Unknown Channel", 10003)
+            channel = guild.channels[channel_id]
+
+            if len(parts) == 2:
+                if method == "DELETE":
+                    return await self.delete_channel(guild, channel)
+                if method == "PATCH":
+                    return await self.edit_channel(guild, channel, body)
+                return json_response(channel)
+            if parts[2] == "permissions":
+                return await self.edit_permission(guild, channel, int(parts[3]), method, body)
+            if parts[2] == "messages" and method == "POST" and len(parts) == 3:
+                return json_response(self.message_payload(channel_id, body.get("content"), BOT_USER, guild, [body["embed"]] if body.get("embed") else ()))
+            if parts[2] == "messages" and method == "PATCH" and len(parts) == 4:
+                message = self.message_payload(channel_id, body.get("content"), BOT_USER, guild, [body["embed"]] if body.get("embed") else ())
+                message["id"] = parts[3]
+                return json_response(message)
+
+        if method == "GET":
+            return json_response([])
+        return web.Response(status=204)
+
+    def not_found(self, message, code):
+        return json_response({"message": message, "code": code}, 404)
+
+    def create_dm(self, recipient_id):
+        channel_id = next(self.snowflakes)
+        self.dm_channels[channel_id] = recipient_id
+        recipient = {"id": str(recipient_id), "username": f"Member {recipient_id}", "discriminator": "0001", "avatar": None}
+        return json_response({"id": str(channel_id), "type": CHANNEL_DM, "last_message_id": None, "recipients": [recipient]})
+
+    def dm_channel_route(self, method, parts, body):
+        channel_id = int(parts[1])
+        if parts[2:] == ["messages"] and method == "POST":
+            return json_response(self.message_payload(channel_id, body.get("content"), BOT_USER, None, [body["embed"]] if body.get("embed") else ()))
+        return web.Response(status=204)
+
+    async def create_channel(self, guild, body):
+        channel_id = next(self.snowflakes)
+        channel = guild.add_channel(channel_id, body["type"], body["name"], body.get("parent_id"), body.get("permission_overwrites", ()), body.get("bitrate", 64000))
+        self.channel_guilds[channel_id] = guild
+        await self.dispatch(guild, "CHANNEL_CREATE", channel)
+        return json_response(channel)
+
+    async def delete_channel(self, guild, channel):
+        channel_id = int(channel["id"])
+        del guild.channels[channel_id]
+        del self.channel_guilds[channel_id]
+        self.deleted_channels[channel_id] = time.monotonic()
+
+        # Everyone still inside gets disconnected
+        for member_id, voice_channel_id in list(guild.voice_states.items()):
+            if voice_channel_id == channel_id:
+                await self.join_voice(guild, member_id, None)
+
+        await self.dispatch(guild, "CHANNEL_DELETE", channel)
+        return json_response(channel)
+
+    async def edit_channel(self, guild, channel, body):
+        for key in ("name", "bitrate", "user_limit", "position"):
+            if key in body:
+                channel[key] = body[key]
+        if "permission_overwrites" in body:
+            channel["permission_overwrites"] = [overwrite_payload(overwrite["id"], overwrite["type"], overwrite["allow"], overwrite["deny"]) for overwrite in body["permission_overwrites"]]
+        await self.dispatch(guild, "CHANNEL_UPDATE", channel)
+        return json_response(channel)
+
+    async def edit_permission(self, guild, channel, target_id, method, body):
+        overwrites = [overwrite for overwrite in channel["permission_overwrites"] if int(overwrite["id"]) != target_id]
+        if method == "PUT":
+            overwrites.append(overwrite_payload(target_id, body["type"], body["allow"], body["deny"]))
+        channel["permission_overwrites"] = overwrites
+        await self.dispatch(guild, "CHANNEL_UPDATE", channel)
+        return web.Response(status=204)
+
+    async def edit_member(self, guild, member_id, body):
+        if "channel_id" in body:
+            channel_id = body["channel_id"] and int(body["channel_id"])
+            if channel_id and channel_id not in guild.channels:
+                return self.not_found("Unknown Channel", 10003)
+            await self.join_voice(guild, member_id, channel_id)
+        return web.Response(status=204)
+
+    def write_settings(self, path, **options):
+        data = dict(options, guilds=[guild.to_settings() for guild in self.guilds])
+        with open(path, "w", encoding="utf8") as settings:
+            json.dump(data, settings, indent=4)
@@ -0,0 +1,185 @@
+import json
+import os
+
+import discord
+
+from lib.Logger import *
+from lib.Lookup import GuildLookup
+
+SETTINGS_PATH = os.getenv("SETTINGS_PATH", "./assets/settings.json")
+
+# Options shared by the whole process
+GLOBAL_DEFAULTS = {
+    "RECONCILE_INTERVAL": 600,
+    "DB_FLUSH_INTERVAL": 2,
+    "PROFANITY_NORMALIZE": False,
+    "MEMBER_CACHE_SIZE": 1000,
+    "METRICS_HOST": "127.0.0.1",
+    "METRICS_PORT": 0,
+    "PROFILE_COMMANDS": [],
+    "VOICE_DEBOUNCE_SECONDS": 0.5,
+    "ANALYTICS": True,
+    "REPAIR_CHANNELS": True,
+}
+
+# Options every guild has, top level values act as defaults for all guilds
+GUILD_DEFAULTS = {
+    "GUILD_ID": 0,
+    "CATEGORY_ID": 0,
+    "ENTRY_ROOM_IDS": [],
+    "COMMANDS_ROOM_ID": 0,
+    "AFK_ROOM_ID": 0,
+    "DEFAULT_DELETE_TIME": 60,
+    "EMPTY_ROOM_GRACE_PERIOD": 30,
+    "POOL_ENABLED": False,
+    "POOL_MIN_SIZE": 1,
+    "POOL_MAX_SIZE": 10,
+    "LANGUAGE": "en",
+    "SLASH_COMMANDS": True,
+    "PREFIX_COMMANDS": True,
+    "MOVE_TO_AFK": True,
+}
+
+# Channel ids only make sense for the guild they belong to, they are never inherited
+GUILD_ID_KEYS = {"GUILD_ID", "CATEGORY_ID", "ENTRY_ROOM_ID", "ENTRY_ROOM_IDS", "COMMANDS_ROOM_ID", "AFK_ROOM_ID"}
+
+class GuildConfig:
+
+    def __init__(self, data, defaults=None):
+        values = dict(GUILD_DEFAULTS)
+        values.update({key: value for key, value in (defaults or {}).items() if key in GUILD_DEFAULTS and key not in GUILD_ID_KEYS})
+        values.update(data)
+
+        # Older settings only knew a single entry room
+        entry_room_ids = list(values["ENTRY_ROOM_IDS"])
+        if values.get("ENTRY_ROOM_ID"):
+            entry_room_ids.append(values["ENTRY_ROOM_ID"])
+
+        self.GUILD_ID = values["GUILD_ID"]
+        self.CATEGORY_ID = values["CATEGORY_ID"]
+        self.ENTRY_ROOM_IDS = set(entry_room_ids)
+        self.COMMANDS_ROOM_ID = values["COMMANDS_ROOM_ID"]
+        self.AFK_ROOM_ID = values["AFK_ROOM_ID"]
+        self.DEFAULT_DELETE_TIME = values["DEFAULT_DELETE_TIME"]
+        self.EMPTY_ROOM_GRACE_PERIOD = values["EMPTY_ROOM_GRACE_PERIOD"]
+        self.POOL_ENABLED = values["POOL_ENABLED"]
+        self.POOL_MIN_SIZE = values["POOL_MIN_SIZE"]
+        self.POOL_MAX_SIZE = values["POOL_MAX_SIZE"]
+        self.LANGUAGE = values["LANGUAGE"]
+        self.SLASH_COMMANDS = values["SLASH_COMMANDS"]
+        self.PREFIX_COMMANDS = values["PREFIX_COMMANDS"]
+        self.MOVE_TO_AFK = values["MOVE_TO_AFK"]
+
+        self.data = data
+
+    def to_dict(self):
+        data = dict(self.data)
+        data.pop("ENTRY_ROOM_ID", None)
+        data.update({
+            "GUILD_ID": self.GUILD_ID,
+            "CATEGORY_ID": self.CATEGORY_ID,
+            "ENTRY_ROOM_IDS": sorted(self.ENTRY_ROOM_IDS),
+            "COMMANDS_ROOM_ID": self.COMMANDS_ROOM_ID,
+            "AFK_ROOM_ID": self.AFK_ROOM_ID,
+        })
+        return data
+
+class Settings:
+
+    def __init__(self, path=SETTINGS_PATH):
+        self.path = path
+        self.options = dict(GLOBAL_DEFAULTS)
+        self.defaults = {}
+        self.guilds = {}
+
+    def load(self):
+        with open(self.path, "r", encoding="utf8") as settings:
+            data = json.load(settings)
+
+        # Flat file from single-guild versions is read as a one guild list
+        if "guilds" in data:
+            guilds = data.pop("guilds")
+        else:
+            guilds = [{key: value for key, value in data.items() if key in GUILD_DEFAULTS or key == "ENTRY_ROOM_ID"}]
+
+        self.options = dict(GLOBAL_DEFAULTS)
+        self.options.update({key: value for key, value in data.items() if key in GLOBAL_DEFAULTS})
+        self.defaults = {key: value for key, value in data.items() if key in GUILD_DEFAULTS and key not in GUILD_ID_KEYS}
+
+        self.guilds = {}
+        for guild_data in guilds:
+            config = GuildConfig(guild_data, self.defaults)
+            if config.GUILD_ID:
+                self.guilds[config.GUILD_ID] = config
+
+        return self
+
+    def add_guild(self, data):
+        config = GuildConfig(data, self.defaults)
+        self.guilds[config.GUILD_ID] = config
+        return config
+
+    def save(self):
+        data = dict(self.defaults)
+        data.update(self.options)
+        data["guilds"] = [config.to_dict() for config in self.guilds.values()]
+
+        with open(self.path, "w", encoding="utf8") as settings:
+            json.dump(data, settings, indent=4)
+
+class GuildState:
+
+    # Everything the bot knows about one configured guild, events are routed here by guild id
+
+    def __init__(self, config, member_cache_size=1000):
+        self.config = config
+        self.guild = None
+        self.category = None
+        self.entry_rooms = []
+        self.commands_room = None
+        self.afk_room = None
+
+        self.lookup = GuildLookup(max_fetched=member_cache_size)
+        self.pool = None
+        self.strings = None
+
+        # Help panel in the commands room, edited in place instead of being posted again
+        self.info_message_id = None
+
+        # Rooms waiting for grace period to pass before deletion
+        self.pending_deletions = {}
+
+        # Category's voice channels when the bot became ready, startup cleanup only looks at these
+        self.startup_room_ids = set()
+
+        # Rooms the last sweep found without a channel, a room just created may not be in the cache yet
+        self.missing_room_ids = set()
+
+    @property
+    def id(self):
+        return self.config.GUILD_ID
+
+    def bind(self, guild, created=()):
+        # created are channels made by provisioning, they may not be in the guild's cache yet
+        self.guild = guild
+        self.lookup.guild = guild
+        known = {channel.id: channel for channel in created}
+        get_channel = lambda channel_id: self.lookup.get_channel(channel_id) or known.get(channel_id)
+
+        self.category = get_channel(self.config.CATEGORY_ID)
+        self.entry_rooms = [channel for channel in map(get_channel, self.config.ENTRY_ROOM_IDS) if channel is not None]
+        self.commands_room = get_channel(self.config.COMMANDS_ROOM_ID)
+        self.afk_room = get_channel(self.config.AFK_ROOM_ID)
+
+        # Said once here, room teardown then simply skips the moves
+        if self.config.AFK_ROOM_ID and self.afk_room is None:
+            logger.warning("AFK room %s of %s doesn't exist anymore, members of deleted rooms get disconnected", self.config.AFK_ROOM_ID, guild.name)
+
+    def is_entry_room(self, channel):
+        return channel is not None and channel.id in self.config.ENTRY_ROOM_IDS
+
+    def is_private_room(self, channel):
+        return isinstance(channel, discord.VoiceChannel) \
+            and channel.category_id == self.config.CATEGORY_ID \
+            and not self.is_entry_room(channel) \
+            and (self.pool is None or channel.id not in self.pool)
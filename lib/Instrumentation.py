@@ -0,0 +1,113 @@
+import asyncio
+import cProfile
+import os
+import time
+
+import discord
+from aiohttp import web
+
+from lib.Logger import *
+from lib.Metrics import metrics, process_rss
+
+loop_lag = metrics.gauge("event_loop_lag_seconds", "How late the last event loop wakeup was")
+resident_memory = metrics.gauge("process_resident_memory_bytes", "Resident memory of the bot process")
+rest_calls = metrics.counter("discord_rest_calls_total", "REST calls made to Discord by method, route and status", ("method", "route", "status"))
+rest_latency = metrics.histogram("discord_rest_seconds", "Duration of REST calls to Discord including rate limit waits", ("method", "route"))
+
+def instrument_http(http):
+    # Wraps the client's request method, routes are the templated paths so label count stays bounded
+    if getattr(http, "instrumented", False):
+        return
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        started = time.monotonic()
+        status = "ok"
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            status = str(e.status)
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            rest_calls.labels(route.method, route.path, status).inc()
+            rest_latency.labels(route.method, route.path).observe(time.monotonic() - started)
+
+    http.request = timed_request
+    http.instrumented = True
+
+class MetricsServer:
+
+    # Serves the metrics registry as Prometheus text on a local port and samples loop lag
+
+    def __init__(self, host="127.0.0.1", port=0, lag_interval=1):
+        self.host = host
+        self.port = port
+        self.lag_interval = lag_interval
+        self.runner = None
+        self.lag_task = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+        self.lag_task = asyncio.get_event_loop().create_task(self.watch_loop_lag())
+        logger.info("SUCCESS: Metrics available on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.lag_task:
+            self.lag_task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle_metrics(self, request):
+        resident_memory.set(process_rss())
+        return web.Response(text=metrics.render(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+    async def watch_loop_lag(self):
+        while True:
+            expected = time.monotonic() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            loop_lag.set(max(0, time.monotonic() - expected))
+
+class CommandProfiler:
+
+    # Opt-in cProfile of single command invocations, stats land in one file per run.
+    # Profiling covers everything the loop runs meanwhile, so only one command is profiled at a time.
+
+    def __init__(self, commands=(), directory="profiles"):
+        self.commands = set(commands)
+        self.directory = directory
+        self.active = None
+
+    def wants(self, command_name):
+        return "*" in self.commands or command_name in self.commands
+
+    def start(self, ctx):
+        if self.active is not None or not self.wants(ctx.command.qualified_name):
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Some other profiler is already hooked in
+            return
+        self.active = (ctx, profile)
+
+    def stop(self, ctx):
+        if self.active is None or self.active[0] is not ctx:
+            return
+        _, profile = self.active
+        self.active = None
+        profile.disable()
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{ctx.command.qualified_name}-{int(time.time() * 1000)}.prof")
+        profile.dump_stats(path)
+        logger.info("Profile of !%s written to %s", ctx.command.qualified_name, path)
@@ -0,0 +1,173 @@
+import asyncio
+
+from discord.http import Route
+
+from lib.Logger import *
+
+# discord.py 1.7 has no interaction support, payloads are read from raw gateway events
+# and answered through the interaction webhook routes.
+
+INTERACTION_COMMAND = 2
+INTERACTION_COMPONENT = 3
+
+RESPONSE_MESSAGE = 4
+RESPONSE_DEFERRED_MESSAGE = 5
+
+# Response is only shown to the member who used the command, nothing lands in the commands room
+FLAG_EPHEMERAL = 64
+
+OPTION_SUB_COMMAND = 1
+OPTION_STRING = 3
+OPTION_USER = 6
+OPTION_MENTIONABLE = 9
+
+COMPONENT_ACTION_ROW = 1
+COMPONENT_BUTTON = 2
+BUTTON_SECONDARY = 2
+BUTTON_DANGER = 4
+
+# Interactions must be answered within 3 seconds, slower commands are acknowledged first
+DEFER_AFTER = 2
+
+BUTTON_PREFIX = "rooms:"
+
+def sub_command(name, description, *options):
+    return {"type": OPTION_SUB_COMMAND, "name": name, "description": description, "options": list(options)}
+
+def option(option_type, name, description):
+    return {"type": option_type, "name": name, "description": description, "required": True}
+
+def button(action, label, emoji, style=BUTTON_SECONDARY):
+    return {"type": COMPONENT_BUTTON, "style": style, "label": label, "emoji": {"name": emoji}, "custom_id": BUTTON_PREFIX + action}
+
+ROOM_COMMAND = {
+    "name": "room",
+    "description": "Manage your private room",
+    "options": [
+        sub_command("unlock", "Let anyone join your room"),
+        sub_command("lock", "Only invited members can join your room"),
+        sub_command("add", "Give a member or role access to your room", option(OPTION_MENTIONABLE, "target", "Member or role")),
+        sub_command("remove", "Revoke access of a member or role", option(OPTION_MENTIONABLE, "target", "Member or role")),
+        sub_command("rename", "Rename your room", option(OPTION_STRING, "name", "New name")),
+        sub_command("delete", "Delete your room"),
+        sub_command("transfer", "Make another member in your room its owner", option(OPTION_USER, "member", "New owner")),
+        sub_command("join", "Ask a room owner to let you in", option(OPTION_USER, "owner", "Room owner")),
+        sub_command("panel", "Show your room with its controls"),
+    ],
+}
+
+ROOM_BUTTONS = [
+    {"type": COMPONENT_ACTION_ROW, "components": [
+        button("unlock", "Unlock", "🔓"),
+        button("lock", "Lock", "🔒"),
+        button("delete", "Delete", "✖️", BUTTON_DANGER),
+    ]},
+]
+
+class InteractionRoute(Route):
+
+    # discord.py holds a lock per bucket during each request and buckets by path template,
+    # which would answer all interactions one by one. Every interaction token is its own bucket.
+
+    def __init__(self, method, path, **parameters):
+        super().__init__(method, path, **parameters)
+        self.token = parameters["token"]
+
+    @property
+    def bucket(self):
+        return f"{self.token}:{self.path}"
+
+async def register_commands(http, application_id, guild_id):
+    # Guild commands replace the whole set at once and are usable right away, unlike global ones
+    route = Route("PUT", "/applications/{application_id}/guilds/{guild_id}/commands", application_id=application_id, guild_id=guild_id)
+    return await http.request(route, json=[ROOM_COMMAND])
+
+class Interaction:
+
+    # One slash command or button press. The first answer goes through the interaction callback
+    # (or replaces the deferred placeholder), later ones are sent as ephemeral follow-ups.
+
+    def __init__(self, http, application_id, payload):
+        self.http = http
+        self.application_id = application_id
+        self.id = payload["id"]
+        self.token = payload["token"]
+        self.guild_id = int(payload.get("guild_id") or 0)
+        self.user_id = int((payload.get("member") or {}).get("user", payload.get("user", {})).get("id", 0))
+
+        data = payload.get("data") or {}
+        self.action = None
+        self.options = {}
+        self.resolved = data.get("resolved") or {}
+
+        if payload["type"] == INTERACTION_COMMAND and data.get("options"):
+            sub = data["options"][0]
+            self.action = sub["name"]
+            self.options = {option["name"]: option["value"] for option in sub.get("options", ())}
+        elif payload["type"] == INTERACTION_COMPONENT and data.get("custom_id", "").startswith(BUTTON_PREFIX):
+            self.action = data["custom_id"][len(BUTTON_PREFIX):]
+
+        self.acknowledged = False
+        self.deferred = False
+        self.answered = False
+        self.lock = asyncio.Lock()
+        self.defer_handle = None
+
+    def watch(self):
+        loop = asyncio.get_event_loop()
+        self.defer_handle = loop.call_later(DEFER_AFTER, lambda: loop.create_task(self.defer()))
+
+    def message(self, embed, components=None):
+        data = {"embeds": [embed.to_dict()], "flags": FLAG_EPHEMERAL}
+        if components:
+            data["components"] = components
+        return data
+
+    async def callback(self, response_type, data):
+        route = InteractionRoute("POST", "/interactions/{interaction_id}/{token}/callback", interaction_id=self.id, token=self.token)
+        await self.http.request(route, json={"type": response_type, "data": data})
+
+    async def defer(self):
+        async with self.lock:
+            if self.acknowledged:
+                return
+            self.acknowledged = self.deferred = True
+            await self.callback(RESPONSE_DEFERRED_MESSAGE, {"flags": FLAG_EPHEMERAL})
+
+    async def respond(self, embed, components=None):
+        async with self.lock:
+            if self.defer_handle:
+                self.defer_handle.cancel()
+
+            data = self.message(embed, components)
+            if not self.acknowledged:
+                self.acknowledged = True
+                await self.callback(RESPONSE_MESSAGE, data)
+            elif self.deferred:
+                self.deferred = False
+                route = InteractionRoute("PATCH", "/webhooks/{application_id}/{token}/messages/@original", application_id=self.application_id, token=self.token)
+                await self.http.request(route, json=data)
+            else:
+                route = InteractionRoute("POST", "/webhooks/{application_id}/{token}", application_id=self.application_id, token=self.token)
+                await self.http.request(route, json=data)
+
+    def reply(self, embed, components=None):
+        # Marks the interaction answered right away, the request itself runs in the background
+        self.answered = True
+        task = asyncio.get_event_loop().create_task(self.respond(embed, components))
+        task.add_done_callback(self.log_failure)
+        return task
+
+    def log_failure(self, task):
+        if not task.cancelled() and task.exception():
+            logger.debug("FAILED: Couldn't answer interaction %s - %s", self.id, task.exception())
+
+class InteractionContext:
+
+    # Stands in for commands.Context, so command callbacks run unchanged for interactions
+
+    def __init__(self, interaction, guild, author):
+        self.interaction = interaction
+        self.guild = guild
+        self.author = author
+        self.message = None
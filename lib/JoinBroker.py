@@ -0,0 +1,135 @@
+import asyncio
+import math
+import time
+
+from lib.Logger import *
+from lib.Metrics import metrics
+
+ACCEPT_EMOJI = "👍"
+DENY_EMOJI = "👎"
+
+pending_requests = metrics.gauge("join_requests_pending", "Join requests waiting for the room owner's answer")
+resolved_requests = metrics.counter("join_requests_total", "Join requests by how they ended", ("outcome",))
+
+class JoinRequest:
+
+    __slots__ = ("message_id", "channel_id", "guild_id", "requester_id", "owner_id", "expires_at")
+
+    def __init__(self, message_id, channel_id, guild_id, requester_id, owner_id, expires_at):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.requester_id = requester_id
+        self.owner_id = owner_id
+        self.expires_at = expires_at
+
+class JoinBroker:
+
+    # Pending join requests keyed by the id of the message the owner reacts to, so a reaction costs
+    # one dict lookup no matter how many requests are open. Expiry runs on a single timer wheel
+    # and requests are stored in the database to outlive restarts.
+
+    def __init__(self, db, on_answer, on_expire, timeout=120, resolution=1, max_per_member=5):
+        self.db = db
+        self.on_answer = on_answer
+        self.on_expire = on_expire
+        self.timeout = timeout
+        self.resolution = resolution
+        self.max_per_member = max_per_member
+
+        self.requests = {}
+        self.pairs = {}
+        self.per_member = {}
+
+        # Every slot holds message ids due in that tick, resolved requests are skipped lazily
+        self.wheel = [[] for _ in range(math.ceil(timeout / resolution) + 1)]
+        self.position = 0
+        self.tick_task = None
+
+    async def restore(self, owns_guild=None):
+        now = time.time()
+        for row in await self.db.get_all_join_requests():
+            request = JoinRequest(*row)
+            if owns_guild is not None and not owns_guild(request.guild_id):
+                continue
+            self.track(request)
+            if request.expires_at <= now:
+                self.expire(request)
+        pending_requests.set(len(self.requests))
+        logger.info("SUCCESS: Restored %s pending join requests", len(self.requests))
+
+    def start(self):
+        if self.tick_task is None or self.tick_task.done():
+            self.tick_task = asyncio.get_event_loop().create_task(self.run())
+
+    def stop(self):
+        if self.tick_task:
+            self.tick_task.cancel()
+
+    def is_pending(self, requester_id, owner_id):
+        return (requester_id, owner_id) in self.pairs
+
+    def can_request(self, requester_id):
+        return self.per_member.get(requester_id, 0) < self.max_per_member
+
+    def add(self, message_id, channel_id, guild_id, requester_id, owner_id):
+        request = JoinRequest(message_id, channel_id, guild_id, requester_id, owner_id, time.time() + self.timeout)
+        self.track(request)
+        self.db.add_join_request(request.message_id, request.channel_id, request.guild_id, request.requester_id, request.owner_id, request.expires_at)
+        return request
+
+    def track(self, request):
+        self.requests[request.message_id] = request
+        self.pairs[(request.requester_id, request.owner_id)] = request.message_id
+        self.per_member[request.requester_id] = self.per_member.get(request.requester_id, 0) + 1
+
+        ticks = max(1, math.ceil((request.expires_at - time.time()) / self.resolution))
+        self.wheel[(self.position + min(ticks, len(self.wheel) - 1)) % len(self.wheel)].append(request.message_id)
+        pending_requests.set(len(self.requests))
+
+    def pop(self, message_id):
+        request = self.requests.pop(message_id, None)
+        if request is None:
+            return None
+
+        self.pairs.pop((request.requester_id, request.owner_id), None)
+        self.per_member[request.requester_id] -= 1
+        if not self.per_member[request.requester_id]:
+            del self.per_member[request.requester_id]
+
+        self.db.delete_join_request(message_id)
+        pending_requests.set(len(self.requests))
+        return request
+
+    def handle_reaction(self, message_id, user_id, emoji):
+        request = self.requests.get(message_id)
+        if request is None or user_id != request.owner_id or emoji not in (ACCEPT_EMOJI, DENY_EMOJI):
+            return None
+
+        self.pop(message_id)
+        accepted = emoji == ACCEPT_EMOJI
+        resolved_requests.labels("accepted" if accepted else "denied").inc()
+        return asyncio.get_event_loop().create_task(self.on_answer(request, accepted))
+
+    def expire(self, request):
+        self.pop(request.message_id)
+        resolved_requests.labels("expired").inc()
+        asyncio.get_event_loop().create_task(self.on_expire(request))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.resolution)
+
+            self.position = (self.position + 1) % len(self.wheel)
+            due, self.wheel[self.position] = self.wheel[self.position], []
+
+            now = time.time()
+            for message_id in due:
+                request = self.requests.get(message_id)
+                if request is None:
+                    continue
+                # Clock drift can leave a request a tick short, give it another round
+                if request.expires_at > now:
+                    self.wheel[(self.position + 1) % len(self.wheel)].append(message_id)
+                    continue
+                self.expire(request)
@@ -1,21 +1,92 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+
+from dotenv import load_dotenv
+
+# Logging is configured from environment (or .env), nothing has to be edited in code:
+#   LOG_LEVEL         minimum level written anywhere (INFO)
+#   LOG_FILE          file to write into, empty disables file output (log.log)
+#   LOG_FORMAT        "text" or "json" for one JSON object per line (text)
+#   LOG_MAX_BYTES     rotate file once it grows this big (5 MB)
+#   LOG_ROTATE_WHEN   rotate by time instead, e.g. "midnight" or "h"
+#   LOG_BACKUP_COUNT  rotated files kept (5)
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "log.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 5 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+
+__all__ = ["logger", "fields"]
+
+# Context fields passed as extra=fields(...), written as their own keys in JSON output
+FIELDS = ("guild", "room", "member")
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "file": record.filename,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    # Stock prepare formats the message on the caller's thread and drops exc_info on the way,
+    # the record is passed on untouched so the listener's formatters do all of that
+
+    def prepare(self, record):
+        return record
+
+def fields(guild=None, room=None, member=None):
+    # Accepts discord objects or plain ids
+    values = {"guild": guild, "room": room, "member": member}
+    return {key: getattr(value, "id", value) for key, value in values.items() if value is not None}
+
+def create_handlers():
+    text_formatter = logging.Formatter('%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s', datefmt='%d-%m-%y %H:%M:%S')
+
+    c_handler = logging.StreamHandler()
+    c_handler.setFormatter(text_formatter)
+    handlers = [c_handler]
+
+    if LOG_FILE:
+        if LOG_ROTATE_WHEN:
+            f_handler = logging.handlers.TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+        else:
+            f_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+        f_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else text_formatter)
+        handlers.append(f_handler)
+
+    return handlers
 
 #create logger
 logger = logging.getLogger('logger')
-logger.setLevel(logging.INFO)
-
-# Create handlers
-c_handler = logging.StreamHandler()
-f_handler = logging.FileHandler('log.log', 'w', 'utf-8')
-c_handler.setLevel(logging.DEBUG)
-f_handler.setLevel(logging.DEBUG)
-
-#create log formatter
-c_formatter = logging.Formatter('%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s', datefmt='%d-%m-%y %H:%M:%S')
-f_formatter = logging.Formatter('%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s', datefmt='%d-%m-%y %H:%M:%S')
-c_handler.setFormatter(c_formatter)
-f_handler.setFormatter(f_formatter)
-
-# Add handlers to the logger
-logger.addHandler(c_handler)
-logger.addHandler(f_handler)
\ No newline at end of file
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+# Event loop only puts records on a queue, formatting and disk writes happen on the listener thread
+log_queue = queue.SimpleQueue()
+listener = logging.handlers.QueueListener(log_queue, *create_handlers(), respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+logger.addHandler(DeferredQueueHandler(log_queue))
@@ -0,0 +1,108 @@
+import asyncio
+from collections import OrderedDict
+
+import discord
+
+from lib.Logger import *
+
+# Discord answers at most this many ids per member request
+MEMBER_QUERY_LIMIT = 100
+
+# Members still unknown after the gateway query are fetched one REST call each, at most this many per lookup
+MEMBER_FETCH_LIMIT = 5
+
+class GuildLookup:
+
+    # Resolves members and channels by id through the guild's own hash maps,
+    # members missing from the gateway cache are fetched once and kept in a bounded LRU.
+    # Members Discord answered 404 for, or who left, are remembered as gone, a failed lookup alone doesn't say that.
+
+    def __init__(self, guild=None, max_fetched=1000):
+        self.guild = guild
+        self.max_fetched = max_fetched
+        self.fetched = OrderedDict()
+        self.gone = OrderedDict()
+
+    def get_channel(self, channel_id):
+        if channel_id is None:
+            return None
+        return self.guild.get_channel(channel_id)
+
+    def get_member(self, member_id):
+        member = self.guild.get_member(member_id)
+        if member is not None:
+            return member
+
+        member = self.fetched.get(member_id)
+        if member is not None:
+            self.fetched.move_to_end(member_id)
+        return member
+
+    async def fetch_member(self, member_id):
+        if member_id is None:
+            return None
+
+        member = self.get_member(member_id)
+        if member is not None:
+            return member
+
+        try:
+            member = await self.guild.fetch_member(member_id)
+        except discord.NotFound:
+            self.forget(member_id)
+            return None
+        except discord.HTTPException:
+            logger.debug("FAILED: Couldn't fetch member %s", member_id)
+            return None
+
+        self.remember(member)
+        return member
+
+    async def fetch_members(self, member_ids):
+        members = []
+        missing = []
+        for member_id in list(member_ids):
+            member = self.get_member(member_id)
+            if member is not None:
+                members.append(member)
+            else:
+                missing.append(member_id)
+
+        # Several unknown members are asked for in one gateway request instead of one REST call each
+        if len(missing) > 1:
+            for start in range(0, len(missing), MEMBER_QUERY_LIMIT):
+                try:
+                    queried = await self.guild.query_members(user_ids=missing[start:start + MEMBER_QUERY_LIMIT], cache=False)
+                except (asyncio.TimeoutError, discord.ClientException) as e:
+                    logger.debug("FAILED: Couldn't query members - %s", e)
+                    break
+                for member in queried:
+                    self.remember(member)
+            members.extend(member for member in map(self.get_member, missing) if member is not None)
+            missing = [member_id for member_id in missing if self.get_member(member_id) is None]
+
+        # Whatever is left costs one REST call each, capped so a timed out query can't turn one command into
+        # hundreds of calls. The rest stays unresolved this time.
+        for member_id in missing[:MEMBER_FETCH_LIMIT]:
+            member = await self.fetch_member(member_id)
+            if member is not None:
+                members.append(member)
+        return members
+
+    def remember(self, member):
+        self.gone.pop(member.id, None)
+        self.fetched[member.id] = member
+        self.fetched.move_to_end(member.id)
+        while len(self.fetched) > self.max_fetched:
+            self.fetched.popitem(last=False)
+
+    def forget(self, member_id):
+        # Member left the guild or doesn't exist
+        self.fetched.pop(member_id, None)
+        self.gone[member_id] = True
+        self.gone.move_to_end(member_id)
+        while len(self.gone) > self.max_fetched:
+            self.gone.popitem(last=False)
+
+    def is_gone(self, member_id):
+        return member_id in self.gone
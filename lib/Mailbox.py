@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import deque
+
+from lib.Logger import *
+from lib.Metrics import metrics
+
+mailboxes_active = metrics.gauge("mailboxes_active", "Rooms and members with operations queued or running")
+mailbox_wait = metrics.histogram("mailbox_wait_seconds", "Time operations waited for earlier operations on the same room", ("operation",))
+mailbox_contended = metrics.counter("mailbox_contended_total", "Operations that had to wait behind another operation on the same room", ("operation",))
+mailbox_collapsed = metrics.counter("mailbox_collapsed_total", "Queued operations replaced by a newer one with the same collapse key", ("operation",))
+
+class Operation:
+
+    __slots__ = ("name", "factory", "collapse", "discard", "future", "enqueued_at")
+
+class Mailbox:
+
+    __slots__ = ("key", "queue", "collapsible", "task")
+
+    def __init__(self, key):
+        self.key = key
+        self.queue = deque()
+        # Collapse key -> operation still waiting in queue
+        self.collapsible = {}
+        self.task = None
+
+class Mailboxes:
+
+    # One FIFO worker per key (room or member), operations on one key run one at a time and in order,
+    # different keys run side by side. Workers only exist while their key has work.
+
+    def __init__(self):
+        self.mailboxes = {}
+
+    def __contains__(self, key):
+        return key in self.mailboxes
+
+    def submit(self, key, name, factory, collapse=None, discard=None):
+        # factory returns the coroutine to run. A queued operation with the same collapse key takes over
+        # the newer factory instead, both callers get its result and discard of the replaced one is called.
+        mailbox = self.mailboxes.get(key)
+        if mailbox is None:
+            mailbox = self.mailboxes[key] = Mailbox(key)
+            mailboxes_active.set(len(self.mailboxes))
+
+        if collapse is not None:
+            operation = mailbox.collapsible.get(collapse)
+            if operation is not None:
+                replaced = operation.discard
+                operation.name = name
+                operation.factory = factory
+                operation.discard = discard
+                mailbox_collapsed.labels(name).inc()
+                if replaced is not None:
+                    replaced()
+                return operation.future
+
+        operation = Operation()
+        operation.name = name
+        operation.factory = factory
+        operation.collapse = collapse
+        operation.discard = discard
+        operation.future = asyncio.get_event_loop().create_future()
+        operation.enqueued_at = time.monotonic()
+
+        if mailbox.task is not None:
+            mailbox_contended.labels(name).inc()
+        if collapse is not None:
+            mailbox.collapsible[collapse] = operation
+        mailbox.queue.append(operation)
+
+        if mailbox.task is None:
+            mailbox.task = asyncio.get_event_loop().create_task(self.run(mailbox))
+        return operation.future
+
+    async def call(self, key, name, factory, collapse=None, discard=None):
+        return await self.submit(key, name, factory, collapse, discard)
+
+    async def run(self, mailbox):
+        try:
+            while mailbox.queue:
+                operation = mailbox.queue.popleft()
+                if operation.collapse is not None and mailbox.collapsible.get(operation.collapse) is operation:
+                    del mailbox.collapsible[operation.collapse]
+
+                mailbox_wait.labels(operation.name).observe(time.monotonic() - operation.enqueued_at)
+
+                try:
+                    result = await operation.factory()
+                except asyncio.CancelledError:
+                    operation.future.cancel()
+                    raise
+                except Exception as e:
+                    if not operation.future.done():
+                        operation.future.set_exception(e)
+                else:
+                    if not operation.future.done():
+                        operation.future.set_result(result)
+        finally:
+            # Anything left behind after cancellation never runs
+            for operation in mailbox.queue:
+                operation.future.cancel()
+            if self.mailboxes.get(mailbox.key) is mailbox:
+                del self.mailboxes[mailbox.key]
+            mailboxes_active.set(len(self.mailboxes))
+
+    def stop(self):
+        for mailbox in list(self.mailboxes.values()):
+            if mailbox.task is not None:
+                mailbox.task.cancel()
@@ -0,0 +1,174 @@
+import bisect
+import os
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class CounterValue:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class GaugeValue:
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class HistogramValue:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested fraction of observations
+        if not self.count:
+            return 0
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name, description, labelnames=(), **options):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.options = options
+        self.children = {}
+
+    def create_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.create_value()
+        return child
+
+    def samples(self):
+        for key, child in self.children.items():
+            yield self.name, format_labels(self.labelnames, key), child.value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+    def __getattr__(self, name):
+        # Metrics without labels proxy straight to their single value
+        if name in ("inc", "dec", "set", "observe", "value", "sum", "count", "percentile"):
+            return getattr(self.labels(), name)
+        raise AttributeError(name)
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def create_value(self):
+        return CounterValue()
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def create_value(self):
+        return GaugeValue()
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def create_value(self):
+        return HistogramValue(self.options.get("buckets", DEFAULT_BUCKETS))
+
+    def samples(self):
+        for key, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(list(child.buckets) + [float("inf")], child.counts):
+                cumulative += count
+                yield f"{self.name}_bucket", format_labels(self.labelnames, key, [("le", format_value(bound))]), cumulative
+            yield f"{self.name}_sum", format_labels(self.labelnames, key), child.sum
+            yield f"{self.name}_count", format_labels(self.labelnames, key), child.count
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def get_or_create(self, cls, name, description, labelnames=(), **options):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, description, labelnames, **options)
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self.get_or_create(Counter, name, description, labelnames)
+
+    def gauge(self, name, description, labelnames=()):
+        return self.get_or_create(Gauge, name, description, labelnames)
+
+    def histogram(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.get_or_create(Histogram, name, description, labelnames, buckets=buckets)
+
+    def render(self):
+        # Prometheus text exposition format
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+metrics = Registry()
+
+def process_rss():
+    # Resident memory in bytes, /proc is exact on Linux, elsewhere fall back to the peak
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
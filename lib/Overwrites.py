@@ -0,0 +1,68 @@
+import discord
+
+from lib.Logger import *
+
+def build_overwrites(default_role, owner, is_open, invited_members=(), denied_members=()):
+    # Desired permission overwrites of a private room, derived only from room state
+    overwrites = {
+        default_role : discord.PermissionOverwrite(connect=is_open),
+    }
+
+    for invited_member in invited_members:
+        overwrites[invited_member] = discord.PermissionOverwrite(connect=True)
+
+    for denied_member in denied_members:
+        overwrites[denied_member] = discord.PermissionOverwrite(connect=False)
+
+    if owner is not None:
+        overwrites[owner] = discord.PermissionOverwrite(connect=True)
+
+    return overwrites
+
+def current_overwrites(channel):
+    # Raw overwrites by target id. channel.overwrites leaves out members missing from the cache,
+    # in lean mode that is nearly everyone invited, and every diff would turn into a full edit.
+    return {overwrite.id: discord.PermissionOverwrite.from_pair(discord.Permissions(overwrite.allow), discord.Permissions(overwrite.deny)) for overwrite in channel._overwrites}
+
+def diff_overwrites(current, desired):
+    # current maps target ids to overwrites, returns changed targets and ids of overwrites that have to be removed
+    changes = {}
+    for target, overwrite in desired.items():
+        if current.get(target.id) != overwrite:
+            changes[target] = overwrite
+
+    desired_ids = {target.id for target in desired}
+    removed = [target_id for target_id in current if target_id not in desired_ids]
+
+    return changes, removed
+
+async def apply_overwrites(channel, desired, keep=()):
+    # Pushes only what changed, returns number of API calls made.
+    # Members in keep couldn't be resolved right now, whatever overwrite they have stays as it is.
+    current = current_overwrites(channel)
+    desired = dict(desired)
+    for target_id in keep:
+        if target_id in current:
+            desired[discord.Object(target_id)] = current[target_id]
+
+    changes, removed = diff_overwrites(current, desired)
+
+    if not changes and not removed:
+        return 0
+
+    # Single target can be patched on its own, anything more is cheaper as one full edit.
+    # Removing needs to know whether the target is a member or a role, an uncached one goes with a full edit.
+    target = None
+    if len(changes) + len(removed) == 1:
+        if changes:
+            target, overwrite = next(iter(changes.items()))
+        else:
+            target, overwrite = channel.guild.get_role(removed[0]) or channel.guild.get_member(removed[0]), None
+
+    if target is not None:
+        await channel.set_permissions(target, overwrite=overwrite)
+    else:
+        await channel.edit(overwrites=desired)
+
+    logger.debug("Applied %s overwrite changes to %s", len(changes) + len(removed), channel.name)
+    return 1
@@ -0,0 +1,117 @@
+import os
+import re
+import time
+import unicodedata
+
+from lib.Logger import *
+
+LEETSPEAK = str.maketrans({
+    "0": "o",
+    "1": "i",
+    "3": "e",
+    "4": "a",
+    "5": "s",
+    "7": "t",
+    "@": "a",
+    "$": "s",
+    "!": "i",
+})
+
+def normalize_text(text):
+    # Strip accents and fold look-alike characters (é -> e, ｆ -> f, 4 -> a)
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return text.casefold().translate(LEETSPEAK)
+
+class ProfanityFilter:
+
+    def __init__(self, path="./assets/bad_words.txt", normalize=False, reload_interval=30):
+        self.path = path
+        self.normalize = normalize
+        self.reload_interval = reload_interval
+
+        self.pattern = None
+        self.normalized_pattern = None
+        self.normalized_words = {}
+
+        self.mtime = None
+        self.last_check = 0
+
+        self.load()
+
+    def compile(self, words):
+        # Words are folded into a prefix trie first, so the regex engine shares work across
+        # common prefixes instead of trying 1000+ alternatives at every position
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[""] = True
+        return re.compile(self.trie_pattern(trie))
+
+    def trie_pattern(self, node):
+        # Optional groups are greedy, so the longest term along a branch is the one reported
+        branches = [re.escape(char) + self.trie_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            pattern = "(?:" + pattern + ")?"
+        return pattern
+
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+
+            with open(self.path, "r") as file:
+                words = {line.strip().lower() for line in file}
+            words.discard("")
+
+        except OSError:
+            logger.error("FAILED: Couldn't load profanity list %s", self.path)
+            return False
+
+        self.normalized_words = {normalize_text(word): word for word in words}
+        if words:
+            self.pattern = self.compile(words)
+            self.normalized_pattern = self.compile(self.normalized_words)
+        else:
+            self.pattern = self.normalized_pattern = None
+
+        self.mtime = mtime
+        self.last_check = time.monotonic()
+
+        logger.info("SUCCESS: Loaded %s words into profanity filter", len(words))
+        return True
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self.last_check < self.reload_interval:
+            return
+        self.last_check = now
+
+        try:
+            if os.stat(self.path).st_mtime != self.mtime:
+                self.load()
+        except OSError:
+            pass
+
+    def match(self, text):
+        # Returns the offending term from the list, or None when text is clean
+        self.reload_if_changed()
+
+        if self.pattern is None:
+            return None
+
+        found = self.pattern.search(text.lower())
+        if found:
+            return found.group(0)
+
+        if self.normalize:
+            found = self.normalized_pattern.search(normalize_text(text))
+            if found:
+                return self.normalized_words[found.group(0)]
+
+        return None
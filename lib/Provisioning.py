@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+
+import discord
+
+from lib.Logger import *
+from lib.Guilds import Settings
+
+CATEGORY_NAME = "Private rooms"
+COMMANDS_ROOM_NAME = "🔐info"
+ENTRY_ROOM_NAME = "Create room"
+SETUP_REASON = "Private rooms setup"
+
+def parse_guild_ids(value):
+    # GUILD_ID in .env may list several guilds, separated by commas
+    return [int(guild_id) for guild_id in (value or "").replace(" ", "").split(",") if guild_id]
+
+def check_channels(guild, data):
+    # Looks up every configured channel once, returns the ones found and labels of what's missing
+    channels = {channel.id: channel for channel in guild.channels}
+
+    def find(channel_id, channel_type):
+        channel = channels.get(channel_id)
+        return channel if isinstance(channel, channel_type) else None
+
+    entry_room_ids = list(data.get("ENTRY_ROOM_IDS", ()))
+    if data.get("ENTRY_ROOM_ID"):
+        entry_room_ids.append(data["ENTRY_ROOM_ID"])
+
+    found = {
+        "category": find(data.get("CATEGORY_ID"), discord.CategoryChannel),
+        "commands_room": find(data.get("COMMANDS_ROOM_ID"), discord.TextChannel),
+        "entry_rooms": [channel for channel in (find(channel_id, discord.VoiceChannel) for channel_id in entry_room_ids) if channel],
+        "afk_room": find(data.get("AFK_ROOM_ID"), discord.VoiceChannel),
+    }
+
+    missing = [label for label, key in (("category", "category"), ("commands room", "commands_room")) if found[key] is None]
+    missing.extend(f"entry room {channel_id}" for channel_id in entry_room_ids if find(channel_id, discord.VoiceChannel) is None)
+    if not found["entry_rooms"] and not entry_room_ids:
+        missing.append("entry room")
+    if data.get("AFK_ROOM_ID") and found["afk_room"] is None:
+        missing.append("AFK room")
+    return found, missing
+
+async def provision_guild(guild, data):
+    # Creates whatever is missing and returns the repaired settings with the channels it created.
+    # The category goes first since the others live in it, commands and entry room are then created side by side.
+    data = dict(data, GUILD_ID=guild.id)
+    found, missing = check_channels(guild, data)
+    if not missing:
+        return data, []
+
+    created = []
+    category = found["category"]
+    if category is None:
+        category = await guild.create_category(CATEGORY_NAME, reason=SETUP_REASON)
+        created.append(category)
+
+    pending = {}
+    if found["commands_room"] is None:
+        pending["commands_room"] = guild.create_text_channel(COMMANDS_ROOM_NAME, category=category, reason=SETUP_REASON)
+    if not found["entry_rooms"]:
+        pending["entry_room"] = guild.create_voice_channel(ENTRY_ROOM_NAME, category=category, reason=SETUP_REASON)
+    channels = dict(zip(pending, await asyncio.gather(*pending.values())))
+    created.extend(channels.values())
+
+    afk_room = found["afk_room"] or guild.afk_channel
+
+    data.pop("ENTRY_ROOM_ID", None)
+    data.update({
+        "CATEGORY_ID": category.id,
+        "COMMANDS_ROOM_ID": (channels.get("commands_room") or found["commands_room"]).id,
+        "ENTRY_ROOM_IDS": [channels["entry_room"].id] if "entry_room" in channels else [channel.id for channel in found["entry_rooms"]],
+        "AFK_ROOM_ID": afk_room.id if afk_room else 0,
+    })
+    return data, created
+
+async def provision_guilds(settings, client, guild_ids, repair=True):
+    # Sets up guilds without settings and repairs configured ones, all guilds side by side.
+    # Changes are saved once, returns the channels created per guild id.
+    async def provision(guild_id):
+        guild = client.get_guild(guild_id)
+        if guild is None:
+            logger.error("FAILED: Bot is not a member of guild %s", guild_id)
+            return None
+
+        config = settings.guilds.get(guild_id)
+        data = config.to_dict() if config else {}
+        _, missing = check_channels(guild, data)
+        if not missing:
+            return None
+
+        if not repair:
+            logger.warning("Guild %s is missing %s", guild.name, ", ".join(missing), extra=fields(guild))
+            return None
+
+        try:
+            data, created = await provision_guild(guild, data)
+        except discord.HTTPException as e:
+            logger.error("FAILED: Couldn't create channels in %s, check the bot's permissions - %s", guild.name, e, extra=fields(guild))
+            return None
+
+        settings.add_guild(data)
+        logger.info("SUCCESS: %s %s, created %s", "Repaired" if config else "Set up", guild.name, ", ".join(channel.name for channel in created) or "nothing", extra=fields(guild))
+        return created
+
+    results = await asyncio.gather(*(provision(guild_id) for guild_id in guild_ids))
+    changed = {guild_id for guild_id, created in zip(guild_ids, results) if created is not None}
+    if changed:
+        # Workers of other shards may have saved their guilds meanwhile, keep those
+        try:
+            stored = Settings(settings.path).load().guilds
+        except (OSError, ValueError):
+            stored = {}
+        for guild_id, config in stored.items():
+            if guild_id not in changed:
+                settings.guilds[guild_id] = config
+        settings.save()
+    return {guild_id: created for guild_id, created in zip(guild_ids, results) if created}
+
+class SetupClient(discord.Client):
+
+    # Connects just long enough to provision, for `python bot.py setup`
+
+    def __init__(self, settings, guild_ids, repair, **options):
+        super().__init__(**options)
+        self.settings = settings
+        self.guild_ids = guild_ids
+        self.repair = repair
+
+    async def on_ready(self):
+        try:
+            guild_ids = self.guild_ids or list(self.settings.guilds)
+            await provision_guilds(self.settings, self, guild_ids, self.repair)
+            logger.info("SUCCESS: Checked %s guilds", len(guild_ids))
+        finally:
+            await self.close()
+
+def setup(argv, token):
+    parser = argparse.ArgumentParser(prog="bot.py setup", description="Create or repair the channels of the bot and save them into settings")
+    parser.add_argument("guild_ids", nargs="*", type=int, help="guilds to set up, all configured guilds by default")
+    parser.add_argument("--check", action="store_true", help="only report missing channels, change nothing")
+    args = parser.parse_args(argv)
+
+    settings = Settings()
+    try:
+        settings.load()
+    except FileNotFoundError:
+        logger.info("No settings file yet, creating %s", settings.path)
+
+    if not args.guild_ids and not settings.guilds:
+        parser.error("no guild configured yet, pass its ID")
+
+    client = SetupClient(settings, args.guild_ids, not args.check, intents=discord.Intents.default())
+    client.run(token)
@@ -0,0 +1,181 @@
+import asyncio
+
+from lib.Logger import *
+from lib.Metrics import metrics
+
+active_rooms = metrics.gauge("active_rooms", "Private rooms currently tracked")
+
+class Room:
+
+    __slots__ = ("guild_id", "room_id", "owner_id", "is_open", "invited")
+
+    def __init__(self, guild_id, room_id, owner_id, is_open=False):
+        self.guild_id = guild_id
+        self.room_id = room_id
+        self.owner_id = owner_id
+        self.is_open = is_open
+        # Ids of invited members and roles, snowflakes never collide
+        self.invited = set()
+
+class RoomCache:
+
+    # Authoritative in-memory copy of active rooms, database is only written behind it.
+    # Room ids are unique across Discord, owners are keyed by (guild_id, member_id)
+
+    def __init__(self, db):
+        self.db = db
+        self.rooms = {}
+        self.owners = {}
+
+    async def warm(self, owns_guild=None):
+        # Sharded workers only load rooms of guilds they serve, the rest belongs to other processes
+        self.rooms.clear()
+        self.owners.clear()
+
+        for guild_id, room_id, member_id, is_open in await self.db.get_all_rooms():
+            if owns_guild is not None and not owns_guild(guild_id):
+                continue
+            self.rooms[room_id] = Room(guild_id, room_id, member_id, bool(is_open))
+            self.owners[(guild_id, member_id)] = room_id
+
+        for room_id, member_id in await self.db.get_all_invitations():
+            room = self.rooms.get(room_id)
+            if room:
+                room.invited.add(member_id)
+
+        active_rooms.set(len(self.rooms))
+        logger.info("SUCCESS: Loaded %s active rooms", len(self.rooms))
+
+    async def write_behind(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.db.flush()
+
+# LOOKUPS
+
+    def is_room_private(self, room_id):
+        return room_id in self.rooms
+
+    def is_owner(self, room_id, member_id):
+        room = self.rooms.get(room_id)
+        return room is not None and room.owner_id == member_id
+
+    def is_already_owner(self, guild_id, member_id):
+        return (guild_id, member_id) in self.owners
+
+    def get_room_owner(self, room_id):
+        room = self.rooms.get(room_id)
+        return room.owner_id if room else None
+
+    def get_owner_room(self, guild_id, member_id):
+        return self.owners.get((guild_id, member_id), False)
+
+    def get_guild_rooms(self, guild_id):
+        return [room for room in self.rooms.values() if room.guild_id == guild_id]
+
+    def is_open(self, room_id):
+        room = self.rooms.get(room_id)
+        return room is not None and room.is_open
+
+    def get_all_invited_members(self, room_id):
+        room = self.rooms.get(room_id)
+        return room.invited if room else set()
+
+    def is_member_invited(self, room_id, member_id):
+        room = self.rooms.get(room_id)
+        return room is not None and member_id in room.invited
+
+# MUTATIONS
+
+    def add_private_room(self, guild_id, room_id, member_id):
+        self.rooms[room_id] = Room(guild_id, room_id, member_id)
+        self.owners[(guild_id, member_id)] = room_id
+        active_rooms.set(len(self.rooms))
+        self.db.add_private_room(room_id, member_id, guild_id)
+
+    def delete_private_room(self, room_id):
+        room = self.rooms.pop(room_id, None)
+        if room is None:
+            return
+        if self.owners.get((room.guild_id, room.owner_id)) == room_id:
+            del self.owners[(room.guild_id, room.owner_id)]
+        active_rooms.set(len(self.rooms))
+        self.db.delete_private_room(room_id)
+
+    def delete_private_rooms(self, room_ids):
+        room_ids = [room_id for room_id in room_ids if room_id in self.rooms]
+        for room_id in room_ids:
+            self.evict(room_id)
+        if room_ids:
+            self.db.delete_private_rooms(room_ids)
+
+    def evict(self, room_id):
+        # Drops a room from memory only, its rows stay for whichever process owns it
+        room = self.rooms.pop(room_id, None)
+        if room and self.owners.get((room.guild_id, room.owner_id)) == room_id:
+            del self.owners[(room.guild_id, room.owner_id)]
+        active_rooms.set(len(self.rooms))
+
+    def assign_guild(self, room_id, guild_id):
+        # Rows written before guilds were tracked are stored with guild 0
+        room = self.rooms.get(room_id)
+        if room is None or room.guild_id == guild_id:
+            return
+        if self.owners.get((room.guild_id, room.owner_id)) == room_id:
+            del self.owners[(room.guild_id, room.owner_id)]
+        room.guild_id = guild_id
+        self.owners[(guild_id, room.owner_id)] = room_id
+        self.db.set_room_guild(room_id, guild_id)
+
+    def open_room(self, room_id):
+        room = self.rooms.get(room_id)
+        if room:
+            room.is_open = True
+            self.db.open_room(room_id)
+
+    def close_room(self, room_id):
+        room = self.rooms.get(room_id)
+        if room:
+            room.is_open = False
+            self.db.close_room(room_id)
+
+    def invite_member(self, room_id, member_id):
+        room = self.rooms.get(room_id)
+        if room and member_id not in room.invited:
+            room.invited.add(member_id)
+            self.db.invite_member(room_id, member_id, room.guild_id)
+
+    def uninvite_member(self, room_id, member_id):
+        room = self.rooms.get(room_id)
+        if room and member_id in room.invited:
+            room.invited.discard(member_id)
+            self.db.uninvite_member(room_id, member_id)
+
+    def invite_members(self, room_id, member_ids):
+        # Returns ids that weren't invited yet
+        room = self.rooms.get(room_id)
+        if room is None:
+            return []
+        added = [member_id for member_id in dict.fromkeys(member_ids) if member_id not in room.invited]
+        if added:
+            room.invited.update(added)
+            self.db.invite_members(room_id, added, room.guild_id)
+        return added
+
+    def uninvite_members(self, room_id, member_ids):
+        room = self.rooms.get(room_id)
+        if room is None:
+            return []
+        removed = [member_id for member_id in dict.fromkeys(member_ids) if member_id in room.invited]
+        if removed:
+            room.invited.difference_update(removed)
+            self.db.uninvite_members(room_id, removed)
+        return removed
+
+    def transfer_ownership(self, guild_id, from_id, to_id):
+        room_id = self.owners.pop((guild_id, from_id), None)
+        if room_id is None:
+            return
+        self.rooms[room_id].owner_id = to_id
+        self.owners[(guild_id, to_id)] = room_id
+        self.db.transfer_ownership(room_id, to_id)
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from lib.Logger import *
+from lib.Metrics import metrics
+
+POOL_ROOM_NAME = "[🔐] Spare room"
+
+pool_size = metrics.gauge("room_pool_spares", "Pre-created spare rooms waiting to be claimed")
+pool_target = metrics.gauge("room_pool_target", "Number of spare rooms the pool is aiming for")
+pool_claims = metrics.counter("room_pool_claims_total", "Entry room joins by whether a spare room was available", ("outcome",))
+
+class RoomPool:
+
+    # Keeps a few locked, hidden voice channels ready so joining the entry room only costs a move,
+    # pool size follows the number of joins seen in the last window
+
+    def __init__(self, create_room, delete_room, get_channel, min_size=1, max_size=10, window=60):
+        self.create_room = create_room
+        self.delete_room = delete_room
+        self.get_channel = get_channel
+
+        self.enabled = False
+        self.min_size = min_size
+        self.max_size = max_size
+        self.window = window
+
+        self.spares = OrderedDict()
+        self.joins = deque()
+        self.fill_task = None
+
+    def __contains__(self, channel_id):
+        return channel_id in self.spares
+
+    def adopt(self, channels):
+        # Spare rooms survive restarts, pick them back up instead of letting the reaper delete them
+        for channel in channels:
+            if channel.name == POOL_ROOM_NAME and not channel.members:
+                self.spares[channel.id] = None
+        pool_size.set(len(self.spares))
+
+    def record_join(self):
+        self.joins.append(time.monotonic())
+
+    def target_size(self):
+        now = time.monotonic()
+        while self.joins and now - self.joins[0] > self.window:
+            self.joins.popleft()
+
+        target = max(self.min_size, min(self.max_size, len(self.joins)))
+        pool_target.set(target)
+        return target
+
+    def claim(self):
+        while self.spares:
+            channel_id, _ = self.spares.popitem(last=False)
+            channel = self.get_channel(channel_id)
+            if channel is not None and not channel.members:
+                pool_size.set(len(self.spares))
+                pool_claims.labels("hit").inc()
+                return channel
+
+        pool_size.set(0)
+        pool_claims.labels("miss").inc()
+        return None
+
+    def refill(self):
+        if not self.enabled:
+            return
+        if self.fill_task is None or self.fill_task.done():
+            self.fill_task = asyncio.get_event_loop().create_task(self.fill())
+
+    async def fill(self):
+        try:
+            while len(self.spares) < self.target_size():
+                channel = await self.create_room(POOL_ROOM_NAME)
+                self.spares[channel.id] = None
+                pool_size.set(len(self.spares))
+                logger.debug("Added spare room to pool (%s)", len(self.spares))
+
+            # Give back rooms left over from a burst of joins
+            while len(self.spares) > self.target_size():
+                channel_id, _ = self.spares.popitem(last=False)
+                pool_size.set(len(self.spares))
+                channel = self.get_channel(channel_id)
+                if channel is not None:
+                    await self.delete_room(channel)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("FAILED: Couldn't refill room pool - %s", e)
@@ -4,12 +4,85 @@ from logging import LoggerAdapter
 import discord
 from discord import guild
 from discord.ext import commands
+from discord.http import Route
 from discord.utils import *
 
-import json
+import asyncio
+import functools
+import os
+import time
+import typing
 
 from lib.Logger import *
 from lib.Database import Database
+from lib.RoomCache import RoomCache
+from lib.Profanity import ProfanityFilter
+from lib.Guilds import Settings, GuildState
+from lib.Overwrites import build_overwrites, apply_overwrites
+from lib.Scheduler import ActionScheduler, PRIORITY_MOVE, PRIORITY_CHANNEL, PRIORITY_RENAME, PRIORITY_MESSAGE, PRIORITY_BACKGROUND
+from lib.RoomPool import RoomPool
+from lib.JoinBroker import JoinBroker, ACCEPT_EMOJI, DENY_EMOJI
+from lib.Mailbox import Mailboxes
+from lib.VoiceEvents import VoiceDebouncer
+from lib.Analytics import Analytics
+from lib.Provisioning import provision_guilds, parse_guild_ids
+from lib.Strings import StringTables
+from lib.Interactions import Interaction, InteractionContext, ROOM_BUTTONS, register_commands
+from lib.Metrics import metrics, process_rss
+from lib.Instrumentation import MetricsServer, CommandProfiler, instrument_http, resident_memory
+
+# Interaction actions that need the member to own the room they are sitting in
+OWNER_ACTIONS = {"unlock", "lock", "add", "remove", "rename", "delete", "transfer", "panel"}
+
+# Startup deletions leave at least one scheduler worker free for moves
+STARTUP_DELETE_CONCURRENCY = 3
+
+# Audit log reason of room deletions by cause
+TEARDOWN_REASONS = {
+    "command": "Deleted by user",
+    "empty": "Empty channel",
+    "stale": "Stale room",
+}
+
+def mention_list(targets, limit=1000):
+    # Embed field values are capped, long lists end with a count of the rest
+    mentions = [getattr(target, "mention", target) for target in targets]
+    text = ", ".join(mentions)
+    shown = len(mentions)
+    while len(text) > limit:
+        shown -= 1
+        text = f"{', '.join(mentions[:shown])} and {len(mentions) - shown} more"
+    return text
+
+def room_operation(collapse=None):
+    # Runs the command in the mailbox of the caller's room, so commands on one room never interleave.
+    # A queued command of the same member with the same collapse key is replaced by the newer one (e.g. lock then unlock).
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(self, ctx, *args, **kwargs):
+            # The room is taken now, the member may have moved on by the time the command gets its turn
+            voice = ctx.author.voice
+            ctx.room = voice.channel if voice else None
+            if ctx.room is None:
+                return await function(self, ctx, *args, **kwargs)
+            return await self.mailboxes.call(
+                ("room", ctx.room.id),
+                function.__name__,
+                lambda: function(self, ctx, *args, **kwargs),
+                # Only commands of the same member replace each other
+                collapse=(collapse, ctx.author.id) if collapse else None,
+                discard=lambda: self.delete_command(ctx),
+            )
+        return wrapper
+    return decorator
+
+join_to_move = metrics.histogram("join_to_move_seconds", "Time from joining the entry room to being moved into own room", ("path",))
+startup_seconds = metrics.gauge("startup_seconds", "Time from loading the cog until the bot was ready")
+rooms_created = metrics.counter("rooms_created_total", "Private rooms handed out, from the pool or newly created", ("path",))
+rooms_deleted = metrics.counter("rooms_deleted_total", "Private rooms deleted by reason", ("reason",))
+teardown_latency = metrics.histogram("room_teardown_seconds", "Time to move everyone out of a room and delete it", ("reason",))
+commands_total = metrics.counter("commands_total", "Commands by name and outcome", ("command", "outcome"))
+command_latency = metrics.histogram("command_seconds", "Time spent running a command", ("command",))
 
 class Rooms(commands.Cog):
 
@@ -17,561 +90,1025 @@ class Rooms(commands.Cog):
 
         self.bot = bot
         self.db = Database()
-
-        self.GUILD_ID = None
-        self.CATEGORY_ID = None
-        self.ENTRY_ROOM_ID = None
-        self.COMMANDS_ROOM_ID = None
-        self.AFK_ROOM_ID = None
+        self.cache = RoomCache(self.db)
+        self.analytics = Analytics(self.db)
+        self.profanity = ProfanityFilter()
+        self.scheduler = ActionScheduler()
+        self.mailboxes = Mailboxes()
+        self.voice_events = VoiceDebouncer(self.handle_voice_transition)
+        self.settings = Settings()
+        self.strings = StringTables(constants={"accept": ACCEPT_EMOJI, "deny": DENY_EMOJI})
+        self.join_broker = JoinBroker(self.db, self.answer_join_request, self.expire_join_request)
+
+        # Per guild state, every event and command is routed by guild id
+        self.guilds = {}
+
+        self.reconcile_task = None
+        self.flush_task = None
+
+        self.started_at = time.monotonic()
+
+        self.metrics_server = None
+        self.application_id = None
+
+        # Slash command and button actions, most of them run the matching prefix command
+        self.interaction_handlers = {
+            "unlock": self.interaction_unlock,
+            "lock": self.interaction_lock,
+            "add": self.interaction_add,
+            "remove": self.interaction_remove,
+            "rename": self.interaction_rename,
+            "delete": self.interaction_delete,
+            "transfer": self.interaction_transfer,
+            "join": self.interaction_join,
+            "panel": self.interaction_panel,
+        }
+        self.profiler = CommandProfiler()
+        instrument_http(self.bot.http)
+
+        # Set once the room cache is loaded, commands and voice events wait for it
+        self.ready = asyncio.Event()
+
+    def cog_unload(self):
+        # Commits whatever is still waiting in the write-behind journal, first since nothing below may stop it
+        self.db.close()
+
+        for task in (self.reconcile_task, self.flush_task):
+            if task:
+                task.cancel()
+        self.scheduler.stop()
+        self.voice_events.stop()
+        self.mailboxes.stop()
+        self.join_broker.stop()
+
+        # bot.py unloads after bot.run() closed the loop, the endpoint went down with it
+        if self.metrics_server and not self.bot.loop.is_closed():
+            self.bot.loop.create_task(self.metrics_server.stop())
+
+    async def cog_before_invoke(self, ctx):
+        ctx.started_at = time.monotonic()
+        self.profiler.start(ctx)
+
+    async def cog_after_invoke(self, ctx):
+        self.profiler.stop(ctx)
+        command_latency.labels(ctx.command.qualified_name).observe(time.monotonic() - ctx.started_at)
+        commands_total.labels(ctx.command.qualified_name, "error" if ctx.command_failed else "ok").inc()
+
+    async def cog_command_error(self, ctx, error):
+        if isinstance(error, commands.CommandInvokeError):
+            logger.error("FAILED: Command !%s - %s", ctx.command.qualified_name, error.original, exc_info=error.original)
+            return
+
+        # Failed checks and bad arguments never reach the invoke hooks
+        if ctx.command is not None:
+            commands_total.labels(ctx.command.qualified_name, "rejected").inc()
+        logger.debug("Rejected command %s - %s", ctx.message.content, error)
+
+    async def cog_check(self, ctx):
+        if ctx.guild is None or ctx.guild.id not in self.guilds:
+            return False
+        if not self.guilds[ctx.guild.id].config.PREFIX_COMMANDS:
+            return False
+        await self.ready.wait()
+        return True
 
     async def load_settings(self):
-        # Settings
-        self.DEFAULT_DELETE_TIME = 60
 
         try:
+            self.settings.load()
 
-            with open("./assets/settings.json", "r", encoding="utf8") as settings:
-                data = json.load(settings)
-
-            self.GUILD_ID = data.get("GUILD_ID")
-            self.CATEGORY_ID = data.get("CATEGORY_ID")
-            self.ENTRY_ROOM_ID = data.get("ENTRY_ROOM_ID")
-            self.COMMANDS_ROOM_ID = data.get("COMMANDS_ROOM_ID")
-            self.AFK_ROOM_ID = data.get("AFK_ROOM_ID")
+            self.RECONCILE_INTERVAL = self.settings.options["RECONCILE_INTERVAL"]
+            self.DB_FLUSH_INTERVAL = self.settings.options["DB_FLUSH_INTERVAL"]
+            self.profanity.normalize = self.settings.options["PROFANITY_NORMALIZE"]
+            self.MEMBER_CACHE_SIZE = self.settings.options["MEMBER_CACHE_SIZE"]
+            self.voice_events.window = self.settings.options["VOICE_DEBOUNCE_SECONDS"]
+            self.analytics.enabled = self.settings.options["ANALYTICS"]
+            self.METRICS_HOST = self.settings.options["METRICS_HOST"]
+            self.METRICS_PORT = self.settings.options["METRICS_PORT"]
+            self.profiler.commands = set(self.settings.options["PROFILE_COMMANDS"])
 
-            logger.info("SUCCESS: Settings loaded")
+            logger.info("SUCCESS: Settings loaded for %s guilds", len(self.settings.guilds))
 
         except:
             logger.error("FAILED: Couldn't load settings")
             exit()
 
-    async def init_module(self):
-        while True:
-            guild_id = input("Enter GUILD ID (Server ID) of your guild: ")
-            try:
-                guild_id = int(guild_id)
-            except:
-                print("Invalid ID! ID must only contain numbers! Try again!")
-                continue
-            guild = discord.utils.get(self.bot.guilds, id=guild_id)
-            if guild:
-                print("ID OK")
-            
-                try:
-                    print("Creating category")
-                    category = await guild.create_category("Private rooms")
+    def add_guild(self, config):
+        state = GuildState(config, self.MEMBER_CACHE_SIZE)
+        state.strings = self.strings.get(config.LANGUAGE)
+        state.pool = RoomPool(
+            lambda name: self.create_spare_room(state, name),
+            lambda channel: self.delete_spare_room(channel),
+            state.lookup.get_channel,
+            min_size=config.POOL_MIN_SIZE,
+            max_size=config.POOL_MAX_SIZE,
+        )
+        self.guilds[config.GUILD_ID] = state
+        return state
+
+    async def provision(self):
+        # Guilds listed in GUILD_ID (.env) without settings are set up, configured ones get deleted channels recreated
+        guild_ids = list(dict.fromkeys([*self.settings.guilds, *parse_guild_ids(os.getenv("GUILD_ID"))]))
+        if not guild_ids and self.serves_all_guilds():
+            logger.error("FAILED: No guild configured, set GUILD_ID in .env or run python bot.py setup <guild id>")
+            exit()
+        guild_ids = [guild_id for guild_id in guild_ids if self.owns_guild(guild_id)]
+
+        return await provision_guilds(self.settings, self.bot, guild_ids, self.settings.options["REPAIR_CHANNELS"])
+
+    @commands.Cog.listener()
+    async def on_ready(self):
 
-                    print("Creating commands channel")
-                    commands_channel = await guild.create_text_channel("🔐info", category=category)
+        await self.load_settings()
 
-                    print("Creating entrance channel")
-                    entry_channel = await guild.create_voice_channel("Create room", category=category)
+        created = await self.provision()
 
-                    print("Looking for AFK room")
-                    if guild.afk_channel:
-                        print("AFK channel found")
-                    else:
-                        print("No AFK channel found! Using default values")
+        logger.debug("Fetching server data")
 
-                except:
-                    print("ERROR! Check if bot has all necessary permissions to create channels!")
-                    exit()
-                
-                try:
-                    print("Saving configuration...")
-                    config = {
-                        "GUILD_ID": guild_id,
-                        "CATEGORY_ID": category.id,
-                        "ENTRY_ROOM_ID": entry_channel.id,
-                        "COMMANDS_ROOM_ID": commands_channel.id,
-                    }
-                    if guild.afk_channel:
-                        config["AFK_ROOM_ID"] = guild.afk_channel.id
-                    
-                    with open("./assets/settings.json", "w", encoding="utf8") as settings:
-                        json.dump(config, settings)
-
-                except:
-                    print("ERROR! Could not save configuration!")
-                    exit()
-
-                print("DONE! Starting Bot ...")
-                await asyncio.sleep(2)
-                break
-            else:
-                print("Looks like BOT has not joined the server yet! Try again after bot connects to the server.")
+        for config in self.settings.guilds.values():
+            if not self.owns_guild(config.GUILD_ID):
                 continue
 
-    @commands.Cog.listener()
-    async def on_ready(self):
+            guild = self.bot.get_guild(config.GUILD_ID)
+            if guild is None:
+                logger.error("FAILED: Couldn't fetch server data for guild %s", config.GUILD_ID)
+                continue
 
-        await self.load_settings()
+            state = self.guilds.get(config.GUILD_ID) or self.add_guild(config)
+            state.config = config
+            # Channels just created reach the cache only with their gateway events
+            state.bind(guild, created.get(config.GUILD_ID, ()))
+
+        if not self.guilds:
+            logger.error("FAILED: Bot is not a member of any configured guild")
+            if self.serves_all_guilds():
+                exit()
+
+        # Cache is authoritative once running, only load it from database on first start
+        if self.flush_task is None:
+            await self.cache.warm(lambda guild_id: guild_id == 0 or self.owns_guild(guild_id))
+            self.assign_legacy_rooms()
+            await self.analytics.start({state.id: [room.room_id for room in self.cache.get_guild_rooms(state.id)] for state in self.guilds.values()})
+            self.flush_task = self.bot.loop.create_task(self.cache.write_behind(self.DB_FLUSH_INTERVAL))
+            await self.join_broker.restore(self.owns_guild)
+            await self.restore_info_messages()
+            self.join_broker.start()
+
+            # Metrics endpoint is off unless a port is configured
+            if self.METRICS_PORT:
+                self.metrics_server = MetricsServer(self.METRICS_HOST, self.METRICS_PORT)
+                try:
+                    await self.metrics_server.start()
+                except OSError as e:
+                    logger.error("FAILED: Couldn't start metrics endpoint - %s", e)
+                    self.metrics_server = None
+
+            # Only rooms that existed before voice events are handled can be stale, new ones may still be waiting for their owner
+            for state in self.guilds.values():
+                state.startup_room_ids = {channel.id for channel in state.category.voice_channels} if state.category else set()
+            self.ready.set()
+
+            for state in self.guilds.values():
+                if state.config.SLASH_COMMANDS:
+                    await self.register_slash_commands(state)
+
+            for state in self.guilds.values():
+                if state.config.POOL_ENABLED and state.category:
+                    state.pool.enabled = True
+                    state.pool.adopt(channel for channel in state.category.voice_channels if not self.cache.is_room_private(channel.id))
+                    state.pool.refill()
+
+        # Guilds that got a new commands room also get a new panel
+        for guild_id, channels in created.items():
+            if guild_id in self.guilds and any(isinstance(channel, discord.TextChannel) for channel in channels):
+                await self.generate_message(self.guilds[guild_id])
+
+        game = discord.Game("Monitoring private rooms")
+        await self.bot.change_presence(status=discord.Status.online, activity=game)
+        
+        logger.info("%s has connected to %s guilds!", self.bot.user.name, len(self.guilds))
+
+        if not startup_seconds.value:
+            startup_seconds.set(time.monotonic() - self.started_at)
+            resident_memory.set(process_rss())
+            cached_members = sum(len(guild.members) for guild in self.bot.guilds)
+            logger.info("SUCCESS: Ready in %.1fs with %s cached members using %.0f MB", startup_seconds.value, cached_members, resident_memory.value / 2**20)
+
+        # on_ready fires again after reconnects, keep only one sweep running
+        if self.reconcile_task is None or self.reconcile_task.done():
+            self.reconcile_task = self.bot.loop.create_task(self.check_rooms())
+
+    def serves_all_guilds(self):
+        return getattr(self.bot, "shard_ids", None) is None
+
+    def owns_guild(self, guild_id):
+        # With shards spread over several processes every guild belongs to exactly one of them
+        if self.serves_all_guilds() or not self.bot.shard_count:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count in self.bot.shard_ids
+
+    def assign_legacy_rooms(self):
+        # Rooms stored before multi-guild support have no guild, find it through the channel
+        for room in self.cache.get_guild_rooms(0):
+            channel = self.bot.get_channel(room.room_id)
+            if channel is not None:
+                self.cache.assign_guild(room.room_id, channel.guild.id)
+            elif self.serves_all_guilds():
+                self.cache.delete_private_room(room.room_id)
+            else:
+                self.cache.evict(room.room_id)
 
-        fresh = False
+    def schedule_room_deletion(self, state, channel):
+        if channel.id in state.pending_deletions:
+            return
+        
+        state.pending_deletions[channel.id] = self.bot.loop.create_task(self.delete_empty_room(state, channel.id))
+        logger.debug("Scheduled deletion of empty room %s in %ss", channel.name, state.config.EMPTY_ROOM_GRACE_PERIOD)
 
-        if self.GUILD_ID == 0:
-            await self.init_module()
-            await self.load_settings()
-            fresh = True
+    def cancel_room_deletion(self, state, channel):
+        task = state.pending_deletions.pop(channel.id, None)
+        if task:
+            task.cancel()
+            logger.debug("Cancelled deletion of room %s", channel.name)
 
+    async def delete_empty_room(self, state, channel_id):
         try:
-            logger.debug("Fetching server data")
+            await asyncio.sleep(state.config.EMPTY_ROOM_GRACE_PERIOD)
+
+            channel = state.lookup.get_channel(channel_id)
+            
+            # Room was already deleted by owner
+            if channel is None:
+                if self.cache.is_room_private(channel_id):
+                    self.analytics.room_deleted(state.id, channel_id)
+                self.cache.delete_private_room(channel_id)
+                return
 
-            self.guild = discord.utils.get(self.bot.guilds, id=self.GUILD_ID)
-            self.entry_room = discord.utils.get(self.guild.voice_channels, id=self.ENTRY_ROOM_ID)
-            self.commands_room = discord.utils.get(self.guild.channels, id=self.COMMANDS_ROOM_ID)
-            self.category = discord.utils.get(self.guild.channels, id=self.CATEGORY_ID)
-            self.afk_room = discord.utils.get(self.guild.channels, id=self.AFK_ROOM_ID)
+            # Commands on the room finish first, somebody may also have come back meanwhile
+            await self.mailboxes.call(("room", channel.id), "teardown", lambda: self.delete_if_empty(state, channel))
         
+        except asyncio.CancelledError:
+            raise
         except:
-            logger.error("FAILED: Couldn't fetch server data")
-            exit()
+            logger.error("FAILED: Couldn't delete empty room %s", channel_id)
+        
+        finally:
+            if state.pending_deletions.get(channel_id) is asyncio.current_task():
+                del state.pending_deletions[channel_id]
+
+    async def delete_if_empty(self, state, channel):
+        if channel.members or state.lookup.get_channel(channel.id) is None:
+            return
+        await self.teardown_room(state, channel, "empty")
+
+    async def teardown_room(self, state, channel, cause, priority=PRIORITY_CHANNEL):
+        # Everyone is moved out, then the room goes. Without an AFK room the moves are skipped,
+        # deleting the channel disconnects whoever is inside.
+        started_at = time.monotonic()
+        if self.cache.is_room_private(channel.id):
+            self.analytics.room_deleted(state.id, channel.id)
+        self.cache.delete_private_room(channel.id)
+
+        if state.afk_room is not None and state.config.MOVE_TO_AFK:
+            moves = [self.move_member(member, state.afk_room) for member in channel.members]
+            if moves:
+                await asyncio.gather(*moves, return_exceptions=True)
 
-        if fresh:
-            await self.generate_message()
+        try:
+            await self.delete_channel(channel, TEARDOWN_REASONS[cause], priority)
+        except discord.NotFound:
+            pass
 
-        game = discord.Game("Monitoring private rooms")
-        await self.bot.change_presence(status=discord.Status.online, activity=game)
-        
-        logger.info(f'{self.bot.user.name} has connected to {self.guild.name}!')
+        elapsed = time.monotonic() - started_at
+        teardown_latency.labels(cause).observe(elapsed)
+        rooms_deleted.labels(cause).inc()
+        logger.info("Deleted private room %s (%s) in %.2fs", channel.name, cause, elapsed, extra=fields(state.guild, channel))
+        return elapsed
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        # Rooms deleted by someone else, the bot's own deletions have dropped the row already
+        state = self.guilds.get(channel.guild.id)
+        if state and self.cache.is_room_private(channel.id):
+            self.cancel_room_deletion(state, channel)
+            self.drop_orphaned_rooms(state, [channel.id])
 
-        await self.check_rooms()
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        state = self.guilds.get(member.guild.id)
+        if state:
+            state.lookup.forget(member.id)
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
-        
-        # Check if user has joined entry room
-        if(before.channel != self.entry_room and after.channel == self.entry_room):
 
-            if self.db.is_already_owner(member.id):
-                channel_id = self.db.get_owner_room(member.id)
-                channel = discord.utils.get(self.guild.channels, id=channel_id)
-                await member.edit(voice_channel=channel)
+        state = self.guilds.get(member.guild.id)
+        if state is None or state.guild is None:
+            return
+        await self.ready.wait()
+
+        # Members leaving voice drop out of the lean member cache, keep them around for commands
+        if after.channel is None:
+            state.lookup.remember(member)
+
+        # Rapid channel changes of a member are handled once, as a move from the first channel to the last
+        self.voice_events.push((state.id, member.id), member, before.channel, after.channel)
+
+    async def handle_voice_transition(self, member, before, after, passed, changed_at):
+
+        state = self.guilds.get(member.guild.id)
+        if state is None or state.guild is None:
+            return
+
+        # Someone came back before grace period ran out
+        if after and after.id in state.pending_deletions:
+            self.cancel_room_deletion(state, after)
+
+        if after and before != after and self.cache.is_room_private(after.id):
+            self.analytics.member_joined(state.id, after.id, member.id)
+
+        # Last member left the room, rooms only passed through count as left too
+        for channel in (before, *passed):
+            if channel and channel != after and state.is_private_room(channel) and not channel.members:
+                self.schedule_room_deletion(state, channel)
+        
+        # Check if user has joined one of the entry rooms
+        if before != after and state.is_entry_room(after):
+            # Joins of one member are handled in order, a quick double join can't create two rooms
+            await self.mailboxes.call(("member", state.id, member.id), "entry", lambda: self.handle_entry(state, member, changed_at), collapse="entry")
+
+    async def handle_entry(self, state, member, joined_at):
+
+        # Member moved on while an earlier join was handled
+        if member.voice is None or not state.is_entry_room(member.voice.channel):
+            return
+
+        if self.cache.is_already_owner(state.id, member.id):
+            channel_id = self.cache.get_owner_room(state.id, member.id)
+            channel = state.lookup.get_channel(channel_id)
+            if channel is not None:
+                await self.move_member(member, channel)
+                join_to_move.labels("existing").observe(time.monotonic() - joined_at)
                 return
-            
-            # Create new private room
-            overwrites = {
-                self.guild.default_role : discord.PermissionOverwrite(connect=False),
-                member : discord.PermissionOverwrite(connect=True),
-            }
-            
-            bitrates = [96000, 128000, 256000, 384000]
-            bitrate = bitrates[self.guild.premium_tier]
 
-            channel_name = f"[🔐] {member.name}"
-            channel = await self.guild.create_voice_channel(channel_name, bitrate=bitrate, overwrites=overwrites, category=self.category)
-            self.db.add_private_room(channel.id, member.id)
+            # Room was deleted behind the bot's back, moving to it would disconnect the member. They get a new one.
+            self.drop_orphaned_rooms(state, [channel_id])
+
+        channel_name = f"[🔐] {member.name}"
+
+        # Hand over a spare room from the pool, owner's overwrite and name follow after the move
+        if state.pool.enabled:
+            state.pool.record_join()
+            channel = state.pool.claim()
+            state.pool.refill()
+
+            if channel:
+                self.cache.add_private_room(state.id, channel.id, member.id)
+                self.analytics.room_created(state.id, channel.id, member.id)
+                await self.move_member(member, channel)
+                join_to_move.labels("pool").observe(time.monotonic() - joined_at)
 
-            # Move member to newly created room
-            await member.edit(voice_channel=channel)
+                self.sync_overwrites(state, channel)
+                self.rename_room(channel, channel_name)
 
-            logger.info(f"Created private room {channel.name}")
+                rooms_created.labels("pool").inc()
+                logger.info("Claimed private room from pool for %s", member.name, extra=fields(state.guild, channel, member))
+                return
+        
+        # Create new private room
+        overwrites = build_overwrites(state.guild.default_role, member, False)
+        channel = await self.scheduler.run("create_channel", lambda: state.guild.create_voice_channel(channel_name, bitrate=self.room_bitrate(state), overwrites=overwrites, category=state.category), PRIORITY_CHANNEL)
+        self.cache.add_private_room(state.id, channel.id, member.id)
+        self.analytics.room_created(state.id, channel.id, member.id)
+
+        # Move member to newly created room
+        await self.move_member(member, channel)
+        join_to_move.labels("create").observe(time.monotonic() - joined_at)
+
+        rooms_created.labels("new").inc()
+        logger.info("Created private room %s", channel.name, extra=fields(state.guild, channel, member))
+
+    def room_bitrate(self, state):
+        bitrates = [96000, 128000, 256000, 384000]
+        return bitrates[state.guild.premium_tier]
+
+    async def create_spare_room(self, state, name):
+        # Spare rooms stay hidden until claimed
+        overwrites = {
+            state.guild.default_role : discord.PermissionOverwrite(connect=False, view_channel=False),
+        }
+        return await self.scheduler.run("create_channel", lambda: state.guild.create_voice_channel(name, bitrate=self.room_bitrate(state), overwrites=overwrites, category=state.category), PRIORITY_BACKGROUND)
+
+    async def delete_spare_room(self, channel):
+        await self.scheduler.run("delete_channel", lambda: channel.delete(reason="Room pool shrink"), PRIORITY_BACKGROUND)
     
+# OUTBOUND ACTIONS
+
+    def move_member(self, member, channel):
+        # None disconnects. Member edits of a guild share one Discord bucket, discord.py sends them one after
+        # another and waits out the bucket from the rate limit headers instead of running into 429s.
+        return self.scheduler.submit("move", lambda: member.move_to(channel), PRIORITY_MOVE, key=("move", member.id))
+
+    def rename_room(self, channel, name):
+        # Discord allows only 2 renames per channel in 10 minutes, queued renames collapse into the latest name
+        return self.scheduler.submit("rename", lambda: channel.edit(name=name), PRIORITY_RENAME, key=("rename", channel.id), bucket=channel.id)
+
+    def delete_channel(self, channel, reason, priority=PRIORITY_CHANNEL):
+        return self.scheduler.submit("delete_channel", lambda: channel.delete(reason=reason), priority, key=("delete_channel", channel.id))
+
+    def reply(self, ctx, state, embed):
+        # Interactions get an ephemeral answer, prefix commands a message in the commands room that deletes itself
+        if isinstance(ctx, InteractionContext):
+            return ctx.interaction.reply(embed)
+        return self.send_info(state, embed)
+
+    def reply_interaction(self, ctx, embed):
+        # Prefix commands ignore requests that lead nowhere, an interaction is told why
+        if isinstance(ctx, InteractionContext):
+            return ctx.interaction.reply(embed)
+        return None
+
+    def send_info(self, state, embed):
+        return self.scheduler.submit("message", lambda: state.commands_room.send(embed=embed, delete_after=state.config.DEFAULT_DELETE_TIME), PRIORITY_MESSAGE)
+
+    def send_direct(self, member, embed):
+        return self.scheduler.submit("direct_message", lambda: member.send(embed=embed, delete_after=120), PRIORITY_MESSAGE)
+
+    def send_directs(self, members, embed):
+        # Notifications of one command share a single queued action, a big invite can't crowd out other messages
+        if not members:
+            return None
+
+        async def send_all():
+            for member in members:
+                try:
+                    await member.send(embed=embed, delete_after=120)
+                except discord.HTTPException:
+                    logger.debug("FAILED: Couldn't send direct message to %s", member.name)
+
+        return self.scheduler.submit("direct_message", send_all, PRIORITY_MESSAGE)
+
+    def delete_command(self, ctx):
+        if ctx.message is None:
+            return None
+        return self.scheduler.submit("delete_message", ctx.message.delete, PRIORITY_MESSAGE)
+
+    def sync_overwrites(self, state, channel, denied_members=()):
+        # Overwrites are computed when the action runs, so queued edits for one room collapse into one
+        return self.scheduler.submit("overwrites", lambda: self.apply_room_overwrites(state, channel, denied_members), PRIORITY_CHANNEL, key=("overwrites", channel.id))
+
+    async def apply_room_overwrites(self, state, channel, denied_members=()):
+        # Brings channel permissions in line with room state, returns number of API calls made
+        owner_id = self.cache.get_room_owner(channel.id)
+        owner = await state.lookup.fetch_member(owner_id)
+        invited_ids = self.cache.get_all_invited_members(channel.id)
+        invited_roles = [role for role in map(state.guild.get_role, invited_ids) if role is not None]
+        role_ids = {role.id for role in invited_roles}
+        invited_members = await state.lookup.fetch_members([member_id for member_id in invited_ids if member_id not in role_ids])
+        
+        overwrites = build_overwrites(state.guild.default_role, owner, self.cache.is_open(channel.id), invited_roles + invited_members, denied_members)
+
+        # Owner and invited members that failed to resolve (timeouts, outages) must not lose access, only those gone from the guild do
+        resolved_ids = {target.id for target in overwrites}
+        unresolved_ids = [target_id for target_id in (owner_id, *invited_ids) if target_id is not None and target_id not in resolved_ids and not state.lookup.is_gone(target_id)]
+        return await apply_overwrites(channel, overwrites, keep=unresolved_ids)
+
     @commands.command()
     async def message(self, ctx):
 
-        if self.commands_room.permissions_for(ctx.author).administrator:
-            await self.generate_message()
+        state = self.guilds[ctx.guild.id]
+        if state.commands_room.permissions_for(ctx.author).administrator:
+            await self.generate_message(state)
 
-        await ctx.message.delete()
-            
-    async def generate_message(self):
-        embed = discord.Embed(title=":lock: Private rooms", description=f"Place to create a new private room or join existing one!", color=discord.Color.magenta())
+        self.delete_command(ctx)
             
-        embed.add_field(name=":eight_spoked_asterisk: Create a new room", inline=False, value="*Connect to the voice room below to create a new private room. Bot will move you automatically.*")
-        embed.add_field(name="🙋‍♂️ Joining the room", inline=False, value="`!join <@room_owner>`\n*Sends a request to join the room.*")
-        embed.add_field(name=":inbox_tray: Grant access", inline=False, value="`!add <@member>` \n*Grants access to member to join the room.*")
-        embed.add_field(name=":outbox_tray: Revoke access", inline=False, value="`!remove <@member>`\n*Will revoke access for member to join the room. This will also kick member from existing room.*\n")
-        embed.add_field(name=":unlock: Unlock a room", inline=False, value="`!unlock`\n*Unlocks the room for everyone without needing an invite to join.*")
-        embed.add_field(name=":lock: Lock a room", inline=False, value="`!lock`\n*Locks the room. Only users with invitation will be able to join. This won't remove existing members.*")
-        embed.add_field(name=":x: Delete a room", inline=False, value="`!delete`\n*Delets the room. Rooms are automatically deleted when detected as empty.*")
-        embed.add_field(name=":abc: Rename a room", inline=False, value="`!rename <name>`\n*Renames a room.*")
-        embed.add_field(name=":crown: Change owner", inline=False, value="`!transfer <@member>`\n*Transfers ownership to other member.*\n")
-        
-        embed.set_footer(text="Note: Rooms are locked by default! Commands are only valid when entered in this channel. Only owner of room can change settings and add/remove members.")
-        
-        await self.commands_room.send(embed=embed)
+    @commands.command()
+    async def stats(self, ctx, days:int=7):
+
+        state = self.guilds[ctx.guild.id]
+        if state.commands_room.permissions_for(ctx.author).administrator and self.analytics.enabled:
+            days = max(1, min(days, 365))
+            summary = await self.analytics.summary(state.id, days)
+
+            lifetime = int(summary["lifetime"])
+            hours = ", ".join(f"{hour:02}:00" for hour in summary["hours"]) or "-"
+            embed = state.strings.render("stats", guild=state.guild.name, days=days, created=summary["created"], active=summary["active"],
+                peak=summary["peak"], lifetime=f"{lifetime // 3600}h {lifetime % 3600 // 60}m", invitations=f"{summary['invitations']:.1f}",
+                joined=summary["joined"], hours=hours)
+            self.reply(ctx, state, embed)
+
+        self.delete_command(ctx)
+
+    async def generate_message(self, state):
+        embed = state.strings.render("panel")
+
+        # Buttons act on the room of whoever presses them, discord.py 1.7 can't send components itself
+        data = {"embed": embed.to_dict(), "components": ROOM_BUTTONS if state.config.SLASH_COMMANDS else []}
+        channel_id = state.commands_room.id
+
+        # Edit the panel posted earlier, a new one is only sent when it's gone
+        if state.info_message_id:
+            try:
+                await self.scheduler.run("message", lambda: self.bot.http.edit_message(channel_id, state.info_message_id, **data), PRIORITY_MESSAGE)
+                return
+            except discord.NotFound:
+                logger.debug("Info message in %s was deleted, sending a new one", state.guild.name)
+
+        route = Route("POST", "/channels/{channel_id}/messages", channel_id=channel_id)
+        message = await self.scheduler.run("message", lambda: self.bot.http.request(route, json=data), PRIORITY_MESSAGE)
+        state.info_message_id = int(message["id"])
+        self.db.set_info_message(state.id, channel_id, state.info_message_id)
+
+    async def restore_info_messages(self):
+        for guild_id, channel_id, message_id in await self.db.get_info_messages():
+            state = self.guilds.get(guild_id)
+            # Panel moves with the commands room, an old one in another channel is left alone
+            if state is not None and channel_id == state.config.COMMANDS_ROOM_ID:
+                state.info_message_id = message_id
 
     @commands.command(aliases=['unlock'])
+    @room_operation(collapse="visibility")
     async def open(self, ctx):
         
+        state = self.guilds[ctx.guild.id]
         member = ctx.author
-        channel = member.voice.channel
+        channel = ctx.room
         
-        if self.db.is_owner(channel.id, member.id):
+        if self.cache.is_owner(channel.id, member.id):
             
-            if not self.db.is_open(channel.id):
-                overwrite = {
-                    member : discord.PermissionOverwrite(connect=True),
-                    self.guild.default_role : discord.PermissionOverwrite(connect=True)
-                }
-
-                invited_members = self.db.get_all_invited_members(channel.id)
-                if invited_members:
-                    for item in invited_members:
-                        invited_member = discord.utils.get(self.guild.members, id=item[2])
-                        overwrite.update({
-                            invited_member : discord.PermissionOverwrite(connect=True)
-                        })
-
-                self.db.open_room(channel.id)
-                
-                await channel.edit(overwrites=overwrite)
-                embed = discord.Embed(title=":unlock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Room unlocked!", inline=True, value="Anyone can join.")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+            if not self.cache.is_open(channel.id):
+                self.cache.open_room(channel.id)
+                await self.sync_overwrites(state, channel)
+
+                embed = state.strings.render("room_unlocked", member=member.mention, room=channel.name)
+                self.reply(ctx, state, embed)
                 
-                logger.info(f"Unlocked room - {channel.name}")
+                logger.info("Unlocked room - %s", channel.name, extra=fields(state.guild, channel, member))
             
             else:
-                embed = discord.Embed(title=":unlock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Room is already unlocked!", inline=True, value="Anyone can join.")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                embed = state.strings.render("room_already_unlocked", member=member.mention, room=channel.name)
+                self.reply(ctx, state, embed)
         
-        await ctx.message.delete()
+        self.delete_command(ctx)
 
     @commands.command(aliases=['lock'])
+    @room_operation(collapse="visibility")
     async def close(self, ctx):
 
+        state = self.guilds[ctx.guild.id]
         member = ctx.author
-        channel = member.voice.channel
-
-        if self.db.is_owner(channel.id, member.id):
-
-            if self.db.is_open(channel.id):
-                overwrite = {
-                    member : discord.PermissionOverwrite(connect=True),
-                    self.guild.default_role : discord.PermissionOverwrite(connect=False)
-                }
-
-                invited_members = self.db.get_all_invited_members(channel.id)
-                if invited_members:
-                    for item in invited_members:
-                        invited_member = discord.utils.get(self.guild.members, id=item[2])
-                        overwrite.update({
-                            invited_member : discord.PermissionOverwrite(connect=True)
-                        })
-
-                self.db.close_room(channel.id)
-                await channel.edit(overwrites=overwrite)
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Room locked!", inline=True, value="Only members with invite can join")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+        channel = ctx.room
+
+        if self.cache.is_owner(channel.id, member.id):
+
+            if self.cache.is_open(channel.id):
+                self.cache.close_room(channel.id)
+                await self.sync_overwrites(state, channel)
+
+                embed = state.strings.render("room_locked", member=member.mention, room=channel.name)
+                self.reply(ctx, state, embed)
                 
-                logger.info(f"Locked room - {channel.name}")
+                logger.info("Locked room - %s", channel.name, extra=fields(state.guild, channel, member))
             
             else:
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Room is already locked!", inline=True, value="Only members with invite can join")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                embed = state.strings.render("room_already_locked", member=member.mention, room=channel.name)
+                self.reply(ctx, state, embed)
 
-        await ctx.message.delete()
+        self.delete_command(ctx)
 
     @commands.command(aliases=['add'])
-    async def invite(self, ctx, mentioned_member:discord.Member):
+    @room_operation()
+    async def invite(self, ctx, *targets:typing.Union[discord.Member, discord.Role]):
         
+        state = self.guilds[ctx.guild.id]
         member = ctx.author
-        channel = member.voice.channel
+        channel = ctx.room
         
-        if self.db.is_owner(channel.id, member.id):
-            if not self.db.is_open(channel.id):
-                overwrite = {
-                    member : discord.PermissionOverwrite(connect=True),
-                    self.guild.default_role : discord.PermissionOverwrite(connect=False)
-                }
-
-                invited_members = self.db.get_all_invited_members(channel.id)
-                if invited_members:
-                    for item in invited_members:
-                        invited_member = discord.utils.get(self.guild.members, id=item[2])
-                        overwrite.update({
-                            invited_member : discord.PermissionOverwrite(connect=True)
-                        })
-                overwrite.update({
-                        mentioned_member : discord.PermissionOverwrite(connect=True)
-                })
-
-                self.db.invite_member(channel.id, mentioned_member.id)
-                await channel.edit(overwrites=overwrite)
+        if targets and self.cache.is_owner(channel.id, member.id):
+            if not self.cache.is_open(channel.id):
+                # Members and roles are stored and pushed together, whole command costs one overwrite edit
+                added = self.cache.invite_members(channel.id, [target.id for target in targets])
+                self.analytics.members_invited(state.id, channel.id, added)
+                await self.sync_overwrites(state, channel)
                 
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Member added!", inline=True, value=f"Room access was given to member {mentioned_member.mention}")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                embed = state.strings.render("members_added", member=member.mention, room=channel.name, targets=mention_list(targets))
+                self.reply(ctx, state, embed)
 
-                embed = discord.Embed(title="✅ **Private rooms**", description=f"{channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Access given!", inline=True, value=f"You were given access to room!")
-                embed.set_author(name=f"{self.guild.name}")
+                embed = state.strings.render("access_given", room=channel.name, guild=state.guild.name)
                 
-                try:
-                    await mentioned_member.send(embed=embed, delete_after=120)
-                except:
-                    pass
+                self.send_directs([target for target in targets if isinstance(target, discord.Member) and target.id in added], embed)
                 
-                logger.info(f"Member added to room - {channel.name}")
+                logger.info("%s members added to room - %s", len(added), channel.name, extra=fields(state.guild, channel, member))
             
             else:
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Error!", inline=True, value=f"You can add or remove members only in locked room!")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                embed = state.strings.render("locked_only", member=member.mention, room=channel.name)
+                self.reply(ctx, state, embed)
         
-        await ctx.message.delete()
+        self.delete_command(ctx)
     
     @commands.command(aliases=['remove'])
-    async def uninvite(self, ctx, mentioned_member:discord.Member):
+    @room_operation()
+    async def uninvite(self, ctx, *targets:typing.Union[discord.Member, discord.Role]):
 
+        state = self.guilds[ctx.guild.id]
         member = ctx.author
-        channel = member.voice.channel
-
-        if self.db.is_owner(channel.id, member.id):
-
-            if not self.db.is_open(channel.id):
-                overwrite = {
-                    member : discord.PermissionOverwrite(connect=True),
-                    self.guild.default_role : discord.PermissionOverwrite(connect=False)
-                }
-
-                invited_members = self.db.get_all_invited_members(channel.id)
-                if invited_members:
-                    for item in invited_members:
-                        invited_member = discord.utils.get(self.guild.members, id=item[2])
-                        overwrite.update({
-                            invited_member : discord.PermissionOverwrite(connect=True)
-                        })
-                overwrite.update({
-                        mentioned_member : discord.PermissionOverwrite(connect=False)
-                })
-
-                self.db.uninvite_member(channel.id, mentioned_member.id)
-                await channel.edit(overwrites=overwrite)
+        channel = ctx.room
+
+        if targets and self.cache.is_owner(channel.id, member.id):
+
+            if not self.cache.is_open(channel.id):
+                self.cache.uninvite_members(channel.id, [target.id for target in targets])
+
+                denied_members = [target for target in targets if isinstance(target, discord.Member) and target.id != member.id]
+                await self.sync_overwrites(state, channel, denied_members=denied_members)
                 
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Member removed!", inline=True, value="Members access has been revoked!")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                embed = state.strings.render("members_removed", member=member.mention, room=channel.name, targets=mention_list(targets))
+                self.reply(ctx, state, embed)
                 
-                if mentioned_member.voice and mentioned_member.voice.channel == channel:
-                    try:
-                        await mentioned_member.edit(voice_channel=self.afk_room)
-                    except:
-                        pass
+                # Kick out everyone who just lost access, directly or through a role
+                removed_ids = {target.id for target in denied_members}
+                removed_role_ids = {target.id for target in targets if isinstance(target, discord.Role)}
+                remaining_ids = self.cache.get_all_invited_members(channel.id)
+                for connected_member in channel.members:
+                    if connected_member.id == member.id:
+                        continue
+                    access_ids = {connected_member.id} | {role.id for role in connected_member.roles}
+                    if connected_member.id in removed_ids or (access_ids & removed_role_ids and not access_ids & remaining_ids):
+                        self.move_member(connected_member, state.afk_room)
                 
-                logger.info(f"Member removed from room - {channel.name}")
+                logger.info("%s members removed from room - %s", len(targets), channel.name, extra=fields(state.guild, channel, member))
             
             else:
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Error!", inline=True, value=f"You can add or remove members only in locked room!")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                embed = state.strings.render("locked_only", member=member.mention, room=channel.name)
+                self.reply(ctx, state, embed)
         
-        await ctx.message.delete()
+        self.delete_command(ctx)
     
     @commands.command()
+    @room_operation(collapse="rename")
     async def rename(self, ctx, *, new_name=None):
         
+        state = self.guilds[ctx.guild.id]
         member = ctx.author
-        channel = member.voice.channel
+        channel = ctx.room
         
-        if self.db.is_owner(channel.id, member.id):
+        if self.cache.is_owner(channel.id, member.id):
             
             if new_name == None:
-                await ctx.message.delete()
+                self.delete_command(ctx)
                 return
-            is_valid = True
+            bad_word = self.profanity.match(new_name)
             
-            with open("./assets/bad_words.txt", "r") as file:
-                words = file.readlines()
-            
-            for word in words:
-                word = word.rstrip()
-                if word in new_name.lower():
-                    is_valid = False
-                    break
-            
-            if is_valid:
+            if bad_word is None:
                 new_name = f"[{member.name}] {new_name}"
-                await channel.edit(name=new_name)
+                self.rename_room(channel, new_name)
             
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {new_name}", color=discord.Color.magenta())
-                embed.add_field(name="Name changed!", inline=True, value="Name of the room was successfuly changed")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                embed = state.strings.render("room_renamed", member=member.mention, room=new_name)
+                self.reply(ctx, state, embed)
             
-                logger.info(f"Room name changed - {new_name}")
+                logger.info("Room name changed - %s", new_name, extra=fields(state.guild, channel, member))
             
             else:
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Error!", inline=True, value="Room name cannot contain any vulgarism!")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                logger.info("Rejected room name containing '%s' - %s", bad_word, new_name)
+                embed = state.strings.render("name_rejected", member=member.mention, room=channel.name)
+                self.reply(ctx, state, embed)
         
-        await ctx.message.delete()
+        self.delete_command(ctx)
 
     @commands.command()
+    @room_operation()
     async def delete(self, ctx):
         
+        state = self.guilds[ctx.guild.id]
         member = ctx.author
-        channel = member.voice.channel
-        await ctx.message.delete()
+        channel = ctx.room
+        self.delete_command(ctx)
         
-        if self.db.is_owner(channel.id, member.id):
-            for connected_member in channel.members:
-                await connected_member.edit(voice_channel=self.afk_room)
+        if self.cache.is_owner(channel.id, member.id):
+            embed = state.strings.render("room_deleted", member=member.mention, room=channel.name)
+            self.reply(ctx, state, embed)
 
-            embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-            embed.add_field(name="Removed!", inline=True, value="Room was successfuly deleted!")
-            await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
-
-            self.db.delete_private_room(channel.id)
-            await channel.delete(reason="Deleted by user")
-        
-            logger.info(f"Deleted private room - {channel.name}")
+            self.cancel_room_deletion(state, channel)
+            await self.teardown_room(state, channel, "command")
 
     @commands.command()
-    @commands.cooldown(1, 120, commands.BucketType.user)
     async def join(self, ctx, mentioned_member:discord.Member):
         
+        state = self.guilds[ctx.guild.id]
         member = ctx.author
-        await ctx.message.delete()
+        self.delete_command(ctx)
         
-        if self.db.is_already_owner(mentioned_member.id):
-            embed = discord.Embed(title="🙋‍♂️ **Private rooms**", description=f"{member.name} wants to join the room!", color=discord.Color.magenta())
-            embed.add_field(name="Accept", inline=True, value="To approve request click on reaction 👍 or to deny request click on reaction 👎")
-            embed.set_footer(text="Request will expire in 2 minutes. If you deny the request, member won't be notified.")
-            embed.set_author(name=f"{member.name}")
-            
-            try:
-                message = await mentioned_member.send(embed=embed, delete_after=120)
-            except:
-                pass
-            await message.add_reaction("👍")
-            await message.add_reaction("👎")
+        if not self.cache.is_already_owner(state.id, mentioned_member.id):
+            self.reply_interaction(ctx, state.strings.render("join_no_room", owner=mentioned_member.name))
+            return
 
-            def check(reaction, user):
-                return user == mentioned_member and (str(reaction.emoji) == "👍" or str(reaction.emoji) == "👎")
+        # One open request per room owner, a few at once per member
+        if self.join_broker.is_pending(member.id, mentioned_member.id) or not self.join_broker.can_request(member.id):
+            self.reply_interaction(ctx, state.strings.render("join_already_requested", owner=mentioned_member.name))
+            return
 
-            reaction = "👎"
+        embed = state.strings.render("join_request", requester=member.name)
+        
+        try:
+            message = await self.scheduler.run("direct_message", lambda: mentioned_member.send(embed=embed), PRIORITY_MESSAGE)
+        except:
+            logger.debug("FAILED: Couldn't send join request to %s", mentioned_member.name)
+            self.reply_interaction(ctx, state.strings.render("join_not_delivered", owner=mentioned_member.name))
+            return
 
-            try:
-                reaction, user = await self.bot.wait_for("reaction_add", timeout=120.0, check=check)
-            except asyncio.TimeoutError:
-                await message.delete()
-                self.join.reset_cooldown(ctx)
-                return
+        self.join_broker.add(message.id, message.channel.id, state.id, member.id, mentioned_member.id)
+        self.scheduler.submit("reaction", lambda: message.add_reaction(ACCEPT_EMOJI), PRIORITY_MESSAGE)
+        self.scheduler.submit("reaction", lambda: message.add_reaction(DENY_EMOJI), PRIORITY_MESSAGE)
+        self.reply_interaction(ctx, state.strings.render("request_done"))
 
-            if str(reaction.emoji) != "👍":
-                await message.delete()
-                self.join.reset_cooldown(ctx)
-                return
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        # Raw event also covers requests sent before a restart, whose messages aren't cached anymore
+        self.join_broker.handle_reaction(payload.message_id, payload.user_id, str(payload.emoji))
 
-            await message.delete()
-            channel_id = self.db.get_owner_room(mentioned_member.id)
-            channel = discord.utils.get(self.guild.channels, id=channel_id)
-            
-            if channel:
-                if not self.db.is_open(channel.id):
-                    overwrite = {
-                        mentioned_member : discord.PermissionOverwrite(connect=True),
-                        self.guild.default_role : discord.PermissionOverwrite(connect=False)
-                    }
-                    invited_members = self.db.get_all_invited_members(channel.id)
-                    if invited_members:
-                        for item in invited_members:
-                            invited_member = discord.utils.get(self.guild.members, id=item[2])
-                            overwrite.update({
-                                invited_member : discord.PermissionOverwrite(connect=True)
-                            })
-                    overwrite.update({
-                        member : discord.PermissionOverwrite(connect=True)
-                    })
-
-                    self.db.invite_member(channel.id, member.id)
-                    await channel.edit(overwrites=overwrite)
-                    
-                    embed = discord.Embed(title="✅ **Private rooms**", description=f"{channel.name}", color=discord.Color.magenta())
-                    embed.add_field(name="Access granted!", inline=True, value=f"You were given access to the room!")
-                    embed.set_author(name=f"{self.guild.name}")
-                    try:
-                        await member.send(embed=embed, delete_after=120)
-                    except:
-                        pass
-                    
-                    logger.info(f"Member added to room - {channel.name}")
-
-            self.join.reset_cooldown(ctx)
+    def delete_join_message(self, request):
+        return self.scheduler.submit("delete_message", lambda: self.bot.http.delete_message(request.channel_id, request.message_id), PRIORITY_MESSAGE)
+
+    async def expire_join_request(self, request):
+        self.delete_join_message(request)
+
+    async def answer_join_request(self, request, accepted):
+        self.delete_join_message(request)
+
+        state = self.guilds.get(request.guild_id)
+        if not accepted or state is None:
+            return
+
+        channel_id = self.cache.get_owner_room(state.id, request.owner_id)
+        channel = state.lookup.get_channel(channel_id)
+        if channel is None:
+            return
+
+        member = await state.lookup.fetch_member(request.requester_id)
+        if member is None:
+            return
+
+        await self.mailboxes.call(("room", channel.id), "join_answer", lambda: self.grant_join(state, channel, member))
+
+    async def grant_join(self, state, channel, member):
+        # Room may have been unlocked or handed over while the answer waited
+        if self.cache.is_open(channel.id) or not self.cache.is_room_private(channel.id):
+            return
+
+        self.cache.invite_member(channel.id, member.id)
+        self.analytics.members_invited(state.id, channel.id, [member.id])
+        await self.sync_overwrites(state, channel)
+        
+        embed = state.strings.render("access_granted", room=channel.name, guild=state.guild.name)
+        self.send_direct(member, embed)
+        
+        logger.info("Member added to room - %s", channel.name, extra=fields(state.guild, channel, member))
 
     @commands.command()
+    @room_operation()
     async def transfer(self, ctx, mentioned_member:discord.Member):
 
+        state = self.guilds[ctx.guild.id]
         member = ctx.author
-        channel = member.voice.channel
-        await ctx.message.delete()
+        channel = ctx.room
+        self.delete_command(ctx)
 
         # Check if user is owner of the current channel
-        if self.db.is_owner(channel.id, member.id):
+        if self.cache.is_owner(channel.id, member.id):
 
             # Check if mentioned member is already owner of any channel
-            if self.db.is_already_owner(mentioned_member.id):
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name=":x: Denied!", inline=True, value="Member is already owner of the other private room!")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+            if self.cache.is_already_owner(state.id, mentioned_member.id):
+                embed = state.strings.render("transfer_already_owner", member=member.mention, room=channel.name)
+                self.reply(ctx, state, embed)
                 return
             
             else:
                 # Check if mentioned member is in the same channel as current owner
                 if not mentioned_member.voice or mentioned_member.voice.channel != channel:
-                    embed = discord.Embed(title=":lock: **Private rooms**", description=f"{member.mention} - {channel.name}", color=discord.Color.magenta())
-                    embed.add_field(name=":x: Denied!", inline=True, value="Member must be present in the room!")
-                    await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                    embed = state.strings.render("transfer_not_present", member=member.mention, room=channel.name)
+                    self.reply(ctx, state, embed)
                     return
                 
                 # Transfer ownership and set new name
-                self.db.transfer_ownership(member.id, mentioned_member.id)
-                logger.info(f"Transfering ownership of room {channel.name} from {member.name} to {mentioned_member.name}")
+                self.cache.transfer_ownership(state.id, member.id, mentioned_member.id)
+                self.analytics.ownership_transferred(state.id, channel.id, mentioned_member.id)
+                logger.info("Transfering ownership of room %s from %s to %s", channel.name, member.name, mentioned_member.name)
                 channel_name = f"[🔐] {mentioned_member.name}"
-                await channel.edit(name=channel_name)
+                self.rename_room(channel, channel_name)
 
                 # Send message to info room
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{mentioned_member.mention} - {channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Transfer successful!", inline=True, value=f"Member {mentioned_member.name} has become new owner of the room!")
-                await self.commands_room.send(embed=embed, delete_after=self.DEFAULT_DELETE_TIME)
+                embed = state.strings.render("transfer_done", member=mentioned_member.mention, room=channel.name, owner=mentioned_member.name)
+                self.reply(ctx, state, embed)
 
                 # Send message to new owner
-                embed = discord.Embed(title=":lock: **Private rooms**", description=f"{channel.name}", color=discord.Color.magenta())
-                embed.add_field(name="Rights transfered!", inline=True, value=f"{member.name} transfered ownership of the room {channel.name} to you!")
-                embed.set_author(name=f"{self.guild.name}")
-                try:
-                    await mentioned_member.send(embed=embed, delete_after=120)
-                except:
-                    pass
+                embed = state.strings.render("transfer_received", room=channel.name, previous_owner=member.name, guild=state.guild.name)
+                self.send_direct(mentioned_member, embed)
+
+                logger.info("Transfered ownership of room - %s", channel.name, extra=fields(state.guild, channel, mentioned_member))
+
+# INTERACTIONS
+
+    async def register_slash_commands(self, state):
+        try:
+            await register_commands(self.bot.http, self.application_id or self.bot.user.id, state.id)
+            logger.info("SUCCESS: Slash commands registered in %s", state.guild.name)
+        except discord.HTTPException as e:
+            logger.error("FAILED: Couldn't register slash commands in %s, is the bot invited with the applications.commands scope? - %s", state.guild.name, e)
 
-                logger.info(f"Transfered ownership of room - {channel.name}")
+    @commands.Cog.listener()
+    async def on_socket_response(self, message):
+        event = message.get("t")
+        if event == "INTERACTION_CREATE":
+            await self.handle_interaction(message["d"])
+        elif event == "READY":
+            application = message["d"].get("application")
+            if application:
+                self.application_id = int(application["id"])
+
+    async def handle_interaction(self, payload):
+        state = self.guilds.get(int(payload.get("guild_id") or 0))
+        if state is None or not state.config.SLASH_COMMANDS:
+            return
+
+        interaction = Interaction(self.bot.http, self.application_id or self.bot.user.id, payload)
+        handler = self.interaction_handlers.get(interaction.action)
+        if handler is None:
+            return
+
+        started = time.monotonic()
+        interaction.watch()
+        await self.ready.wait()
+
+        outcome = "ok"
+        try:
+            member = await state.lookup.fetch_member(interaction.user_id)
+            ctx = InteractionContext(interaction, state.guild, member)
+
+            # Prefix commands ignore non-owners silently, an interaction always needs an answer
+            if interaction.action in OWNER_ACTIONS and not self.owns_current_room(ctx.author):
+                outcome = "rejected"
+                interaction.reply(state.strings.render("not_owner"))
+                return
+
+            # Every handler answers what it did, silence means the room changed before the command got its turn
+            await handler(state, ctx, interaction)
+            if not interaction.answered:
+                outcome = "ignored"
+                interaction.reply(state.strings.render("nothing_changed"))
+
+        except Exception as e:
+            outcome = "error"
+            logger.error("FAILED: Interaction /room %s - %s", interaction.action, e, exc_info=e)
+            if not interaction.answered:
+                interaction.reply(state.strings.render("interaction_failed"))
+
+        finally:
+            commands_total.labels(interaction.action, outcome).inc()
+            command_latency.labels(interaction.action).observe(time.monotonic() - started)
+
+    def owns_current_room(self, member):
+        return member is not None and member.voice is not None and member.voice.channel is not None \
+            and self.cache.is_owner(member.voice.channel.id, member.id)
+
+    async def resolve_target(self, state, interaction, name):
+        target_id = int(interaction.options[name])
+        if str(target_id) in interaction.resolved.get("roles", {}):
+            return state.guild.get_role(target_id)
+        return await state.lookup.fetch_member(target_id)
+
+    async def interaction_unlock(self, state, ctx, interaction):
+        await self.open.callback(self, ctx)
+
+    async def interaction_lock(self, state, ctx, interaction):
+        await self.close.callback(self, ctx)
+
+    async def interaction_add(self, state, ctx, interaction):
+        target = await self.resolve_target(state, interaction, "target")
+        if target is None:
+            interaction.reply(state.strings.render("target_not_found"))
+            return
+        await self.invite.callback(self, ctx, target)
+
+    async def interaction_remove(self, state, ctx, interaction):
+        target = await self.resolve_target(state, interaction, "target")
+        if target is None:
+            interaction.reply(state.strings.render("target_not_found"))
+            return
+        await self.uninvite.callback(self, ctx, target)
+
+    async def interaction_rename(self, state, ctx, interaction):
+        await self.rename.callback(self, ctx, new_name=interaction.options["name"])
+
+    async def interaction_delete(self, state, ctx, interaction):
+        await self.delete.callback(self, ctx)
+
+    async def interaction_transfer(self, state, ctx, interaction):
+        member = await state.lookup.fetch_member(int(interaction.options["member"]))
+        if member is None:
+            interaction.reply(state.strings.render("target_not_found"))
+            return
+        await self.transfer.callback(self, ctx, member)
+
+    async def interaction_join(self, state, ctx, interaction):
+        owner = await state.lookup.fetch_member(int(interaction.options["owner"]))
+        if owner is None:
+            interaction.reply(state.strings.render("target_not_found"))
+            return
+        await self.join.callback(self, ctx, owner)
+
+    async def interaction_panel(self, state, ctx, interaction):
+        channel = ctx.author.voice.channel
+        invited_ids = self.cache.get_all_invited_members(channel.id)
+        invited = mention_list(state.guild.get_role(target_id) or f"<@{target_id}>" for target_id in invited_ids) or "-"
+        key = "room_panel_unlocked" if self.cache.is_open(channel.id) else "room_panel_locked"
+        interaction.reply(state.strings.render(key, room=channel.name, invited=invited), ROOM_BUTTONS)
 
     async def check_rooms(self):
 
+        # Clear out whatever piled up while the bot was offline, guilds are handled side by side
+        await asyncio.gather(*(self.reconcile_startup(state) for state in list(self.guilds.values())))
+
+        # Voice events handle room deletion, this sweep only catches drift (missed events)
         while True:
-            logger.debug("Checking rooms")
-
-            # Get all voice channels in private rooms category
-            channels_in_category = self.category.voice_channels
-            for channel in channels_in_category:
-
-                # If channel is empty, delete it
-                if channel != self.entry_room and not channel.members:
-                    invited_members = self.db.get_all_invited_members(channel.id)
-                    if invited_members:
-                        for item in invited_members:
-                            self.db.uninvite_member(channel.id, item[2])
-                    
-                    self.db.delete_private_room(channel.id)
-                    await channel.delete(reason="Empty channel")
-                    
-                    logger.info(f"Deleted empty private room {channel.name}")
-
-            def is_me(m):
-                return m.author != self.bot.user
-
-            logger.debug("Purging messages from commands room")
-            
-            try:
-                await self.commands_room.purge(limit=30, check=is_me)
-            except:
-                logger.debug("FAILED: Couldn't purge messages from commands room")
-                pass
-    
-            await asyncio.sleep(10)
\ No newline at end of file
+            await asyncio.sleep(self.RECONCILE_INTERVAL)
+
+            logger.debug("Reconciling rooms")
+
+            for state in self.guilds.values():
+                await self.reconcile_guild(state)
+
+    async def reconcile_startup(self, state):
+
+        started_at = time.monotonic()
+        channels = {channel.id: channel for channel in state.category.voice_channels} if state.category else {}
+
+        # Rows whose channel is gone are dropped together and committed right away
+        orphaned_rows = [room.room_id for room in self.cache.get_guild_rooms(state.id) if room.room_id not in channels]
+        self.drop_orphaned_rooms(state, orphaned_rows)
+        await self.db.flush()
+
+        # Empty rooms and channels left without a row are deleted without waiting out the grace period
+        stale_channels = [channel for channel in channels.values() if channel.id in state.startup_room_ids and state.is_private_room(channel) and not channel.members]
+        for channel in channels.values():
+            if state.is_private_room(channel) and channel.members and not self.cache.is_room_private(channel.id):
+                logger.warning("Room %s has no owner but is not empty, leaving it alone", channel.name)
+
+        semaphore = asyncio.Semaphore(STARTUP_DELETE_CONCURRENCY)
+
+        async def delete_stale(channel):
+            async with semaphore:
+                # Someone may have joined while it waited
+                if channel.members:
+                    return False
+                try:
+                    await self.teardown_room(state, channel, "stale", PRIORITY_BACKGROUND)
+                except Exception as e:
+                    logger.error("FAILED: Couldn't delete stale room %s - %s", channel.name, e)
+                    return False
+                return True
+
+        deleted = await asyncio.gather(*(delete_stale(channel) for channel in stale_channels))
+
+        state.pool.refill()
+        await self.purge_commands_room(state)
+
+        logger.info("SUCCESS: Reconciled %s in %.1fs, dropped %s orphaned rows and deleted %s stale rooms", state.guild.name, time.monotonic() - started_at, len(orphaned_rows), sum(deleted))
+
+    async def reconcile_guild(self, state):
+
+        # Catches deletions whose event never arrived, rooms missing in two sweeps in a row are dropped
+        missing = {room.room_id for room in self.cache.get_guild_rooms(state.id) if state.lookup.get_channel(room.room_id) is None}
+        self.drop_orphaned_rooms(state, list(missing & state.missing_room_ids))
+        state.missing_room_ids = missing - state.missing_room_ids
+
+        if state.category:
+            for channel in state.category.voice_channels:
+                if state.is_private_room(channel) and not channel.members:
+                    self.schedule_room_deletion(state, channel)
+
+        state.pool.refill()
+        await self.purge_commands_room(state)
+
+    def drop_orphaned_rooms(self, state, room_ids):
+        # Forgets rooms whose channel no longer exists
+        for room_id in room_ids:
+            self.analytics.room_deleted(state.id, room_id)
+        self.cache.delete_private_rooms(room_ids)
+        if room_ids:
+            logger.info("Dropped %s rooms whose channel is gone", len(room_ids), extra=fields(state.guild))
+
+    async def purge_commands_room(self, state):
+        # Slash commands leave nothing behind in the room
+        if not state.config.PREFIX_COMMANDS:
+            return
+
+        def is_me(m):
+            return m.author != self.bot.user
+
+        logger.debug("Purging messages from commands room in %s", state.guild.name)
+        
+        try:
+            await self.scheduler.run("purge", lambda: state.commands_room.purge(limit=30, check=is_me), PRIORITY_MESSAGE)
+        except:
+            logger.debug("FAILED: Couldn't purge messages from commands room")
+            pass
@@ -0,0 +1,160 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+
+from lib.Logger import *
+from lib.Metrics import metrics
+
+# Lower number runs first
+PRIORITY_MOVE = 0
+PRIORITY_CHANNEL = 1
+PRIORITY_RENAME = 2
+PRIORITY_MESSAGE = 3
+PRIORITY_BACKGROUND = 4
+
+# Known Discord limits discord.py can only learn about by hitting them, (requests, seconds) per bucket
+ROUTE_LIMITS = {
+    "rename": (2, 600),
+}
+
+queue_depth = metrics.gauge("scheduler_queue_depth", "Actions waiting in the outbound queue")
+queue_wait = metrics.histogram("scheduler_wait_seconds", "Time actions spent queued before running", ("route",))
+actions_total = metrics.counter("scheduler_actions_total", "Actions executed by route and outcome", ("route", "outcome"))
+actions_coalesced = metrics.counter("scheduler_actions_coalesced_total", "Actions replaced by a newer action for the same target", ("route",))
+
+class Bucket:
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.history = deque()
+
+    def delay(self):
+        now = time.monotonic()
+        while self.history and now - self.history[0] >= self.period:
+            self.history.popleft()
+        if len(self.history) < self.limit:
+            return 0
+        return self.period - (now - self.history[0])
+
+    def consume(self):
+        self.history.append(time.monotonic())
+
+class Action:
+
+    __slots__ = ("priority", "sequence", "route", "key", "bucket", "factory", "future", "enqueued_at")
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+class ActionScheduler:
+
+    # Single outbound queue for every REST mutation, actions sharing a key are coalesced
+    # into the newest one and routes with known limits wait for their bucket
+
+    def __init__(self, concurrency=4, limits=ROUTE_LIMITS):
+        self.concurrency = concurrency
+        self.limits = limits
+
+        self.queue = None
+        self.workers = []
+        self.pending = {}
+        self.buckets = {}
+        self.sequence = itertools.count()
+
+    def start(self):
+        if self.workers:
+            return
+        loop = asyncio.get_event_loop()
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [loop.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    def submit(self, route, factory, priority=PRIORITY_CHANNEL, key=None, bucket=None):
+        # factory returns the coroutine to run, it is only called once the action is executed
+        self.start()
+
+        if key is not None:
+            action = self.pending.get(key)
+            if action is not None:
+                action.factory = factory
+                actions_coalesced.labels(route).inc()
+                return action.future
+
+        action = Action()
+        action.priority = priority
+        action.sequence = next(self.sequence)
+        action.route = route
+        action.key = key
+        action.bucket = (route, bucket) if route in self.limits else None
+        action.factory = factory
+        action.future = asyncio.get_event_loop().create_future()
+        action.future.add_done_callback(self.discard_result)
+        action.enqueued_at = time.monotonic()
+
+        if key is not None:
+            self.pending[key] = action
+
+        self.enqueue(action)
+        return action.future
+
+    async def run(self, route, factory, priority=PRIORITY_CHANNEL, key=None, bucket=None):
+        return await self.submit(route, factory, priority, key, bucket)
+
+    def enqueue(self, action):
+        self.queue.put_nowait(action)
+        queue_depth.set(self.queue.qsize())
+
+    def get_bucket(self, action):
+        if action.bucket is None:
+            return None
+        bucket = self.buckets.get(action.bucket)
+        if bucket is None:
+            bucket = self.buckets[action.bucket] = Bucket(*self.limits[action.route])
+        return bucket
+
+    def discard_result(self, future):
+        # Fire-and-forget callers never read the future, don't let asyncio complain about it
+        if not future.cancelled():
+            future.exception()
+
+    async def worker(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            action = await self.queue.get()
+            queue_depth.set(self.queue.qsize())
+
+            bucket = self.get_bucket(action)
+            if bucket is not None:
+                delay = bucket.delay()
+                if delay > 0:
+                    # Park the action without holding a worker, it keeps collecting newer state meanwhile
+                    loop.call_later(delay, self.enqueue, action)
+                    continue
+                bucket.consume()
+
+            if action.key is not None and self.pending.get(action.key) is action:
+                del self.pending[action.key]
+
+            queue_wait.labels(action.route).observe(time.monotonic() - action.enqueued_at)
+
+            try:
+                result = await action.factory()
+            except asyncio.CancelledError:
+                action.future.cancel()
+                raise
+            except Exception as e:
+                actions_total.labels(action.route, "error").inc()
+                logger.debug("FAILED: Scheduled %s action - %s", action.route, e)
+                if not action.future.done():
+                    action.future.set_exception(e)
+            else:
+                actions_total.labels(action.route, "ok").inc()
+                if not action.future.done():
+                    action.future.set_result(result)
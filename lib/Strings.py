@@ -0,0 +1,116 @@
+import json
+import os
+from collections import OrderedDict
+
+import discord
+
+from lib.Logger import *
+
+STRINGS_DIR = "./assets/strings"
+DEFAULT_LANGUAGE = "en"
+EMBED_COLOR = discord.Color.magenta()
+
+# Rendered embeds kept per language, repeated responses (same room, same member) are sent again as is
+RENDER_CACHE_SIZE = 256
+
+class Placeholders(dict):
+
+    # Leaves unknown placeholders in place, so constants can be filled in ahead of time
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+def compile_text(text, constants):
+    # Returns the text with constants filled in and whether anything is left to format per response
+    if not text:
+        return discord.Embed.Empty, False
+    text = text.format_map(constants)
+    return text, "{" in text
+
+def fill(text, dynamic, values):
+    return text.format_map(values) if dynamic else text
+
+class EmbedTemplate:
+
+    # One response parsed once at startup. Templates without placeholders are kept as a finished embed,
+    # the rest only format the parts that hold placeholders.
+
+    __slots__ = ("title", "description", "fields", "inline", "footer", "author", "embed")
+
+    def __init__(self, data, constants=None):
+        constants = Placeholders(constants or {})
+
+        self.title = compile_text(data.get("title"), constants)
+        self.description = compile_text(data.get("description"), constants)
+        self.fields = [compile_text(name, constants) + compile_text(value, constants) for name, value in data.get("fields", ())]
+        self.inline = data.get("inline", True)
+        self.footer = compile_text(data.get("footer"), constants)
+        self.author = compile_text(data.get("author"), constants)
+
+        static = not any(dynamic for _, dynamic in (self.title, self.description, self.footer, self.author)) \
+            and not any(name_dynamic or value_dynamic for _, name_dynamic, _, value_dynamic in self.fields)
+        self.embed = self.build(None) if static else None
+
+    def build(self, values):
+        embed = discord.Embed(title=fill(*self.title, values), description=fill(*self.description, values), color=EMBED_COLOR)
+        for name, name_dynamic, value, value_dynamic in self.fields:
+            embed.add_field(name=fill(name, name_dynamic, values), value=fill(value, value_dynamic, values), inline=self.inline)
+        if self.footer[0]:
+            embed.set_footer(text=fill(*self.footer, values))
+        if self.author[0]:
+            embed.set_author(name=fill(*self.author, values))
+        return embed
+
+class StringTable:
+
+    def __init__(self, language, templates, cache_size=RENDER_CACHE_SIZE):
+        self.language = language
+        self.templates = templates
+        self.cache_size = cache_size
+        self.rendered = OrderedDict()
+
+    def render(self, key, **values):
+        # Embeds are shared between responses, callers must not modify what they get back
+        template = self.templates[key]
+        if template.embed is not None:
+            return template.embed
+
+        cache_key = (key, *values.items())
+        embed = self.rendered.get(cache_key)
+        if embed is not None:
+            self.rendered.move_to_end(cache_key)
+            return embed
+
+        embed = self.rendered[cache_key] = template.build(values)
+        while len(self.rendered) > self.cache_size:
+            self.rendered.popitem(last=False)
+        return embed
+
+class StringTables:
+
+    # Loads every language once, keys missing from a translation fall back to the default language
+
+    def __init__(self, directory=STRINGS_DIR, constants=None):
+        self.directory = directory
+        self.constants = constants or {}
+        self.tables = {}
+
+    def read(self, language):
+        with open(os.path.join(self.directory, f"{language}.json"), "r", encoding="utf8") as strings:
+            return json.load(strings)
+
+    def get(self, language=DEFAULT_LANGUAGE):
+        table = self.tables.get(language)
+        if table is not None:
+            return table
+
+        data = self.read(DEFAULT_LANGUAGE)
+        if language != DEFAULT_LANGUAGE:
+            try:
+                data.update(self.read(language))
+            except (OSError, ValueError) as e:
+                logger.error("FAILED: Couldn't load strings for language %s, using %s - %s", language, DEFAULT_LANGUAGE, e)
+
+        table = StringTable(language, {key: EmbedTemplate(template, self.constants) for key, template in data.items()})
+        self.tables[language] = table
+        logger.debug("Loaded %s response templates for language %s", len(table.templates), language)
+        return table
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+from lib.Logger import *
+from lib.Metrics import metrics
+
+voice_events = metrics.counter("voice_events_total", "Voice state updates received")
+voice_events_dropped = metrics.counter("voice_events_dropped_total", "Voice state updates that caused no room work", ("reason",))
+voice_transitions = metrics.counter("voice_transitions_total", "Coalesced channel changes handed to the room logic")
+
+class Transition:
+
+    # Where a member started and ended up within one window, plus channels passed through on the way
+
+    __slots__ = ("member", "before", "after", "passed", "changed_at", "handle")
+
+    def __init__(self, member, before, after):
+        self.member = member
+        self.before = before
+        self.after = after
+        self.passed = []
+        self.changed_at = time.monotonic()
+        self.handle = None
+
+class VoiceDebouncer:
+
+    # Channel changes of one member are gathered for a short window after the first one and handled as a single
+    # move from the first channel to the last. Reconnects and quick bounces end where they began and cost nothing.
+    # Updates that keep the channel (mute, deafen, video, ...) are dropped right away.
+
+    def __init__(self, handler, window=0.5):
+        # handler(member, before, after, passed, changed_at) is awaited once per window
+        self.handler = handler
+        self.window = window
+        self.pending = {}
+        self.tasks = set()
+
+    def push(self, key, member, before, after):
+        voice_events.inc()
+
+        if before == after:
+            voice_events_dropped.labels("unchanged").inc()
+            return
+
+        transition = self.pending.get(key)
+        if transition is not None:
+            voice_events_dropped.labels("collapsed").inc()
+            transition.passed.append(transition.after)
+            transition.member = member
+            transition.after = after
+            transition.changed_at = time.monotonic()
+            return
+
+        transition = Transition(member, before, after)
+        if self.window <= 0:
+            self.dispatch(transition)
+            return
+
+        self.pending[key] = transition
+        transition.handle = asyncio.get_event_loop().call_later(self.window, self.flush, key)
+
+    def flush(self, key):
+        transition = self.pending.pop(key, None)
+        if transition is None:
+            return
+
+        # Back where it started, only channels passed through may need a look
+        if transition.before == transition.after and not any(channel is not None and channel != transition.after for channel in transition.passed):
+            voice_events_dropped.labels("flapped").inc()
+            return
+
+        self.dispatch(transition)
+
+    def dispatch(self, transition):
+        voice_transitions.inc()
+        task = asyncio.get_event_loop().create_task(self.run(transition))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, transition):
+        try:
+            await self.handler(transition.member, transition.before, transition.after, transition.passed, transition.changed_at)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("FAILED: Couldn't handle voice update of %s - %s", transition.member, e, extra=fields(transition.member.guild, None, transition.member))
+
+    def stop(self):
+        for transition in self.pending.values():
+            transition.handle.cancel()
+        self.pending.clear()
+        for task in list(self.tasks):
+            task.cancel()
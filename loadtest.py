@@ -0,0 +1,903 @@
+# loadtest.py
+import argparse
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+# Everything the cog touches on disk goes into a scratch directory, must be set before lib is imported
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix="rooms-loadtest-")
+os.environ["SETTINGS_PATH"] = os.path.join(WORK_DIR, "settings.json")
+os.environ["DATABASE_PATH"] = os.path.join(WORK_DIR, "bot.db")
+os.environ["LOG_FILE"] = os.path.join(WORK_DIR, "log.log")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import discord
+from discord.ext import commands
+
+from lib.Logger import *
+from lib.Logger import DeferredQueueHandler, JsonFormatter
+from lib.FakeGateway import FakeGateway
+from lib.Database import Database
+from lib.Rooms import Rooms
+from lib.RoomCache import RoomCache
+from lib.Profanity import ProfanityFilter
+from lib.Metrics import metrics
+
+# Drives the Rooms cog against an in-process fake Discord and reports latency and API calls per scenario.
+# Numbers are only comparable between runs with the same --latency and rate limit settings.
+
+# Rough per-route limits, Discord doesn't publish most of them
+RATE_LIMITS = {
+    ("POST", "guilds/{id}/channels"): (50, 5),
+    ("PATCH", "channels/{id}"): (5, 5),
+    ("PUT", "channels/{id}/permissions/{id}"): (10, 5),
+}
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Harness:
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.bot = None
+        self.cog = None
+        self.connect_task = None
+
+        self.sent = {}
+        self.finished = {}
+
+    async def start(self, lean=False, **options):
+        discord.http.Route.BASE = f"{self.gateway.url}/api/v7"
+        self.gateway.write_settings(os.environ["SETTINGS_PATH"], **options)
+
+        intents = discord.Intents.default()
+        intents.members = True
+        intents.reactions = True
+
+        # Same member cache as bot.py with LEAN_MODE
+        bot_options = dict(command_prefix="!", intents=intents, help_command=None, case_insensitive=True)
+        if lean:
+            bot_options["chunk_guilds_at_startup"] = False
+            bot_options["member_cache_flags"] = discord.MemberCacheFlags(online=False, voice=True, joined=False)
+
+        self.bot = commands.Bot(**bot_options)
+        self.cog = Rooms(self.bot)
+        self.bot.add_cog(self.cog)
+        self.bot.add_listener(self.on_command_completion)
+        self.bot.add_listener(self.on_command_error)
+
+        started = time.monotonic()
+        await self.bot.login("fake")
+        self.connect_task = asyncio.get_event_loop().create_task(self.bot.connect(reconnect=False))
+        await self.cog.ready.wait()
+        return time.monotonic() - started
+
+    async def stop(self):
+        self.bot.remove_cog("Rooms")
+        await self.bot.close()
+        self.connect_task.cancel()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(os.environ["DATABASE_PATH"] + suffix)
+            except FileNotFoundError:
+                pass
+
+    async def on_command_completion(self, ctx):
+        self.finished[ctx.message.id] = time.monotonic()
+
+    async def on_command_error(self, ctx, error):
+        self.finished[ctx.message.id] = time.monotonic()
+
+    async def command(self, guild, member_id, content, mentions=()):
+        message = await self.gateway.send_message(guild, member_id, guild.commands_room_id, content, mentions)
+        self.sent[int(message["id"])] = time.monotonic()
+
+    async def interact(self, guild, member_id, name, options=()):
+        # Slash commands count as finished once the bot answers the interaction
+        interaction = await self.gateway.interact(guild, member_id, name, options)
+        self.sent[int(interaction["id"])] = time.monotonic()
+
+    def finished_at(self, sent_id):
+        return self.finished.get(sent_id) or self.gateway.interaction_answers.get(sent_id)
+
+    async def wait_for(self, condition, timeout):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def settle(self, timeout, quiet=1):
+        # Waits until no REST call arrived for quiet seconds, returns the time of the last one
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            last = self.gateway.requests[-1][0] if self.gateway.requests else 0
+            if time.monotonic() - last >= quiet:
+                return last
+            await asyncio.sleep(0.1)
+        return time.monotonic()
+
+    async def wait_for_commands(self, timeout):
+        return await self.wait_for(lambda: all(self.finished_at(sent_id) for sent_id in self.sent), timeout)
+
+    def command_latencies(self):
+        return [self.finished_at(sent_id) - sent for sent_id, sent in self.sent.items() if self.finished_at(sent_id)]
+
+    def moves(self, guild, since=0):
+        # First move out of the entry room for every member
+        moved = {}
+        for at, guild_id, member_id, channel_id in self.gateway.voice_log:
+            if at >= since and guild_id == guild.id and channel_id not in (None, guild.entry_room_id) and member_id not in moved:
+                moved[member_id] = (at, channel_id)
+        return moved
+
+    def api_calls(self, since=0):
+        calls = Counter()
+        limited = 0
+        for at, method, template, status, _ in self.gateway.requests:
+            if at < since:
+                continue
+            if status == 429:
+                limited += 1
+            else:
+                calls[f"{method} {template}"] += 1
+        return calls, limited
+
+class LagMonitor:
+
+    # Wakes up every interval and records how late it was, which is how long something held the event loop.
+    # The fake gateway shares the loop with the bot, so its own work shows up in the lag too.
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0, time.monotonic() - expected))
+
+    def start(self):
+        self.task = asyncio.get_event_loop().create_task(self.run())
+
+    def stop(self):
+        self.task.cancel()
+
+    def summary(self):
+        return {"max_lag_ms": round(max(self.lags, default=0) * 1000, 1), "p99_lag_ms": round(percentile(self.lags, 0.99) * 1000, 1)}
+
+def report(name, elapsed, operations, latencies, calls, limited, extra=None):
+    result = {
+        "scenario": name,
+        "seconds": round(elapsed, 2),
+        "operations": operations,
+        "throughput": round(operations / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "api_calls": sum(calls.values()),
+        "rate_limited": limited,
+        "calls_by_route": dict(calls.most_common()),
+    }
+    result.update(extra or {})
+
+    print(f"\n{name}")
+    print(f"  {operations} operations in {elapsed:.2f}s ({result['throughput']}/s), p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms")
+    print(f"  {result['api_calls']} API calls, {limited} answered with 429")
+    for route, count in calls.most_common():
+        print(f"    {count:6} {route}")
+    for key, value in (extra or {}).items():
+        print(f"  {key}: {value}")
+    return result
+
+async def entry_rush(args):
+    # N users join the entry room spread evenly over a few seconds, latency is join to being moved
+    users, spread = args.users, args.spread
+    gateway = FakeGateway(guild_count=1, member_count=users, latency=args.latency, rate_limits=args.rate_limits)
+    await gateway.start()
+    harness = Harness(gateway)
+    await harness.start()
+
+    guild = gateway.guilds[0]
+    started = time.monotonic()
+    joined = {}
+    for index, member_id in enumerate(guild.member_ids()):
+        await asyncio.sleep(max(0, started + index * spread / users - time.monotonic()))
+        joined[member_id] = time.monotonic()
+        await gateway.join_voice(guild, member_id, guild.entry_room_id)
+
+    await harness.wait_for(lambda: len(harness.moves(guild, started)) >= users, args.timeout)
+    moved = harness.moves(guild, started)
+    elapsed = max((at for at, _ in moved.values()), default=time.monotonic()) - started
+
+    latencies = [at - joined[member_id] for member_id, (at, _) in moved.items()]
+    calls, limited = harness.api_calls(started)
+    await harness.stop()
+    await gateway.stop()
+    return report(f"entry_rush: {users} users join within {spread:g}s", elapsed, len(moved), latencies, calls, limited, {"not_moved": users - len(moved)})
+
+async def lock_storm(args):
+    # Owners each invite a group with one !add, then everybody toggles lock and unlock.
+    # With --slash the same is done through /room, one add per invited member.
+    owners, invites, rounds = args.owners, args.invites, args.rounds
+    gateway = FakeGateway(guild_count=1, member_count=owners * (invites + 1), latency=args.latency, rate_limits=args.rate_limits)
+    await gateway.start()
+    harness = Harness(gateway)
+    await harness.start()
+
+    guild = gateway.guilds[0]
+    member_ids = list(guild.member_ids())
+    owner_ids = member_ids[:owners]
+    for owner_id in owner_ids:
+        await gateway.join_voice(guild, owner_id, guild.entry_room_id)
+    await harness.wait_for(lambda: len(harness.moves(guild)) >= owners, args.timeout)
+
+    started = time.monotonic()
+    for index, owner_id in enumerate(owner_ids):
+        invited = member_ids[owners + index * invites:owners + (index + 1) * invites]
+        if args.slash:
+            for member_id in invited:
+                await harness.interact(guild, owner_id, "add", {"target": member_id})
+        else:
+            await harness.command(guild, owner_id, "!add " + " ".join(f"<@{member_id}>" for member_id in invited), invited)
+    await harness.wait_for_commands(args.timeout)
+
+    for round_number in range(rounds):
+        for owner_id in owner_ids:
+            action = "unlock" if round_number % 2 == 0 else "lock"
+            if args.slash:
+                await harness.interact(guild, owner_id, action)
+            else:
+                await harness.command(guild, owner_id, "!" + action)
+        await harness.wait_for_commands(args.timeout)
+
+    # Overwrite pushes run behind the commands, wait for the fake to go quiet before counting
+    finished = await harness.settle(args.timeout)
+    elapsed = finished - started
+
+    latencies = harness.command_latencies()
+    calls, limited = harness.api_calls(started)
+    await harness.stop()
+    await gateway.stop()
+    return report(f"lock_storm{' (slash)' if args.slash else ''}: {owners} owners, {owners * invites} invites, {rounds} lock/unlock rounds", elapsed, len(latencies), latencies, calls, limited, {"unfinished_commands": len(harness.sent) - len(latencies)})
+
+async def stale_restart(args):
+    # Bot comes back to a category full of empty rooms plus rows whose channels are long gone
+    rooms = args.rooms
+    gateway = FakeGateway(guild_count=1, room_count=rooms, latency=args.latency, rate_limits=args.rate_limits)
+    await gateway.start()
+    guild = gateway.guilds[0]
+
+    db = Database()
+    for index, room_id in enumerate(guild.room_ids):
+        db.add_private_room(room_id, guild.id + 1 + index, guild.id)
+        db.add_private_room(room_id + 1, guild.id + 1 + rooms + index, guild.id)
+    await db.flush()
+    db.close()
+
+    harness = Harness(gateway)
+    started = time.monotonic()
+    ready = await harness.start()
+
+    def deleted():
+        return sum(1 for _, method, template, status, _ in gateway.requests if method == "DELETE" and template == "channels/{id}" and status != 429)
+
+    await harness.wait_for(lambda: deleted() >= rooms, args.timeout)
+    elapsed = time.monotonic() - started
+
+    calls, limited = harness.api_calls(started)
+    await harness.stop()
+    await gateway.stop()
+    return report(f"stale_restart: {rooms} stale rooms and {rooms} orphaned rows", elapsed, deleted(), [], calls, limited, {"ready_seconds": round(ready, 2)})
+
+async def teardown(args):
+    # Owners of full rooms all use !delete at once, latency is command to channel deletion
+    rooms, members = args.teardown_rooms, args.room_members
+    gateway = FakeGateway(guild_count=1, member_count=rooms * (members + 1), latency=args.latency, rate_limits=args.rate_limits)
+    await gateway.start()
+    harness = Harness(gateway)
+    await harness.start(MOVE_TO_AFK=not args.no_afk)
+
+    guild = gateway.guilds[0]
+    member_ids = list(guild.member_ids())
+    owner_ids = member_ids[:rooms]
+    for owner_id in owner_ids:
+        await gateway.join_voice(guild, owner_id, guild.entry_room_id)
+    await harness.wait_for(lambda: len(harness.moves(guild)) >= rooms, args.timeout)
+
+    room_ids = {owner_id: channel_id for owner_id, (_, channel_id) in harness.moves(guild).items()}
+    for index, owner_id in enumerate(owner_ids):
+        for member_id in member_ids[rooms + index * members:rooms + (index + 1) * members]:
+            await gateway.join_voice(guild, member_id, room_ids[owner_id])
+    await asyncio.sleep(1)
+
+    started = time.monotonic()
+    for owner_id in owner_ids:
+        await harness.command(guild, owner_id, "!delete")
+    await harness.wait_for(lambda: all(room_id in gateway.deleted_channels for room_id in room_ids.values()), args.timeout)
+    await harness.settle(args.timeout)
+
+    deleted = [gateway.deleted_channels[room_id] for room_id in room_ids.values() if room_id in gateway.deleted_channels]
+    elapsed = max(deleted, default=time.monotonic()) - started
+    latencies = [at - started for at in deleted]
+    calls, limited = harness.api_calls(started)
+    await harness.stop()
+    await gateway.stop()
+    mode = "disconnected by deletion" if args.no_afk else "moved to AFK"
+    return report(f"teardown: {rooms} rooms with {members} members each, {mode}", elapsed, len(deleted), latencies, calls, limited)
+
+async def flapping(args):
+    # Owners sitting in their rooms reconnect, toggle mute and bounce through the entry room a few times,
+    # latency is the last event of a member to the bot going quiet again
+    owners, bounces = args.flappers, args.bounces
+    gateway = FakeGateway(guild_count=1, member_count=owners, latency=args.latency, rate_limits=args.rate_limits)
+    await gateway.start()
+    harness = Harness(gateway)
+    await harness.start(VOICE_DEBOUNCE_SECONDS=0 if args.no_debounce else 0.5)
+
+    guild = gateway.guilds[0]
+    owner_ids = list(guild.member_ids())
+    for owner_id in owner_ids:
+        await gateway.join_voice(guild, owner_id, guild.entry_room_id)
+    await harness.wait_for(lambda: len(harness.moves(guild)) >= owners, args.timeout)
+    await harness.settle(args.timeout)
+    room_ids = {owner_id: channel_id for owner_id, (_, channel_id) in harness.moves(guild).items()}
+
+    def counted():
+        events = metrics.metrics["voice_events_total"].value
+        dropped = sum(child.value for child in metrics.metrics["voice_events_dropped_total"].children.values())
+        return events, dropped, metrics.metrics["voice_transitions_total"].value
+    events_before, dropped_before, transitions_before = counted()
+
+    async def flap(owner_id):
+        room_id = room_ids[owner_id]
+        for _ in range(bounces):
+            await gateway.join_voice(guild, owner_id, room_id, self_mute=True)
+            await gateway.join_voice(guild, owner_id, room_id, self_mute=False)
+            await gateway.join_voice(guild, owner_id, None)
+            await asyncio.sleep(0.05)
+            await gateway.join_voice(guild, owner_id, room_id)
+            await asyncio.sleep(0.05)
+            await gateway.join_voice(guild, owner_id, guild.entry_room_id)
+            await asyncio.sleep(0.05)
+            await gateway.join_voice(guild, owner_id, room_id)
+        return time.monotonic()
+
+    started = time.monotonic()
+    finished = await asyncio.gather(*(flap(owner_id) for owner_id in owner_ids))
+    # Nothing reaches the REST API while updates wait out the debounce window
+    await asyncio.sleep(1)
+    quiet = await harness.settle(args.timeout)
+    elapsed = max(quiet, max(finished)) - started
+
+    events, dropped, transitions = (after - before for after, before in zip(counted(), (events_before, dropped_before, transitions_before)))
+    latencies = [max(0, quiet - at) for at in finished]
+    calls, limited = harness.api_calls(started)
+    lost = sum(1 for room_id in room_ids.values() if room_id in gateway.deleted_channels)
+    await harness.stop()
+    await gateway.stop()
+    mode = "no debounce" if args.no_debounce else "debounced"
+    return report(f"flapping: {owners} owners bounce {bounces} times ({mode})", elapsed, events, latencies, calls, limited,
+        {"events_dropped": dropped, "transitions_handled": transitions, "rooms_lost": lost})
+
+async def command_flood(args):
+    # Owners fire lock/unlock as fast as the spread allows, checks that the loop keeps breathing meanwhile.
+    # Heartbeats go out late once the loop stalls for seconds, --max-lag is well below that.
+    commands_count, owners = args.commands, args.flood_owners
+    gateway = FakeGateway(guild_count=1, member_count=owners, latency=args.latency, rate_limits=args.rate_limits)
+    await gateway.start()
+    harness = Harness(gateway)
+    await harness.start()
+
+    guild = gateway.guilds[0]
+    owner_ids = list(guild.member_ids())
+    for owner_id in owner_ids:
+        await gateway.join_voice(guild, owner_id, guild.entry_room_id)
+    await harness.wait_for(lambda: len(harness.moves(guild)) >= owners, args.timeout)
+    await harness.settle(args.timeout)
+
+    monitor = LagMonitor()
+    monitor.start()
+    started = time.monotonic()
+    for index in range(commands_count):
+        await asyncio.sleep(max(0, started + index * args.flood_spread / commands_count - time.monotonic()))
+        await harness.command(guild, owner_ids[index % owners], "!lock" if index // owners % 2 else "!unlock")
+    await harness.wait_for_commands(args.timeout)
+    finished = await harness.settle(args.timeout)
+    monitor.stop()
+    elapsed = finished - started
+
+    latencies = harness.command_latencies()
+    calls, limited = harness.api_calls(started)
+    await harness.stop()
+    await gateway.stop()
+
+    extra = dict(monitor.summary(), unfinished_commands=len(harness.sent) - len(latencies))
+    if max(monitor.lags, default=0) > args.max_lag:
+        extra["failed"] = f"event loop stalled for {extra['max_lag_ms']} ms, allowed {args.max_lag * 1000:g} ms"
+    return report(f"command_flood: {commands_count} commands from {owners} owners within {args.flood_spread:g}s", elapsed, len(latencies), latencies, calls, limited, extra)
+
+# Only calls that create a room or touch its overwrites count in the overwrites scenario
+OVERWRITE_ROUTES = ("POST guilds/{id}/channels", "PATCH channels/{id}", "PUT channels/{id}/permissions/{id}", "DELETE channels/{id}/permissions/{id}")
+CONNECT = discord.Permissions(connect=True).value
+
+async def overwrites(args):
+    # One owner walks through the room commands, every step checks the REST calls it made, their payload
+    # and the overwrites the channel ends up with. Single changes must go out as one PUT, several as one PATCH
+    # and commands that change nothing must not call the API at all.
+    gateway = FakeGateway(guild_count=1, member_count=4, latency=args.latency, rate_limits=args.rate_limits)
+    await gateway.start()
+    harness = Harness(gateway)
+    await harness.start(lean=args.lean)
+
+    guild = gateway.guilds[0]
+    owner_id, first_id, second_id, third_id = guild.member_ids()
+    mention = lambda *member_ids: " ".join(f"<@{member_id}>" for member_id in member_ids)
+    locked, unlocked, allowed, denied = (0, CONNECT), (CONNECT, 0), (CONNECT, 0), (0, CONNECT)
+
+    # (label, command or None to join the entry room, mentioned members, expected calls by route, expected overwrites)
+    steps = [
+        ("create", None, (), {"POST guilds/{id}/channels": 1}, {guild.id: locked, owner_id: allowed}),
+        ("invite one", f"!add {mention(first_id)}", (first_id,), {"PUT channels/{id}/permissions/{id}": 1}, {guild.id: locked, owner_id: allowed, first_id: allowed}),
+        ("invite again", f"!add {mention(first_id)}", (first_id,), {}, {guild.id: locked, owner_id: allowed, first_id: allowed}),
+        ("invite two", f"!add {mention(second_id, third_id)}", (second_id, third_id), {"PATCH channels/{id}": 1}, {guild.id: locked, owner_id: allowed, first_id: allowed, second_id: allowed, third_id: allowed}),
+        ("uninvite", f"!remove {mention(first_id)}", (first_id,), {"PUT channels/{id}/permissions/{id}": 1}, {guild.id: locked, owner_id: allowed, first_id: denied, second_id: allowed, third_id: allowed}),
+        ("unlock", "!unlock", (), {"PATCH channels/{id}": 1}, {guild.id: unlocked, owner_id: allowed, second_id: allowed, third_id: allowed}),
+        ("unlock again", "!unlock", (), {}, {guild.id: unlocked, owner_id: allowed, second_id: allowed, third_id: allowed}),
+        ("lock", "!lock", (), {"PUT channels/{id}/permissions/{id}": 1}, {guild.id: locked, owner_id: allowed, second_id: allowed, third_id: allowed}),
+        ("lock again", "!lock", (), {}, {guild.id: locked, owner_id: allowed, second_id: allowed, third_id: allowed}),
+    ]
+
+    failures = []
+    payloads = {}
+    started = time.monotonic()
+    for label, content, mentions, expected_calls, expected_overwrites in steps:
+        step_started = time.monotonic()
+        if content is None:
+            await gateway.join_voice(guild, owner_id, guild.entry_room_id)
+            await harness.wait_for(lambda: harness.moves(guild), args.timeout)
+        else:
+            await harness.command(guild, owner_id, content, mentions)
+            await harness.wait_for_commands(args.timeout)
+        await harness.settle(args.timeout, quiet=0.5)
+
+        made = [(f"{method} {template}", body) for at, method, template, status, body in gateway.requests if at >= step_started and status != 429 and f"{method} {template}" in OVERWRITE_ROUTES]
+        calls = Counter(route for route, _ in made)
+        payloads[label] = sum(len(json.dumps(body)) for _, body in made if body)
+        if calls != Counter(expected_calls):
+            failures.append(f"{label} made {dict(calls)}, expected {expected_calls}")
+
+        _, room_id = harness.moves(guild)[owner_id]
+        current = {int(overwrite["id"]): (int(overwrite["allow_new"]) & CONNECT, int(overwrite["deny_new"]) & CONNECT) for overwrite in guild.channels[room_id]["permission_overwrites"]}
+        if current != expected_overwrites:
+            failures.append(f"{label} left overwrites {current}, expected {expected_overwrites}")
+
+    elapsed = time.monotonic() - started
+    latencies = harness.command_latencies()
+    calls, limited = harness.api_calls(started)
+    await harness.stop()
+    await gateway.stop()
+
+    extra = {"payload_bytes": payloads}
+    if failures:
+        extra["failed"] = "; ".join(failures)
+    return report(f"overwrites: room commands of one owner{' (lean)' if args.lean else ''}", elapsed, len(steps), latencies, calls, limited, extra)
+
+class StallingFileHandler(logging.FileHandler):
+
+    # Every stall_every-th record blocks the writing thread for stall seconds, like a busy disk or network share
+
+    def __init__(self, path, stall, stall_every):
+        super().__init__(path, encoding="utf-8")
+        self.stall = stall
+        self.stall_every = stall_every
+        self.written = 0
+
+    def emit(self, record):
+        super().emit(record)
+        self.written += 1
+        if self.stall and self.written % self.stall_every == 0:
+            time.sleep(self.stall)
+
+async def log_flood(args):
+    # Coroutines log as fast as they can, once through a file handler writing on the loop like lib.Logger used to
+    # and once through its queue pipeline. Every tenth record carries a traceback, JSON lines are checked for it.
+    # The disk stalls for --log-stall seconds every 10k records, on the listener thread that must not reach the loop.
+    records, writers = args.log_records, 20
+    results = {}
+    failures = []
+
+    for mode in ("direct", "queued"):
+        path = os.path.join(WORK_DIR, f"flood-{mode}.log")
+        file_handler = StallingFileHandler(path, args.log_stall, 10000)
+        file_handler.setFormatter(JsonFormatter())
+
+        flood_logger = logging.getLogger(f"flood-{mode}")
+        flood_logger.propagate = False
+        flood_logger.setLevel(logging.INFO)
+        if mode == "queued":
+            flood_queue = queue.SimpleQueue()
+            flood_listener = logging.handlers.QueueListener(flood_queue, file_handler)
+            flood_listener.start()
+            flood_logger.addHandler(DeferredQueueHandler(flood_queue))
+        else:
+            flood_logger.addHandler(file_handler)
+
+        async def write(writer):
+            for index in range(records // writers):
+                if index % 10 == 0:
+                    try:
+                        raise RuntimeError(f"flood {writer}")
+                    except RuntimeError:
+                        flood_logger.exception("FAILED: Record %s of writer %s", index, writer, extra=fields(1, 2, writer))
+                else:
+                    flood_logger.info("Record %s of writer %s", index, writer, extra=fields(1, 2, writer))
+                # Commands and events get their turn between log calls in the bot too
+                await asyncio.sleep(0)
+
+        monitor = LagMonitor()
+        monitor.start()
+        started = time.monotonic()
+        await asyncio.gather(*(write(writer) for writer in range(writers)))
+        elapsed = time.monotonic() - started
+        monitor.stop()
+
+        if mode == "queued":
+            flood_listener.stop()
+        flood_logger.handlers.clear()
+        file_handler.close()
+
+        with open(path, encoding="utf-8") as output:
+            lines = [json.loads(line) for line in output]
+        with_exception = sum(1 for line in lines if "exception" in line)
+        if with_exception != records // 10:
+            failures.append(f"{mode} wrote {with_exception} tracebacks, expected {records // 10}")
+        results[mode] = dict(monitor.summary(), loop_seconds=round(elapsed, 2))
+
+    if max(monitor.lags, default=0) > args.max_lag:
+        failures.append(f"event loop stalled for {results['queued']['max_lag_ms']} ms with queued logging, allowed {args.max_lag * 1000:g} ms")
+
+    extra = {"direct": results["direct"], "queued": results["queued"]}
+    if failures:
+        extra["failed"] = "; ".join(failures)
+    return report(f"log_flood: {records} records from {writers} coroutines", results["queued"]["loop_seconds"], records, [], Counter(), 0, extra)
+
+async def legacy_check_rooms(state, bot_user):
+    # check_rooms as it was before rooms were deleted from voice events: walk the category and purge every 10 seconds
+    while True:
+        for channel in state.category.voice_channels:
+            if not state.is_entry_room(channel) and not channel.members:
+                await channel.delete(reason="Empty channel")
+        try:
+            await state.commands_room.purge(limit=30, check=lambda message: message.author != bot_user)
+        except discord.HTTPException:
+            pass
+        await asyncio.sleep(10)
+
+async def idle(args):
+    # Guilds full of occupied rooms and nobody doing anything, once with the old polling loop and once with
+    # voice events plus the reconciliation sweep. Loop wakeups are counted at the selector, figures are per hour.
+    # Sweeps only show up once --idle-seconds is longer than --reconcile-interval.
+    guilds, rooms, seconds = args.idle_guilds, args.idle_rooms, args.idle_seconds
+    results = {}
+    loop = asyncio.get_event_loop()
+
+    for mode in ("legacy", "current"):
+        gateway = FakeGateway(guild_count=guilds, member_count=rooms, latency=args.latency, rate_limits=args.rate_limits)
+        await gateway.start()
+        harness = Harness(gateway)
+        # The legacy loop stands in for the sweep, which then never gets its turn
+        await harness.start(RECONCILE_INTERVAL=3600 * 24 if mode == "legacy" else args.reconcile_interval)
+
+        for guild in gateway.guilds:
+            for member_id in guild.member_ids():
+                await gateway.join_voice(guild, member_id, guild.entry_room_id)
+        await harness.wait_for(lambda: all(len(harness.moves(guild)) >= rooms for guild in gateway.guilds), args.timeout)
+        await harness.settle(args.timeout)
+
+        legacy_tasks = [loop.create_task(legacy_check_rooms(state, harness.bot.user)) for state in harness.cog.guilds.values()] if mode == "legacy" else []
+
+        # Private selector, but every pass of the loop goes through exactly one select
+        selector = loop._selector
+        select = selector.select
+        wakeups = 0
+        def counted_select(timeout=None):
+            nonlocal wakeups
+            wakeups += 1
+            return select(timeout)
+        selector.select = counted_select
+
+        started, cpu_started = time.monotonic(), time.process_time()
+        await asyncio.sleep(seconds)
+        elapsed, cpu = time.monotonic() - started, time.process_time() - cpu_started
+        selector.select = select
+
+        for task in legacy_tasks:
+            task.cancel()
+        calls, limited = harness.api_calls(started)
+        await harness.stop()
+        await gateway.stop()
+
+        per_hour = 3600 / elapsed
+        results[mode] = {
+            "cpu_seconds": round(cpu * per_hour, 1),
+            "wakeups": round(wakeups * per_hour),
+            "purges": round(calls["GET channels/{id}/messages"] * per_hour),
+            "api_calls": round((sum(calls.values()) + limited) * per_hour),
+        }
+
+    extra = {"legacy_per_hour": results["legacy"], "current_per_hour": results["current"], "reconcile_interval": args.reconcile_interval}
+    return report(f"idle: {guilds} guilds with {rooms} occupied rooms each for {seconds:g}s", seconds, 0, [], Counter(), 0, extra)
+
+LEGACY_SCHEMA = (
+    "CREATE TABLE active_rooms (id INTEGER PRIMARY KEY AUTOINCREMENT, room_id INTEGER NOT NULL, member_id INTEGER NOT NULL, is_open INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE active_invitations (id INTEGER PRIMARY KEY AUTOINCREMENT, room_id INTEGER NOT NULL, member_id INTEGER NOT NULL)",
+)
+
+async def db_lookups(args):
+    # is_owner and is_member_invited against tables with --db-rows rooms and invitations, half of the lookups miss.
+    # Legacy is the schema without indexes queried with f-strings on the loop, database goes through lib.Database
+    # and its executor thread, cache is the in-memory RoomCache the cog answers from.
+    rows, lookups = args.db_rows, args.db_lookups
+    random.seed(rows)
+    rooms = [(1000000 + index, 5000000 + index, 9000000 + index) for index in range(rows)]
+    samples = []
+    for index in range(lookups):
+        room_id, owner_id, invited_id = random.choice(rooms)
+        miss = index % 2
+        samples.append((room_id, owner_id + miss, invited_id + miss))
+
+    legacy_path = os.path.join(WORK_DIR, "legacy.db")
+    legacy = sqlite3.connect(legacy_path)
+    for statement in LEGACY_SCHEMA:
+        legacy.execute(statement)
+    legacy.executemany("INSERT INTO active_rooms (room_id, member_id) VALUES (?, ?)", [(room_id, owner_id) for room_id, owner_id, _ in rooms])
+    legacy.executemany("INSERT INTO active_invitations (room_id, member_id) VALUES (?, ?)", [(room_id, invited_id) for room_id, _, invited_id in rooms])
+    legacy.commit()
+
+    db = Database(os.path.join(WORK_DIR, "lookups.db"))
+    for room_id, owner_id, invited_id in rooms:
+        db.add_private_room(room_id, owner_id, 1)
+        db.invite_member(room_id, invited_id, 1)
+    await db.flush()
+    cache = RoomCache(db)
+    await cache.warm()
+
+    def legacy_query(statement):
+        cursor = legacy.cursor()
+        cursor.execute(statement)
+        return bool(cursor.fetchall()[0][0])
+
+    lookups_by_mode = {
+        "legacy": (
+            lambda room_id, member_id: legacy_query(f"SELECT EXISTS (SELECT 1 FROM active_rooms WHERE room_id = {int(room_id)} AND member_id = {int(member_id)} LIMIT 1)"),
+            lambda room_id, member_id: legacy_query(f"SELECT EXISTS (SELECT 1 FROM active_invitations WHERE member_id = {int(member_id)} AND room_id = {int(room_id)} LIMIT 1)"),
+        ),
+        "database": (db.is_owner, db.is_member_invited),
+        "cache": (cache.is_owner, cache.is_member_invited),
+    }
+
+    results = {}
+    latencies = []
+    started = time.monotonic()
+    for mode, (is_owner, is_member_invited) in lookups_by_mode.items():
+        for name, lookup, member_index in (("is_owner", is_owner, 1), ("is_member_invited", is_member_invited, 2)):
+            timings = []
+            for sample in samples:
+                lookup_started = time.perf_counter()
+                result = lookup(sample[0], sample[member_index])
+                if asyncio.iscoroutine(result):
+                    await result
+                timings.append(time.perf_counter() - lookup_started)
+            results[f"{mode}.{name}"] = f"p50 {percentile(timings, 0.5) * 1e6:.1f} us, p99 {percentile(timings, 0.99) * 1e6:.1f} us"
+            if mode == "database":
+                latencies.extend(timings)
+    elapsed = time.monotonic() - started
+
+    legacy.close()
+    db.close()
+    for path in (legacy_path, db.name, db.name + "-wal", db.name + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+    return report(f"db_lookups: {lookups} lookups each against {rows} rooms and invitations", elapsed, lookups * 2 * len(lookups_by_mode), latencies, Counter(), 0, results)
+
+# Room names people pick, profane ones are built from the list itself
+NAME_WORDS = ("gaming", "night", "study", "group", "chill", "music", "room", "squad", "raid", "lobby", "movie", "talk", "homework", "friends", "late")
+
+def legacy_profanity_match(name):
+    # Rename check as it was: read the list on every call and test the words one after another
+    with open("./assets/bad_words.txt", "r") as file:
+        words = file.readlines()
+    for word in words:
+        word = word.rstrip()
+        if word in name.lower():
+            return word
+    return None
+
+async def profanity(args):
+    # Renames checked per second by the old loop and the compiled matcher, with and without normalization.
+    # Every fifth name hides a listed word, every tenth spells it in leetspeak which only normalization catches.
+    count = args.names
+    random.seed(count)
+    with open("./assets/bad_words.txt", "r") as file:
+        bad_words = [line.strip() for line in file if line.strip()]
+    leet = str.maketrans({"o": "0", "i": "1", "e": "3", "a": "4", "s": "5"})
+
+    names = []
+    for index in range(count):
+        words = [random.choice(NAME_WORDS) for _ in range(random.randint(1, 4))]
+        if index % 5 == 0:
+            word = random.choice(bad_words)
+            words.insert(random.randint(0, len(words)), word.translate(leet) if index % 10 == 0 else word.upper())
+        names.append(" ".join(words) + f" {index % 100}")
+
+    matchers = {
+        "legacy": legacy_profanity_match,
+        "compiled": ProfanityFilter(normalize=False).match,
+        "normalized": ProfanityFilter(normalize=True).match,
+    }
+
+    results = {}
+    rejected = {}
+    started = time.monotonic()
+    for mode, match in matchers.items():
+        mode_started = time.perf_counter()
+        rejected[mode] = [match(name) is not None for name in names]
+        elapsed = time.perf_counter() - mode_started
+        results[mode] = {"names_per_second": round(count / elapsed), "rejected": sum(rejected[mode])}
+    elapsed = time.monotonic() - started
+
+    # The compiled matcher has to reject exactly what the old loop rejected, normalization only adds to it
+    failures = []
+    disagreeing = sum(1 for old, new in zip(rejected["legacy"], rejected["compiled"]) if old != new)
+    if disagreeing:
+        failures.append(f"compiled matcher disagrees with the old loop on {disagreeing} names")
+    missed = sum(1 for old, new in zip(rejected["compiled"], rejected["normalized"]) if old and not new)
+    if missed:
+        failures.append(f"normalization let {missed} names through that the compiled matcher rejects")
+
+    extra = dict(results)
+    if failures:
+        extra["failed"] = "; ".join(failures)
+    return report(f"profanity: {count} renames checked against {len(bad_words)} words", elapsed, count * len(matchers), [], Counter(), 0, extra)
+
+async def member_lookup(args):
+    # Resolving the invited members of one room as a lock/unlock rebuild does, plus the room channel itself,
+    # by scanning guild.members/guild.channels with discord.utils.get as before and by id through GuildLookup
+    invites, rounds = args.lookup_invites, args.lookup_rounds
+    results = {}
+    latencies = []
+    unresolved = 0
+    started = time.monotonic()
+
+    for size in args.lookup_sizes:
+        gateway = FakeGateway(guild_count=1, member_count=size, latency=args.latency, rate_limits=args.rate_limits)
+        await gateway.start()
+        harness = Harness(gateway)
+        await harness.start()
+
+        guild = harness.bot.get_guild(gateway.guilds[0].id)
+        # Nothing else runs on the loop while rebuilds are timed, the rest of on_ready goes first
+        await harness.wait_for(lambda: len(guild.members) > size and guild.id in gateway.registered_commands, args.timeout)
+        await harness.settle(args.timeout)
+        lookup = harness.cog.guilds[guild.id].lookup
+        member_ids = list(gateway.guilds[0].member_ids())
+        channel_ids = [channel.id for channel in guild.channels]
+
+        resolvers = {
+            "scan": (lambda member_id: discord.utils.get(guild.members, id=member_id), lambda channel_id: discord.utils.get(guild.channels, id=channel_id)),
+            "lookup": (lookup.get_member, lookup.get_channel),
+        }
+        for mode, (get_member, get_channel) in resolvers.items():
+            random.seed(size)
+            timings = []
+            for _ in range(rounds):
+                invited_ids = random.sample(member_ids, invites)
+                channel_id = random.choice(channel_ids)
+                rebuild_started = time.perf_counter()
+                resolved = [get_member(member_id) for member_id in invited_ids]
+                get_channel(channel_id)
+                timings.append(time.perf_counter() - rebuild_started)
+                unresolved += resolved.count(None)
+            results[f"{size}.{mode}"] = f"p50 {percentile(timings, 0.5) * 1000:.3f} ms, p99 {percentile(timings, 0.99) * 1000:.3f} ms"
+            if mode == "lookup":
+                latencies.extend(timings)
+
+        await harness.stop()
+        await gateway.stop()
+
+    elapsed = time.monotonic() - started
+    if unresolved:
+        results["failed"] = f"{unresolved} invited members weren't found"
+    return report(f"member_lookup: {invites} invited members resolved per rebuild at {'/'.join(map(str, args.lookup_sizes))} members", elapsed, rounds * len(args.lookup_sizes) * 2, latencies, Counter(), 0, results)
+
+SCENARIOS = {
+    "entry_rush": entry_rush,
+    "lock_storm": lock_storm,
+    "stale_restart": stale_restart,
+    "teardown": teardown,
+    "flapping": flapping,
+    "command_flood": command_flood,
+    "overwrites": overwrites,
+    "log_flood": log_flood,
+    "idle": idle,
+    "db_lookups": db_lookups,
+    "profanity": profanity,
+    "member_lookup": member_lookup,
+}
+
+async def main(args):
+    results = []
+    for name in args.scenarios:
+        results.append(await SCENARIOS[name](args))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf8") as output:
+            json.dump({"latency": args.latency, "results": results}, output, indent=4)
+
+    # Scenarios with a pass condition record why they failed
+    failed = [result["scenario"] for result in results if result.get("failed")]
+    if failed:
+        print(f"\nFAILED: {', '.join(failed)}")
+    return not failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Rooms cog against a simulated Discord guild")
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS), help="scenarios to run, all by default")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every REST call takes")
+    parser.add_argument("--no-rate-limits", action="store_true", help="never answer with 429")
+    parser.add_argument("--users", type=int, default=500, help="entry_rush: users joining the entry room")
+    parser.add_argument("--spread", type=float, default=10, help="entry_rush: seconds the joins are spread over")
+    parser.add_argument("--owners", type=int, default=20, help="lock_storm: room owners")
+    parser.add_argument("--invites", type=int, default=10, help="lock_storm: members invited by every owner")
+    parser.add_argument("--rounds", type=int, default=10, help="lock_storm: lock/unlock rounds")
+    parser.add_argument("--slash", action="store_true", help="lock_storm: use slash commands instead of prefix commands")
+    parser.add_argument("--rooms", type=int, default=1000, help="stale_restart: stale rooms left in the category")
+    parser.add_argument("--teardown-rooms", type=int, default=10, help="teardown: rooms deleted at once")
+    parser.add_argument("--room-members", type=int, default=25, help="teardown: members sitting in every room")
+    parser.add_argument("--no-afk", action="store_true", help="teardown: don't move members to the AFK room first")
+    parser.add_argument("--flappers", type=int, default=100, help="flapping: owners reconnecting and bouncing")
+    parser.add_argument("--bounces", type=int, default=3, help="flapping: reconnect and entry room bounces per owner")
+    parser.add_argument("--no-debounce", action="store_true", help="flapping: handle every voice update on its own")
+    parser.add_argument("--commands", type=int, default=10000, help="command_flood: commands sent in total")
+    parser.add_argument("--flood-owners", type=int, default=100, help="command_flood: room owners sending them")
+    parser.add_argument("--flood-spread", type=float, default=5, help="command_flood: seconds the commands are spread over")
+    parser.add_argument("--idle-guilds", type=int, default=4, help="idle: guilds served")
+    parser.add_argument("--idle-rooms", type=int, default=25, help="idle: occupied rooms in every guild")
+    parser.add_argument("--idle-seconds", type=float, default=60, help="idle: seconds measured for each mode")
+    parser.add_argument("--reconcile-interval", type=float, default=600, help="idle: sweep interval of the current code, RECONCILE_INTERVAL setting")
+    parser.add_argument("--db-rows", type=int, default=100000, help="db_lookups: rooms and invitations stored")
+    parser.add_argument("--db-lookups", type=int, default=2000, help="db_lookups: lookups per query and mode")
+    parser.add_argument("--names", type=int, default=10000, help="profanity: room names checked")
+    parser.add_argument("--lookup-sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="member_lookup: guild sizes measured")
+    parser.add_argument("--lookup-invites", type=int, default=10, help="member_lookup: invited members resolved per rebuild")
+    parser.add_argument("--lookup-rounds", type=int, default=200, help="member_lookup: rebuilds per guild size and mode")
+    parser.add_argument("--log-records", type=int, default=100000, help="log_flood: records logged in total")
+    parser.add_argument("--log-stall", type=float, default=0.2, help="log_flood: seconds a simulated disk write blocks every 10k records, 0 for none")
+    parser.add_argument("--max-lag", type=float, default=0.5, help="command_flood, log_flood: longest allowed event loop stall in seconds")
+    parser.add_argument("--lean", action="store_true", help="overwrites: cache only members in voice like LEAN_MODE")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds a scenario may take before giving up")
+    parser.add_argument("--json", help="also write results into this file")
+    args = parser.parse_args()
+
+    args.rate_limits = {} if args.no_rate_limits else RATE_LIMITS
+    logging.getLogger("discord").setLevel(logging.ERROR)
+
+    sys.exit(0 if asyncio.run(main(args)) else 1)